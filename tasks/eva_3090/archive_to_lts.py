@@ -1,8 +1,12 @@
 import gzip
-import shutil
+import hashlib
+import json
+import math
 import tarfile
 import os.path
 from argparse import ArgumentParser
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 from ebi_eva_common_pyutils.logger import logging_config
 from retry import retry
@@ -10,13 +14,11 @@ from retry import retry
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
-
-def make_tarfile(source_dir, output_filename):
-    logger.info(f'Create Final Tar file {output_filename}.')
-    with tarfile.open(output_filename, "w") as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
-    file_stats = os.stat(output_filename)
-    logger.info(f'{output_filename} completed. File Size in Bytes is {file_stats.st_size}')
+MEG = 2 ** 20
+# Files are compressed in blocks of this size, each block being an independent gzip member. Files larger than one
+# block are therefore compressed in parallel and result in a multi-member gzip file that gunzip reads as one stream.
+DEFAULT_BLOCK_SIZE = 64 * MEG
+COPY_CHUNK_SIZE = 16 * MEG
 
 
 def is_compressed(file_path):
@@ -28,75 +30,281 @@ def is_compressed(file_path):
 
 
 @retry(tries=5, delay=3, backoff=2, logger=logger)
-def retriable_compress(src_file_path, dest_file_path):
-    MEG = 2 ** 20
+def retriable_compress_block(src_file_path, offset, length):
     with open(src_file_path, 'rb') as f_in:
-        with gzip.open(dest_file_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out, length=16 * MEG)
+        f_in.seek(offset)
+        return gzip.compress(f_in.read(length), mtime=0)
 
 
 def matches(name, patterns):
     return any((pattern for pattern in patterns if pattern in name))
 
 
-@retry(tries=5, delay=3, backoff=2, logger=logger)
-def retriable_remove(path):
-    shutil.rmtree(path)
+class ArchiveEntry:
+    """A directory, symlink or file to add to the archive, with the name it has in the archive"""
 
+    def __init__(self, src_path, arcname, compress=False):
+        self.src_path = src_path
+        self.arcname = arcname
+        self.compress = compress
+        self.stat = os.lstat(src_path)
 
-@retry(tries=5, delay=3, backoff=2, logger=logger)
-def retryable_copy(src_file_path, dest_file_path, **kwargs):
-    if os.path.exists(dest_file_path):
-        os.remove(dest_file_path)
-    shutil.copyfile(src_file_path, dest_file_path, **kwargs)
+    def get_tarinfo(self, size=0):
+        tarinfo = tarfile.TarInfo(self.arcname)
+        tarinfo.mode = self.stat.st_mode & 0o7777
+        tarinfo.mtime = int(self.stat.st_mtime)
+        tarinfo.uid = self.stat.st_uid
+        tarinfo.gid = self.stat.st_gid
+        if os.path.islink(self.src_path):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(self.src_path)
+        elif os.path.isdir(self.src_path):
+            tarinfo.type = tarfile.DIRTYPE
+        else:
+            tarinfo.size = size
+        return tarinfo
 
+    def is_regular_file(self):
+        return not os.path.islink(self.src_path) and os.path.isfile(self.src_path)
 
-def archive_directory(root_dir, scratch_dir, destination_dir, filter_patterns=None):
 
-    root_dir_name = os.path.basename(root_dir)
-    logger.info(f'Archive {root_dir_name} from {root_dir}')
+def list_entries_to_archive(root_dir, filter_patterns):
+    """List, in a deterministic order, the entries of root_dir that are not excluded by the filters"""
     parent_root_dir = os.path.dirname(root_dir)
     for base, dirs, files in os.walk(root_dir, topdown=True, followlinks=False):
         # Filter the downstream directory to
         filtered_dir = []
-        for d in dirs:
+        linked_dirs = []
+        for d in sorted(dirs):
             if matches(d, filter_patterns):
                 logger.info(f'Ignore directory {d} because of filters: {filter_patterns}')
+            elif os.path.islink(os.path.join(base, d)):
+                linked_dirs.append(d)
             else:
                 filtered_dir.append(d)
         # modify dirs in place
         dirs[:] = filtered_dir
-        src_basename = os.path.relpath(base, parent_root_dir)
-        scratch_dest_dir = os.path.join(scratch_dir, src_basename)
-        os.makedirs(scratch_dest_dir, exist_ok=True)
-        for fname in files:
+        yield ArchiveEntry(base, os.path.relpath(base, parent_root_dir))
+        for d in linked_dirs:
+            yield ArchiveEntry(os.path.join(base, d), os.path.relpath(os.path.join(base, d), parent_root_dir))
+        for fname in sorted(files):
             src_file_path = os.path.join(base, fname)
-            dest_file_path = os.path.join(scratch_dest_dir, fname)
             if matches(fname, filter_patterns):
                 logger.info(f'Ignore file {src_file_path} because of filters: {filter_patterns}')
                 continue
+            arcname = os.path.relpath(src_file_path, parent_root_dir)
             if os.path.islink(src_file_path) or is_compressed(src_file_path):
-                logger.info(f'Copy {src_file_path}')
-                retryable_copy(src_file_path, dest_file_path, follow_symlinks=False)
+                yield ArchiveEntry(src_file_path, arcname)
+            else:
+                yield ArchiveEntry(src_file_path, arcname + '.gz', compress=True)
+
+
+class ArchiveManifest:
+    """
+    Record every entry written to the tar file with its checksum and its end offset in the tar file. Entries are
+    written in a deterministic order so the entries of the manifest are the ones a resumed run can skip.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        valid_length = 0
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rb') as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        entry = None
+                    if entry is None or not line.endswith(b'\n'):
+                        # The last line might be incomplete if the previous run was interrupted while writing it
+                        break
+                    self.entries[entry['name']] = entry
+                    valid_length += len(line)
+        self.manifest = open(manifest_path, 'a')
+        self.manifest.truncate(valid_length)
+
+    @property
+    def end_offset(self):
+        return max((entry['end_offset'] for entry in self.entries.values()), default=0)
+
+    def is_archived(self, archive_entry):
+        entry = self.entries.get(archive_entry.arcname)
+        if entry is None:
+            return False
+        if entry['source_size'] != archive_entry.stat.st_size or entry['source_mtime'] != archive_entry.stat.st_mtime:
+            logger.warning(f'{archive_entry.src_path} changed since it was archived. The archived version is kept.')
+        return True
+
+    def add(self, archive_entry, archived_size, md5, end_offset):
+        entry = {'name': archive_entry.arcname, 'source': archive_entry.src_path,
+                 'source_size': archive_entry.stat.st_size, 'source_mtime': archive_entry.stat.st_mtime,
+                 'archived_size': archived_size, 'md5': md5, 'end_offset': end_offset}
+        self.manifest.write(json.dumps(entry) + '\n')
+        self.manifest.flush()
+        self.entries[entry['name']] = entry
+
+    def close(self):
+        self.manifest.close()
+
+
+class StreamingTarWriter:
+    """
+    Write a GNU tar file in one pass. The size of a compressed file is only known once its last block is written so
+    its header is written with a placeholder size and rewritten once the data is written.
+    """
+
+    def __init__(self, tar_path, offset):
+        if offset and (not os.path.exists(tar_path) or os.path.getsize(tar_path) < offset):
+            raise ValueError(f'{tar_path} is shorter than what its manifest records. Remove both to start again.')
+        self.tar_file = open(tar_path, 'r+b' if os.path.exists(tar_path) else 'wb')
+        # Remove the end of archive marker and any partially written entry
+        self.tar_file.truncate(offset)
+        self.tar_file.seek(offset)
+
+    def _header(self, tarinfo):
+        return tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape')
+
+    def add_entry(self, archive_entry, data_chunks=()):
+        """Write the entry and its data, and return the size and md5 of the data written"""
+        header_offset = self.tar_file.tell()
+        header = self._header(archive_entry.get_tarinfo())
+        self.tar_file.write(header)
+        md5 = hashlib.md5()
+        size = 0
+        for chunk in data_chunks:
+            self.tar_file.write(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+        if size:
+            remainder = size % tarfile.BLOCKSIZE
+            if remainder:
+                self.tar_file.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            end_offset = self.tar_file.tell()
+            final_header = self._header(archive_entry.get_tarinfo(size))
+            assert len(final_header) == len(header)
+            self.tar_file.seek(header_offset)
+            self.tar_file.write(final_header)
+            self.tar_file.seek(end_offset)
+        # The entry is only recorded in the manifest once it is in the tar file
+        self.tar_file.flush()
+        return size, md5.hexdigest()
+
+    def tell(self):
+        return self.tar_file.tell()
+
+    def close(self):
+        # End of archive marker followed by padding to a full record like tarfile does
+        self.tar_file.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self.tar_file.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self.tar_file.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self.tar_file.close()
+
+
+def read_file_chunks(file_path):
+    with open(file_path, 'rb') as f_in:
+        while True:
+            chunk = f_in.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def get_num_blocks(archive_entry, block_size):
+    # Empty files still need one (empty) gzip member
+    return max(1, math.ceil(archive_entry.stat.st_size / block_size))
+
+
+class BlockCompressor:
+    """
+    Compress the blocks of the files to archive in a process pool, ahead of the tar writer and in the order the tar
+    writer needs them. At most max_blocks_in_flight blocks are submitted and not yet written, which bounds the memory.
+    """
+
+    def __init__(self, entries, executor, block_size, max_blocks_in_flight):
+        self.entries = entries
+        self.executor = executor
+        self.block_size = block_size
+        self.max_blocks_in_flight = max_blocks_in_flight
+        self.blocks_to_submit = ((index, block * block_size)
+                                 for index, entry in enumerate(entries) if entry.compress
+                                 for block in range(get_num_blocks(entry, block_size)))
+        self.futures_per_entry = defaultdict(deque)
+        self.blocks_in_flight = 0
+
+    def _submit_blocks(self):
+        while self.blocks_in_flight < self.max_blocks_in_flight:
+            block = next(self.blocks_to_submit, None)
+            if block is None:
+                return
+            index, offset = block
+            self.futures_per_entry[index].append(
+                self.executor.submit(retriable_compress_block, self.entries[index].src_path, offset, self.block_size)
+            )
+            self.blocks_in_flight += 1
+
+    def _compressed_blocks(self, index):
+        for _ in range(get_num_blocks(self.entries[index], self.block_size)):
+            # Blocks are submitted in order so the blocks in flight all belong to this entry when it has none left
+            if not self.futures_per_entry[index]:
+                self._submit_blocks()
+            compressed_block = self.futures_per_entry[index].popleft().result()
+            self.blocks_in_flight -= 1
+            self._submit_blocks()
+            yield compressed_block
+        del self.futures_per_entry[index]
+
+    def __iter__(self):
+        """Yield each entry with an iterator over the data to write in the archive for it"""
+        self._submit_blocks()
+        for index, entry in enumerate(self.entries):
+            if entry.compress:
+                yield entry, self._compressed_blocks(index)
+            elif entry.is_regular_file():
+                yield entry, read_file_chunks(entry.src_path)
             else:
-                logger.info(f'Compress {src_file_path}')
-                retriable_compress(src_file_path, dest_file_path + '.gz')
+                yield entry, ()
+
+
+def archive_directory(root_dir, destination_dir, filter_patterns=None, num_processes=1, block_size=DEFAULT_BLOCK_SIZE):
+    filter_patterns = filter_patterns or []
+    root_dir_name = os.path.basename(root_dir)
+    logger.info(f'Archive {root_dir_name} from {root_dir}')
+    os.makedirs(destination_dir, exist_ok=True)
     final_tar_file = os.path.join(destination_dir, root_dir_name + '.tar')
-    scratch_dir_archived = os.path.join(scratch_dir, root_dir_name)
-    make_tarfile(scratch_dir_archived, final_tar_file)
-    logger.info(f'Delete scratch folder {scratch_dir_archived}.')
-    retriable_remove(scratch_dir_archived)
-    logger.info(f'Scratch folder {scratch_dir_archived} deleted.')
+    manifest = ArchiveManifest(final_tar_file + '.manifest')
+    if manifest.entries:
+        logger.info(f'Resume archive of {root_dir_name}: {len(manifest.entries)} entries already archived')
+    tar_writer = StreamingTarWriter(final_tar_file, manifest.end_offset)
+    entries = [entry for entry in list_entries_to_archive(root_dir, filter_patterns)
+               if not manifest.is_archived(entry)]
+    try:
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            for entry, data_chunks in BlockCompressor(entries, executor, block_size,
+                                                      max_blocks_in_flight=num_processes * 2):
+                logger.info(f'{"Compress" if entry.compress else "Add"} {entry.src_path}')
+                archived_size, md5 = tar_writer.add_entry(entry, data_chunks)
+                manifest.add(entry, archived_size, md5, tar_writer.tell())
+        tar_writer.close()
+    finally:
+        manifest.close()
+    file_stats = os.stat(final_tar_file)
+    logger.info(f'{final_tar_file} completed. File Size in Bytes is {file_stats.st_size}')
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument('--root_dir', required=True, type=str)
     parser.add_argument('--destination_dir', required=True, type=str)
-    parser.add_argument('--scratch_dir', required=True, type=str)
     parser.add_argument('--filter_patterns', type=str, nargs='*', default=[] )
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help='Number of processes compressing the files')
+    parser.add_argument('--block_size_mb', type=int, default=DEFAULT_BLOCK_SIZE // MEG,
+                        help='Size of the blocks compressed independently. Larger files are compressed in parallel')
     args = parser.parse_args()
-    archive_directory(args.root_dir, args.scratch_dir,  args.destination_dir, args.filter_patterns)
+    archive_directory(args.root_dir, args.destination_dir, args.filter_patterns, num_processes=args.num_processes,
+                      block_size=args.block_size_mb * MEG)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,62 @@
+import gzip
 import os
+import tarfile
 
-from tasks.eva_3090.archive_to_lts import archive_directory
+from tasks.eva_3090.archive_to_lts import archive_directory, ArchiveManifest
 
+resources = os.path.join(os.path.dirname(__file__), 'resources')
+src_dir = os.path.join(resources, 'src')
+expected_members = ['src', 'src/dir1', 'src/dir1/dir2', 'src/dir1/dir2/test5.txt.gz', 'src/dir1/test3.txt.gz',
+                    'src/dir1/test4.txt.gz', 'src/test1.txt.gz', 'src/test2.txt.gz']
 
-def test_archive_directory():
-    resources = os.path.join(os.path.dirname(__file__), 'resources')
-    src_dir = os.path.join(resources, 'src')
-    dest_dir = os.path.join(resources, 'dest')
-    scratch_dir = os.path.join(resources, 'scratch')
 
-    archive_directory(src_dir, scratch_dir, dest_dir, filter_patterns=['do_not_want'])
+def read_archive(tar_path):
+    with tarfile.open(tar_path) as tar:
+        return {member.name: tar.extractfile(member).read() if member.isfile() else None
+                for member in tar.getmembers()}
+
+
+def test_archive_directory(tmp_path):
+    dest_dir = os.path.join(tmp_path, 'dest')
+
+    archive_directory(src_dir, dest_dir, filter_patterns=['do_not_want'])
+
+    members = read_archive(os.path.join(dest_dir, 'src.tar'))
+    assert sorted(members) == expected_members
+    with open(os.path.join(src_dir, 'dir1', 'test3.txt'), 'rb') as open_file:
+        assert gzip.decompress(members['src/dir1/test3.txt.gz']) == open_file.read()
+    with open(os.path.join(src_dir, 'dir1', 'test4.txt.gz'), 'rb') as open_file:
+        assert members['src/dir1/test4.txt.gz'] == open_file.read()
+    assert sorted(ArchiveManifest(os.path.join(dest_dir, 'src.tar.manifest')).entries) == expected_members
+
+
+def test_archive_directory_in_blocks(tmp_path):
+    src_file_dir = os.path.join(tmp_path, 'big')
+    os.makedirs(src_file_dir)
+    content = b''.join(b'line %d of a file larger than a block\n' % i for i in range(20000))
+    with open(os.path.join(src_file_dir, 'big_file.txt'), 'wb') as open_file:
+        open_file.write(content)
+
+    archive_directory(src_file_dir, os.path.join(tmp_path, 'dest'), num_processes=2, block_size=100000)
+
+    members = read_archive(os.path.join(tmp_path, 'dest', 'big.tar'))
+    assert gzip.decompress(members['big/big_file.txt.gz']) == content
+
+
+def test_resume_archive_directory(tmp_path):
+    dest_dir = os.path.join(tmp_path, 'dest')
+    archive_directory(src_dir, dest_dir, filter_patterns=['do_not_want'])
+    manifest_path = os.path.join(dest_dir, 'src.tar.manifest')
+    with open(manifest_path) as open_file:
+        manifest_lines = open_file.readlines()
+    # Simulate a run interrupted after the first entries with a partially written tar file and manifest
+    with open(manifest_path, 'w') as open_file:
+        open_file.writelines(manifest_lines[:3])
+        open_file.write(manifest_lines[3][:10])
+    with open(os.path.join(dest_dir, 'src.tar'), 'r+b') as open_file:
+        open_file.truncate(os.path.getsize(os.path.join(dest_dir, 'src.tar')) // 2)
+
+    archive_directory(src_dir, dest_dir, filter_patterns=['do_not_want'])
+
+    assert sorted(read_archive(os.path.join(dest_dir, 'src.tar'))) == expected_members
+    assert sorted(ArchiveManifest(manifest_path).entries) == expected_members
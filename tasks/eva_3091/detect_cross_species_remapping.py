@@ -1,39 +1,58 @@
 import argparse
-import datetime
-import json
-import os.path
-import atexit
 from collections import defaultdict
 
+import requests
+from ebi_eva_common_pyutils import ncbi_utils
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.metadata_utils import get_metadata_connection_handle
 from ebi_eva_common_pyutils.ncbi_utils import get_ncbi_assembly_dicts_from_term, get_ncbi_taxonomy_dicts_from_ids
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
+from retry import retry
 
-cached_dict = {}
-cached_file = 'cached_data.json'
-if os.path.exists(cached_file):
-    with open(cached_file) as open_file:
-        cached_dict = json.load(open_file)
-if 'assembly_dicts' not in cached_dict: cached_dict['assembly_dicts'] = {}
-if 'taxonomy_dicts' not in cached_dict: cached_dict['taxonomy_dicts'] = {}
-
-def exit_handler():
-    with open(cached_file, 'w') as open_file:
-        json.dump(cached_dict, open_file)
-
-
-atexit.register(exit_handler)
-
-
+from tasks.eva_3091.lookup_cache import LookupCache
 
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
+cache = LookupCache('cached_data.sqlite')
+
+
+@retry(tries=3, delay=2, backoff=1.2, jitter=(1, 3))
+def get_ncbi_assembly_dicts_per_accession(assemblies):
+    """
+    Retrieve the NCBI assembly dicts of several assemblies with one search and one summary query. Only the dicts
+    that have the assembly accession as accession or synonym are associated with it. Assemblies without any are left
+    out so that they are searched individually.
+    """
+    payload = {'db': 'Assembly', 'term': ' OR '.join('"{}"'.format(assembly) for assembly in assemblies),
+               'retmode': 'JSON', 'retmax': 10000}
+    response = requests.get(ncbi_utils.esearch_url, params=payload)
+    response.raise_for_status()
+    assembly_id_list = response.json().get('esearchresult', {}).get('idlist', [])
+    assembly_dicts_per_accession = defaultdict(list)
+    if not assembly_id_list:
+        return assembly_dicts_per_accession
+    response = requests.post(ncbi_utils.esummary_url,
+                             data={'db': 'Assembly', 'id': ','.join(assembly_id_list), 'retmode': 'JSON'})
+    response.raise_for_status()
+    summary_list = response.json()
+    for assembly_id in summary_list.get('result', {}).get('uids', []):
+        assembly_dict = summary_list.get('result').get(assembly_id)
+        accessions = set([assembly_dict.get('assemblyaccession')] + list(assembly_dict.get('synonym', {}).values()))
+        for accession in accessions.intersection(assemblies):
+            assembly_dicts_per_accession[accession].append(assembly_dict)
+    return assembly_dicts_per_accession
+
+
+def get_ncbi_taxonomy_dicts_per_id(taxids):
+    taxonomy_dicts_per_id = defaultdict(list)
+    for taxonomy_dict in get_ncbi_taxonomy_dicts_from_ids([str(taxid) for taxid in taxids]):
+        taxonomy_dicts_per_id[str(taxonomy_dict.get('uid'))].append(taxonomy_dict)
+    return taxonomy_dicts_per_id
+
+
 def cached_get_key_from(assembly, key):
-    if assembly not in cached_dict['assembly_dicts']:
-        cached_dict['assembly_dicts'][assembly] = get_ncbi_assembly_dicts_from_term(assembly)
-    assembly_dicts = cached_dict['assembly_dicts'][assembly]
+    assembly_dicts = cache.get_or_fetch('assembly_dicts', assembly, get_ncbi_assembly_dicts_from_term)
     values = set([d.get(key) for d in assembly_dicts])
     if len(values) > 1:
         # Only keep the one that have the assembly accession as a synonymous and check again
@@ -54,9 +73,8 @@ def cached_get_assembly_name_from(assembly):
 
 
 def cached_get_scientific_name(taxid):
-    if taxid not in cached_dict['taxonomy_dicts']:
-        cached_dict['taxonomy_dicts'][taxid] = get_ncbi_taxonomy_dicts_from_ids([str(taxid)])
-    taxonomy_dicts = cached_dict['taxonomy_dicts'][taxid]
+    taxonomy_dicts = cache.get_or_fetch('taxonomy_dicts', taxid,
+                                        lambda taxid: get_ncbi_taxonomy_dicts_from_ids([str(taxid)]))
     scientific_names = set([d.get('scientificname') for d in taxonomy_dicts])
     if len(scientific_names) != 1:
         raise ValueError(f"Cannot resolve taxonomy's name for taxonomy_id {taxid} in NCBI. "
@@ -87,6 +105,17 @@ def detect_species_with_cross_species_target(maven_config, maven_profile):
         for taxonomy, assembly, remapping_start, study_accessions in get_all_results_for_query(pg_conn, query):
             assemblies_to_species_clustering_dates[(taxonomy, assembly)].append(remapping_start)
 
+    # Retrieve in batches what the checks below will look up in NCBI
+    all_assemblies = set(assembly for assemblies in taxonomy_to_assemblies.values() for assembly in assemblies)
+    cache.prefetch('assembly_dicts', all_assemblies, get_ncbi_assembly_dicts_per_accession)
+    all_taxonomies = set(taxonomy_to_assemblies)
+    for assembly in all_assemblies:
+        try:
+            all_taxonomies.add(cached_get_taxonomy_from(assembly))
+        except ValueError:
+            pass
+    cache.prefetch('taxonomy_dicts', all_taxonomies, get_ncbi_taxonomy_dicts_per_id)
+
     for taxonomy in taxonomy_to_current_assembly:
         for assembly in taxonomy_to_assemblies[taxonomy]:
             taxonomy_from_assembly = cached_get_taxonomy_from(assembly)
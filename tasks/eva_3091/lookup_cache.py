@@ -0,0 +1,124 @@
+import json
+import sqlite3
+import threading
+import time
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+class _InFlightLookup:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LookupCache:
+    """
+    Persistent cache of remote lookups (NCBI, Ensembl...) stored in SQLite.
+    Entries are grouped by namespace and written one by one so an interrupted run keeps everything looked up so far.
+    A lookup that found nothing is cached as None for negative_ttl seconds while other entries are kept for ttl seconds.
+    Concurrent lookups of the same key are coalesced so that only one thread queries the remote service.
+    """
+
+    def __init__(self, cache_file, ttl=30 * DAY, negative_ttl=DAY):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._connection = None
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.cache_file, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS lookup_cache (namespace TEXT, key TEXT, value TEXT, '
+                                     'expires_at REAL, PRIMARY KEY (namespace, key))')
+            self._connection.commit()
+        return self._connection
+
+    def _get(self, namespace, key):
+        row = self.connection.execute(
+            'SELECT value FROM lookup_cache WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (namespace, str(key), time.time())
+        ).fetchone()
+        return (True, json.loads(row[0])) if row else (False, None)
+
+    def get(self, namespace, key):
+        """Return whether the key is cached and its value"""
+        with self.lock:
+            return self._get(namespace, key)
+
+    def _set_many(self, namespace, values):
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO lookup_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            [(namespace, str(key), json.dumps(value), now + (self.ttl if value is not None else self.negative_ttl))
+             for key, value in values.items()]
+        )
+        self.connection.commit()
+
+    def set(self, namespace, key, value):
+        with self.lock:
+            self._set_many(namespace, {key: value})
+
+    def get_or_fetch(self, namespace, key, fetch):
+        """
+        Return the cached value of the key or call fetch(key) to retrieve it and cache it. If another thread is already
+        fetching the same key, wait for its result instead. Errors raised by fetch are not cached.
+        """
+        with self.lock:
+            found, value = self._get(namespace, key)
+            if found:
+                self.hits += 1
+                return value
+            in_flight_lookup = self.in_flight.get((namespace, str(key)))
+            fetching = in_flight_lookup is None
+            if fetching:
+                self.misses += 1
+                in_flight_lookup = self.in_flight[(namespace, str(key))] = _InFlightLookup()
+        if not fetching:
+            in_flight_lookup.done.wait()
+            if in_flight_lookup.error:
+                raise in_flight_lookup.error
+            return in_flight_lookup.value
+        try:
+            in_flight_lookup.value = fetch(key)
+            self.set(namespace, key, in_flight_lookup.value)
+            return in_flight_lookup.value
+        except Exception as e:
+            in_flight_lookup.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[(namespace, str(key))]
+            in_flight_lookup.done.set()
+
+    def prefetch(self, namespace, keys, fetch_many, batch_size=200):
+        """
+        Retrieve the keys not yet cached in batches with fetch_many(keys), which returns a dict of the values found.
+        Keys missing from that dict are not cached and are left to get_or_fetch to look up individually.
+        """
+        with self.lock:
+            keys_to_fetch = sorted(set(key for key in keys if not self._get(namespace, key)[0]), key=str)
+        for start in range(0, len(keys_to_fetch), batch_size):
+            batch = keys_to_fetch[start:start + batch_size]
+            values = fetch_many(batch)
+            with self.lock:
+                self._set_many(namespace, values)
+            logger.info(f'Prefetched {len(values)} of {len(batch)} {namespace} entries')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,113 @@
+import logging
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Rough size of one (accession, _id) pair held in memory, used to turn the memory limit into a number of records
+BYTES_PER_RECORD = 200
+
+
+class DuplicateAccessionDetector:
+    """
+    Find the accessions shared by several documents with a bounded amount of memory.
+    Records are kept in memory until the memory limit is reached, then spilled to partition files chosen by hashing the
+    accession so that all the documents of an accession end up in the same partition. Each partition is then grouped in
+    memory on its own, and split again with a different hash if it is still too large.
+    """
+
+    def __init__(self, work_dir, memory_limit_mb=1024, num_partitions=64, max_depth=4):
+        self.work_dir = tempfile.mkdtemp(prefix='duplicate_accessions_', dir=work_dir)
+        self.max_records_in_memory = max(1, memory_limit_mb * 1024 * 1024 // BYTES_PER_RECORD)
+        self.num_partitions = num_partitions
+        self.max_depth = max_depth
+        self.records = []
+        self.partition_files = None
+        self.partition_sizes = None
+        self.num_records = 0
+
+    def add(self, accession, document_id):
+        self.records.append((accession, str(document_id)))
+        self.num_records += 1
+        if len(self.records) >= self.max_records_in_memory:
+            self._spill()
+
+    def _partition(self, accession, depth):
+        return hash((depth, accession)) % self.num_partitions
+
+    def _spill(self):
+        if self.partition_files is None:
+            self.partition_files = [open(self._partition_path(self.work_dir, partition), 'w')
+                                    for partition in range(self.num_partitions)]
+            self.partition_sizes = [0] * self.num_partitions
+        for accession, document_id in self.records:
+            partition = self._partition(accession, 0)
+            self.partition_files[partition].write(f'{accession}\t{document_id}\n')
+            self.partition_sizes[partition] += 1
+        logger.info(f'Spilled {len(self.records)} records to disk ({self.num_records} records so far)')
+        self.records = []
+
+    @staticmethod
+    def _partition_path(directory, partition):
+        return os.path.join(directory, f'partition_{partition}.tsv')
+
+    @staticmethod
+    def _read_partition(partition_path):
+        with open(partition_path) as open_file:
+            for line in open_file:
+                accession, document_id = line.rstrip('\n').split('\t')
+                yield int(accession), document_id
+
+    @staticmethod
+    def _group_duplicates(records):
+        ids_per_accession = defaultdict(list)
+        for accession, document_id in records:
+            ids_per_accession[accession].append(document_id)
+        for accession in sorted(ids_per_accession):
+            if len(ids_per_accession[accession]) > 1:
+                yield accession, ids_per_accession[accession]
+
+    def _find_duplicates_in_partition(self, partition_path, num_records, depth):
+        if num_records <= self.max_records_in_memory or depth >= self.max_depth:
+            yield from self._group_duplicates(self._read_partition(partition_path))
+            return
+        # The partition does not fit in memory: split it again using a different hash
+        sub_directory = partition_path + '.split'
+        os.makedirs(sub_directory)
+        sub_partition_files = [open(self._partition_path(sub_directory, partition), 'w')
+                               for partition in range(self.num_partitions)]
+        sub_partition_sizes = [0] * self.num_partitions
+        for accession, document_id in self._read_partition(partition_path):
+            partition = self._partition(accession, depth + 1)
+            sub_partition_files[partition].write(f'{accession}\t{document_id}\n')
+            sub_partition_sizes[partition] += 1
+        for sub_partition_file in sub_partition_files:
+            sub_partition_file.close()
+        os.remove(partition_path)
+        for partition in range(self.num_partitions):
+            yield from self._find_duplicates_in_partition(self._partition_path(sub_directory, partition),
+                                                          sub_partition_sizes[partition], depth + 1)
+
+    def find_duplicates(self):
+        """Yield each duplicated accession with the _id of all its documents, sorted by accession within a partition"""
+        try:
+            if self.partition_files is None:
+                yield from self._group_duplicates(self.records)
+                return
+            self._spill()
+            for partition_file in self.partition_files:
+                partition_file.close()
+            for partition in range(self.num_partitions):
+                yield from self._find_duplicates_in_partition(self._partition_path(self.work_dir, partition),
+                                                              self.partition_sizes[partition], 0)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.partition_files:
+            for partition_file in self.partition_files:
+                partition_file.close()
+        self.records = []
+        shutil.rmtree(self.work_dir, ignore_errors=True)
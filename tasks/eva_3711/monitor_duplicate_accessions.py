@@ -21,13 +21,15 @@ from datetime import datetime
 from urllib.parse import quote_plus
 
 import click
+from pymongo import MongoClient
 
 
 import configparser
 import logging
-import subprocess
 import sys
 
+from tasks.eva_3711.duplicate_accession_detector import DuplicateAccessionDetector
+
 
 def init_logger():
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)-15s %(levelname)s %(message)s')
@@ -60,30 +62,6 @@ def get_mongo_connection_details_from_properties_file(properties_file):
     return mongo_connection_properties
 
 
-def run_command_with_output(command_description, command, return_process_output=False):
-    process_output = ""
-
-    logger.info("Starting process: " + command_description)
-
-    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, universal_newlines=True,
-                          shell=True) as process:
-        for line in iter(process.stdout.readline, ''):
-            line = str(line).rstrip()
-            logger.info(line)
-            if return_process_output:
-                process_output += line
-        for line in iter(process.stderr.readline, ''):
-            line = str(line).rstrip()
-            logger.error(line)
-    if process.returncode != 0:
-        logger.error(command_description + " failed! Refer to the error messages for details.")
-        raise subprocess.CalledProcessError(process.returncode, process.args)
-    else:
-        logger.info(command_description + " - completed successfully")
-    if return_process_output:
-        return process_output
-
-
 logger = init_logger()
 
 
@@ -98,14 +76,24 @@ def get_mongo_uri(mongo_connection_properties, timeout=60000):
     )
 
 
-def export_mongo_accessions(mongo_connection_properties, collection_name, study, export_output_filename):
-    export_command = (f'mongoexport --uri "{get_mongo_uri(mongo_connection_properties)}" '
-                      f'--collection {collection_name} --type=csv --fields accession '
-                      f"--query  '{{\"study\": \"{study}\", \"remappedFrom\": {{\"$exists\": false}}}}' " 
-                      f'-o "{export_output_filename}" 2>&1')
-    run_command_with_output("Exporting accessions in the {0} collection in the {1} database at {2}..."
-                            .format(collection_name, mongo_connection_properties["mongo_db"],
-                                    mongo_connection_properties["mongo_host"]), export_command)
+def find_duplicate_accessions_in_mongo(mongo_connection_properties, collection_name, study, work_dir,
+                                     memory_limit_mb):
+    """Stream the accessions from the collection and return the duplicated ones with the _id of their documents"""
+    detector = DuplicateAccessionDetector(work_dir, memory_limit_mb=memory_limit_mb)
+    logger.info("Reading accessions in the {0} collection in the {1} database at {2}..."
+                .format(collection_name, mongo_connection_properties["mongo_db"],
+                        mongo_connection_properties["mongo_host"]))
+    with MongoClient(get_mongo_uri(mongo_connection_properties)) as mongo_client:
+        collection = mongo_client[mongo_connection_properties["mongo_db"]][collection_name]
+        cursor = collection.find({"study": study, "remappedFrom": {"$exists": False}}, {"accession": 1},
+                                 no_cursor_timeout=True, batch_size=10000)
+        try:
+            for document in cursor:
+                detector.add(document["accession"], document["_id"])
+        finally:
+            cursor.close()
+    logger.info("Read {0} accessions".format(detector.num_records))
+    return detector.find_duplicates()
 
 
 def notify_by_email(mongo_connection_properties, collection_name, duplicates_output_filename,
@@ -119,19 +107,14 @@ def notify_by_email(mongo_connection_properties, collection_name, duplicates_out
     smtplib.SMTP('localhost').sendmail(getpass.getuser(), email_recipients, email_message)
 
 
-def report_duplicates_in_exported_accessions_file(mongo_connection_properties, collection_name, export_output_filename,
-                                                  duplicates_output_filename, email_recipients):
-    sorted_export_output_filename = export_output_filename.replace(".csv", "_sorted.csv")
-    run_command_with_output("Sorting {0}...".format(duplicates_output_filename),
-                            'sort -S 4G -T {0} -o "{1}" "{2}"'
-                            .format(os.path.dirname(export_output_filename), sorted_export_output_filename,
-                                    export_output_filename))
-    run_command_with_output("Exporting duplicates to {0}...".format(duplicates_output_filename),
-                            'uniq -d "{0}" > {1}'.format(sorted_export_output_filename, duplicates_output_filename))
-    number_of_duplicate_accessions = run_command_with_output("Find duplicate accessions in the exported file...",
-                                                             'wc -l < "{0}"'.format(duplicates_output_filename),
-                                                             return_process_output=True)
-    if int(number_of_duplicate_accessions) > 0:
+def report_duplicates(mongo_connection_properties, collection_name, duplicate_accessions,
+                      duplicates_output_filename, email_recipients):
+    number_of_duplicate_accessions = 0
+    with open(duplicates_output_filename, "w") as duplicates_output_file:
+        for accession, document_ids in duplicate_accessions:
+            duplicates_output_file.write("{0}\t{1}\n".format(accession, ",".join(document_ids)))
+            number_of_duplicate_accessions += 1
+    if number_of_duplicate_accessions > 0:
         notify_by_email(mongo_connection_properties, collection_name, duplicates_output_filename,
                         number_of_duplicate_accessions, email_recipients)
         # Use exit code 0 as scheduler will also send email on crash
@@ -144,38 +127,40 @@ def report_duplicates_in_exported_accessions_file(mongo_connection_properties, c
 
 
 def report_duplicate_accessions_in_mongo(pipeline_properties_file, accessions_export_output_dir,
-                                         collection_name, study, email_recipients):
+                                         collection_name, study, email_recipients, memory_limit_mb=1024):
     mongo_connection_properties = get_mongo_connection_details_from_properties_file(pipeline_properties_file)
-    export_output_filename = os.path.sep.join([accessions_export_output_dir,
-                                               "accessions_in_{0}_{1}_at_{2}_as_of_{3}.csv"
-                                              .format(mongo_connection_properties["mongo_db"], collection_name,
-                                                      mongo_connection_properties["mongo_host"],
-                                                      datetime.today().strftime('%Y%m%d%H%M%S'))])
-    duplicates_output_filename = export_output_filename.replace("accessions_in", "duplicate_accessions_in")
+    duplicates_output_filename = os.path.sep.join([accessions_export_output_dir,
+                                                   "duplicate_accessions_in_{0}_{1}_at_{2}_as_of_{3}.tsv"
+                                                  .format(mongo_connection_properties["mongo_db"], collection_name,
+                                                          mongo_connection_properties["mongo_host"],
+                                                          datetime.today().strftime('%Y%m%d%H%M%S'))])
 
     logger.info("Checking duplicate accessions in the {0} collection in the {1} database at {2}..."
                 .format(collection_name, mongo_connection_properties["mongo_db"],
                         mongo_connection_properties["mongo_host"]))
 
-    export_mongo_accessions(mongo_connection_properties, collection_name, study, export_output_filename)
+    duplicate_accessions = find_duplicate_accessions_in_mongo(mongo_connection_properties, collection_name, study,
+                                                              accessions_export_output_dir, memory_limit_mb)
 
-    return report_duplicates_in_exported_accessions_file(mongo_connection_properties, collection_name,
-                                                         export_output_filename, duplicates_output_filename,
-                                                         email_recipients)
+    return report_duplicates(mongo_connection_properties, collection_name, duplicate_accessions,
+                             duplicates_output_filename, email_recipients)
 
 
 @click.option("-p", "--pipeline-properties-file", required=True)
 @click.option("-o", "--accessions-export-output-dir", required=True)
 @click.option("-s", "--study", required=True)
 @click.option("-e", "--email-recipients", multiple=True, required=True)
+@click.option("-m", "--memory-limit-mb", type=int, default=1024, show_default=True,
+              help="Memory used to hold accessions before spilling them to the output directory")
 @click.argument("collection-names", nargs=-1, required=True)
 @click.command()
-def main(pipeline_properties_file, accessions_export_output_dir, study, email_recipients, collection_names):
+def main(pipeline_properties_file, accessions_export_output_dir, study, email_recipients, memory_limit_mb,
+         collection_names):
     exit_code = 0
     for collection_name in collection_names:
         exit_code = exit_code or \
                     report_duplicate_accessions_in_mongo(pipeline_properties_file, accessions_export_output_dir,
-                                                         collection_name, study, email_recipients)
+                                                         collection_name, study, email_recipients, memory_limit_mb)
     sys.exit(exit_code)
 
 
@@ -0,0 +1,133 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+SUCCESS = 'SUCCESS'
+FAILED = 'FAILED'
+TIMED_OUT = 'TIMED_OUT'
+
+
+class DatabaseTimeoutError(Exception):
+    pass
+
+
+class WriteOpsBudget:
+    """Token bucket shared by all the workers to cap the number of write operations per second across databases"""
+
+    def __init__(self, ops_per_second):
+        self.ops_per_second = ops_per_second
+        self.available = ops_per_second
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, num_ops):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.ops_per_second,
+                                     self.available + (now - self.last_refill) * self.ops_per_second)
+                self.last_refill = now
+                # A request larger than the bucket is let through once the bucket is full
+                if self.available >= min(num_ops, self.ops_per_second):
+                    self.available -= num_ops
+                    return
+                wait_time = (min(num_ops, self.ops_per_second) - self.available) / self.ops_per_second
+            time.sleep(wait_time)
+
+
+class DatabaseTaskContext:
+    """Passed to the per-database task to check its deadline, share the write budget and report progress"""
+
+    def __init__(self, db_name, timeout=None, write_ops_budget=None):
+        self.db_name = db_name
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.write_ops_budget = write_ops_budget
+        self.progress = 0
+
+    def check_timeout(self):
+        if self.deadline and time.monotonic() > self.deadline:
+            raise DatabaseTimeoutError(f'Processing of database {self.db_name} timed out')
+
+    def acquire_write_ops(self, num_ops):
+        if self.write_ops_budget:
+            self.write_ops_budget.acquire(num_ops)
+
+    def add_progress(self, count):
+        self.progress += count
+
+
+class DatabaseTaskResult:
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.status = None
+        self.result = None
+        self.attempts = 0
+        self.duration = 0
+        self.progress = 0
+        self.error = None
+
+
+class ParallelDatabaseExecutor:
+    """
+    Run a task for each database across a bounded pool of workers.
+    The task is called with the database name and a DatabaseTaskContext. It is retried when it fails and stopped when
+    it goes over the per-database timeout, which the task enforces by calling context.check_timeout() regularly.
+    """
+
+    def __init__(self, max_workers=4, timeout=None, retries=0, retry_delay=5, write_ops_per_second=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.write_ops_budget = WriteOpsBudget(write_ops_per_second) if write_ops_per_second else None
+
+    def _run_task(self, task, db_name):
+        task_result = DatabaseTaskResult(db_name)
+        start_time = time.monotonic()
+        while task_result.attempts <= self.retries:
+            task_result.attempts += 1
+            context = DatabaseTaskContext(db_name, self.timeout, self.write_ops_budget)
+            try:
+                task_result.result = task(db_name, context)
+                task_result.status = SUCCESS
+                task_result.error = None
+            except DatabaseTimeoutError as e:
+                task_result.status = TIMED_OUT
+                task_result.error = e
+            except Exception as e:
+                logger.exception(f"[{db_name}] Attempt {task_result.attempts} failed")
+                task_result.status = FAILED
+                task_result.error = e
+            task_result.progress += context.progress
+            if task_result.status == SUCCESS or task_result.attempts > self.retries:
+                break
+            time.sleep(self.retry_delay)
+        task_result.duration = time.monotonic() - start_time
+        return task_result
+
+    def run(self, db_names, task):
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run_task, task, db_name) for db_name in db_names]
+            for future in as_completed(futures):
+                task_result = future.result()
+                results.append(task_result)
+                logger.info(f"[{task_result.db_name}] {task_result.status} after {task_result.attempts} attempt(s) "
+                            f"in {task_result.duration:.1f}s. Databases done: {len(results)}/{len(db_names)}")
+        self.report(results)
+        return results
+
+    @staticmethod
+    def report(results):
+        logger.info(f"{'Database':<40}{'Status':<12}{'Attempts':>10}{'Progress':>15}{'Duration (s)':>15}")
+        for task_result in sorted(results, key=lambda r: r.db_name):
+            logger.info(f"{task_result.db_name:<40}{task_result.status:<12}{task_result.attempts:>10}"
+                        f"{task_result.progress:>15}{task_result.duration:>15.1f}")
+        failed = [task_result.db_name for task_result in results if task_result.status != SUCCESS]
+        logger.info(f"{len(results) - len(failed)} databases succeeded, {len(failed)} failed or timed out"
+                    + (f": {failed}" if failed else ""))
@@ -3,6 +3,8 @@ from ebi_eva_internal_pyutils.mongo_utils import get_mongo_connection_handle
 from ebi_eva_common_pyutils.logger import logging_config
 from pymongo import UpdateOne
 
+from tasks.eva_4083.parallel_database_executor import ParallelDatabaseExecutor
+
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
@@ -30,28 +32,32 @@ def get_variant_type(ref, alt):
         return None
 
 
-def process_indel_variants(db_name, variant_coll):
+def process_indel_variants(db_name, variant_coll, context=None):
     modified_count = 0
     cursor = variant_coll.find(QUERY, {'_id': 1, 'ref': 1, 'alt': 1}).batch_size(BATCH_SIZE).allow_disk_use(True)
 
     batch = []
-    for variant in cursor:
-        batch.append(variant)
-        if len(batch) < BATCH_SIZE:
-            continue
+    try:
+        for variant in cursor:
+            batch.append(variant)
+            if len(batch) < BATCH_SIZE:
+                continue
 
-        # process variants in batch
-        modified_count += process_batch(db_name, batch, variant_coll)
-        batch = []
+            # process variants in batch
+            modified_count += process_batch(db_name, batch, variant_coll, context)
+            batch = []
 
-    # process remaining variants
-    if batch:
-        modified_count += process_batch(db_name, batch, variant_coll)
+        # process remaining variants
+        if batch:
+            modified_count += process_batch(db_name, batch, variant_coll, context)
+    finally:
+        cursor.close()
 
     logger.info(f"[{db_name}] Done. Total modified: {modified_count}")
+    return modified_count
 
 
-def process_batch(db_name, batch, variant_coll):
+def process_batch(db_name, batch, variant_coll, context=None):
     ids_modified = []
     bulk_ops = []
     for variant in batch:
@@ -62,9 +68,15 @@ def process_batch(db_name, batch, variant_coll):
             )
             ids_modified.append(variant['_id'])
 
+    if context:
+        context.check_timeout()
     if bulk_ops:
+        if context:
+            context.acquire_write_ops(len(bulk_ops))
         result = variant_coll.bulk_write(bulk_ops, ordered=False)
         logger.info(f"[{db_name}] Modified in batch: {result.modified_count}. Ids modified: {ids_modified}")
+        if context:
+            context.add_progress(result.modified_count)
         return result.modified_count
     else:
         logger.info(f"[{db_name}] No modification in batch")
@@ -76,6 +88,11 @@ def main():
     parser.add_argument("--private-config-xml-file", help="ex: /path/to/eva-maven-settings.xml", required=True)
     parser.add_argument('--profile', default='localhost')
     parser.add_argument('--db-name', help='Database name to run the script on', required=False)
+    parser.add_argument('--num-workers', type=int, default=4, help='Number of databases processed concurrently')
+    parser.add_argument('--db-timeout', type=int, default=None, help='Maximum time in seconds spent on one database')
+    parser.add_argument('--retries', type=int, default=0, help='Number of times a failed database is retried')
+    parser.add_argument('--write-ops-per-second', type=int, default=None,
+                        help='Maximum number of updates per second across all the databases')
     args = parser.parse_args()
 
     with get_mongo_connection_handle(args.profile, args.private_config_xml_file) as mongo_conn:
@@ -85,15 +102,18 @@ def main():
         else:
             db_list = mongo_conn.list_database_names()
 
-        for db_name in db_list:
-            if db_name in ['admin', 'config', 'local']:
-                continue
+        def process_database(db_name, context):
             db = mongo_conn[db_name]
             if VARIANT_COLL_NAME in db.list_collection_names():
                 logger.info(f"Processing Database: {db_name}")
                 variant_coll = db[VARIANT_COLL_NAME]
                 # Process indel variants
-                process_indel_variants(db_name, variant_coll)
+                return process_indel_variants(db_name, variant_coll, context)
+
+        executor = ParallelDatabaseExecutor(max_workers=args.num_workers, timeout=args.db_timeout,
+                                            retries=args.retries, write_ops_per_second=args.write_ops_per_second)
+        executor.run([db_name for db_name in db_list if db_name not in ['admin', 'config', 'local']],
+                     process_database)
 
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@ import logging
 import os
 import shutil
 import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from ftplib import FTP
 
 import yaml
@@ -17,12 +19,17 @@ logger = log_cfg.get_logger(__name__)
 log_cfg.add_stdout_handler()
 log_cfg.set_log_level(logging.INFO)
 
+DEFAULT_FTP_HOST = 'ftp.ebi.ac.uk'
+
 
 def run_nextflow(working_dir, params, project_id, acc_file_db_name_csv):
     workflow_name = f"import_accession_{project_id}"
+    # Each import runs from its project directory so that concurrent imports do not share the Nextflow history, cache
+    # and log. Nextflow names the run itself as a fixed name can only be used once in the history.
+    project_dir = os.path.abspath(os.path.join(working_dir, project_id))
 
     # create nextflow work dir - remove if already exists
-    nextflow_work_dir = os.path.join(working_dir, project_id, workflow_name)
+    nextflow_work_dir = os.path.join(project_dir, workflow_name)
     if os.path.exists(nextflow_work_dir):
         shutil.rmtree(nextflow_work_dir)
     os.makedirs(nextflow_work_dir)
@@ -31,14 +38,14 @@ def run_nextflow(working_dir, params, project_id, acc_file_db_name_csv):
         command_utils.run_command_with_output(
             f'Nextflow {workflow_name} process',
             ' '.join((
+                'cd', project_dir, '&&',
                 'export NXF_OPTS="-Xms1g -Xmx8g"; ',
-                params['nextflow_path'], params['nextflow_script'],
-                '-name', workflow_name,
+                params['nextflow_path'], os.path.abspath(params['nextflow_script']),
                 '-work-dir', nextflow_work_dir,
-                '--java_app', params['java_app'],
-                '--acc_import_job_props', params['acc_import_job_props'],
-                '--acc_file_db_name_csv', acc_file_db_name_csv,
-                '--logs_dir', os.path.join(working_dir, project_id)
+                '--java_app', os.path.abspath(params['java_app']),
+                '--acc_import_job_props', os.path.abspath(params['acc_import_job_props']),
+                '--acc_file_db_name_csv', os.path.abspath(acc_file_db_name_csv),
+                '--logs_dir', project_dir
             ))
         )
     except subprocess.CalledProcessError as e:
@@ -67,9 +74,9 @@ def get_tax_asm_details(params, project_id, formatted_file_names):
 
 
 @retry(tries=3, delay=2, backoff=1.5, jitter=(1, 3))
-def get_accession_report_files_from_ftp(working_dir, project_id):
+def get_accession_report_files_from_ftp(working_dir, project_id, ftp_host=DEFAULT_FTP_HOST):
     try:
-        ftp = FTP('ftp.ebi.ac.uk', timeout=600)
+        ftp = FTP(ftp_host, timeout=600)
         ftp.login()
         ftp.cwd(f'pub/databases/eva/{project_id}')
         files_in_ftp = ftp.nlst()
@@ -98,8 +105,12 @@ def download_file_from_ftp(ftp, file, local_file_path):
         ftp.retrbinary(f"RETR {file}", local_file.write)
 
 
-def run_import_accession_job_for_project(working_dir, params, project_id):
-    logger.info(f"Starting processing project: {project_id}")
+def prepare_import_for_project(working_dir, params, project_id):
+    """
+    Find or download the accession reports of the project and resolve the variant warehouse database of each.
+    Return the path to the CSV listing the reports and their database, and the set of databases it imports into.
+    """
+    logger.info(f"Preparing project: {project_id}")
 
     project_path = os.path.join(params['project_dir'], project_id)
     if os.path.exists(project_path):
@@ -111,40 +122,143 @@ def run_import_accession_job_for_project(working_dir, params, project_id):
         logger.warning(f"Could not find the Project {project_id} in project_path {project_path}. "
                        f"Trying to retrieve accession report files from FTP")
         try:
-            accession_report_files = get_accession_report_files_from_ftp(working_dir, project_id)
+            accession_report_files = get_accession_report_files_from_ftp(
+                working_dir, project_id, params.get('ftp_host', DEFAULT_FTP_HOST))
         except Exception:
             raise Exception(f"Error fetching files from ftp for study {project_id}.")
 
     if not accession_report_files:
         raise Exception(f"No accession report files found for project {project_id} in CODON/FTP")
-    else:
-        logger.info(f"Accession report files: {accession_report_files}")
+    logger.info(f"Accession report files: {accession_report_files}")
 
-        formatted_name_file_dict = {
-            os.path.basename(file).replace('.accessioned.vcf', '.vcf'): file
-            for file in accession_report_files
-        }
+    formatted_name_file_dict = {
+        os.path.basename(file).replace('.accessioned.vcf', '.vcf'): file
+        for file in accession_report_files
+    }
 
-        file_asm_tax_list = get_tax_asm_details(params, project_id, formatted_name_file_dict.keys())
-        logger.info(f"acc report files and their corresponding asm accession and taxonomy_id : {file_asm_tax_list}")
+    file_asm_tax_list = get_tax_asm_details(params, project_id, formatted_name_file_dict.keys())
+    logger.info(f"acc report files and their corresponding asm accession and taxonomy_id : {file_asm_tax_list}")
 
-        if len(file_asm_tax_list) != len(accession_report_files):
-            missing_files = set(formatted_name_file_dict.keys()) - set([file_asm_tax_list[i][0] for i in range(len(file_asm_tax_list))])
-            raise Exception(
-                f"For project {project_id}, File mismatch between DB and Codon/FTP."
-                f"\nFiles missing: {[os.path.basename(formatted_name_file_dict[f]) for f in missing_files]}")
-        else:
-            os.makedirs(os.path.join(working_dir, project_id), exist_ok=True)
-            with get_metadata_connection_handle("production_processing", params['private_settings_xml_file']) as pg_conn:
-                acc_file_db_name_csv = os.path.join(working_dir, project_id, 'acc_file_db_name.csv')
-                with open(acc_file_db_name_csv, 'w', newline='') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(['acc_report_file', 'db_name'])
-                    for acc_file, asm, taxonomy in file_asm_tax_list:
-                        db_name = resolve_variant_warehouse_db_name(pg_conn, asm, taxonomy)
-                        writer.writerow([formatted_name_file_dict[acc_file], db_name])
+    if len(file_asm_tax_list) != len(accession_report_files):
+        missing_files = set(formatted_name_file_dict.keys()) - set([file_asm_tax_list[i][0] for i in range(len(file_asm_tax_list))])
+        raise Exception(
+            f"For project {project_id}, File mismatch between DB and Codon/FTP."
+            f"\nFiles missing: {[os.path.basename(formatted_name_file_dict[f]) for f in missing_files]}")
+
+    os.makedirs(os.path.join(working_dir, project_id), exist_ok=True)
+    db_names = set()
+    with get_metadata_connection_handle("production_processing", params['private_settings_xml_file']) as pg_conn:
+        acc_file_db_name_csv = os.path.join(working_dir, project_id, 'acc_file_db_name.csv')
+        with open(acc_file_db_name_csv, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['acc_report_file', 'db_name'])
+            for acc_file, asm, taxonomy in file_asm_tax_list:
+                db_name = resolve_variant_warehouse_db_name(pg_conn, asm, taxonomy)
+                writer.writerow([formatted_name_file_dict[acc_file], db_name])
+                db_names.add(db_name)
+    return acc_file_db_name_csv, db_names
+
+
+def run_import_accession_job_for_project(working_dir, params, project_id):
+    logger.info(f"Starting processing project: {project_id}")
+    acc_file_db_name_csv, _ = prepare_import_for_project(working_dir, params, project_id)
+    run_nextflow(working_dir, params, project_id, acc_file_db_name_csv)
+
+
+class ImportState:
+    """Projects already imported, recorded in a file so that a restart skips them"""
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.completed_projects = set()
+        if os.path.exists(state_file):
+            with open(state_file) as open_file:
+                self.completed_projects = set(line.strip() for line in open_file if line.strip())
+
+    def is_completed(self, project_id):
+        return project_id in self.completed_projects
+
+    def mark_completed(self, project_id):
+        with open(self.state_file, 'a') as open_file:
+            open_file.write(f'{project_id}\n')
+        self.completed_projects.add(project_id)
+
+
+class ImportScheduler:
+    """
+    Prepare the projects concurrently and start the import of each project as soon as it is prepared.
+    Imports into the same variant warehouse database run one at a time while imports into different databases run in
+    parallel, up to max_parallel_imports. Projects completed in a previous run are skipped.
+    """
+
+    def __init__(self, working_dir, params, state_file, num_prefetch_workers=4, max_parallel_imports=2):
+        self.working_dir = working_dir
+        self.params = params
+        self.state = ImportState(state_file)
+        self.num_prefetch_workers = num_prefetch_workers
+        self.max_parallel_imports = max_parallel_imports
+
+    def prepare(self, project_id):
+        return prepare_import_for_project(self.working_dir, self.params, project_id)
+
+    def run_import(self, project_id, acc_file_db_name_csv):
+        run_nextflow(self.working_dir, self.params, project_id, acc_file_db_name_csv)
+
+    def run(self, project_ids):
+        start_time = time.perf_counter()
+        projects_to_import = []
+        for project_id in project_ids:
+            if self.state.is_completed(project_id):
+                logger.info(f"Project {project_id} already imported: skipping")
+            elif project_id not in projects_to_import:
+                projects_to_import.append(project_id)
+
+        failed_projects = {}
+        # Prepared projects waiting for their databases to be free, in the order they were prepared
+        waiting_projects = []
+        busy_databases = set()
+        with ThreadPoolExecutor(max_workers=self.num_prefetch_workers) as prepare_executor, \
+                ThreadPoolExecutor(max_workers=self.max_parallel_imports) as import_executor:
+            running = {prepare_executor.submit(self.prepare, project_id): ('preparation', project_id, None)
+                       for project_id in projects_to_import}
+            num_imports_running = 0
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, project_id, db_names = running.pop(future)
+                    if step == 'import':
+                        num_imports_running -= 1
+                        busy_databases -= db_names
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"The {step} of project {project_id} failed: {e}")
+                        failed_projects[project_id] = e
+                        continue
+                    if step == 'preparation':
+                        acc_file_db_name_csv, db_names = result
+                        waiting_projects.append((project_id, acc_file_db_name_csv, db_names))
+                    else:
+                        logger.info(f"Import of project {project_id} into {sorted(db_names)} completed")
+                        self.state.mark_completed(project_id)
+
+                for waiting_project in list(waiting_projects):
+                    if num_imports_running >= self.max_parallel_imports:
+                        break
+                    project_id, acc_file_db_name_csv, db_names = waiting_project
+                    if busy_databases.isdisjoint(db_names):
+                        waiting_projects.remove(waiting_project)
+                        busy_databases |= db_names
+                        num_imports_running += 1
+                        logger.info(f"Starting import of project {project_id} into {sorted(db_names)}")
+                        future = import_executor.submit(self.run_import, project_id, acc_file_db_name_csv)
+                        running[future] = ('import', project_id, db_names)
 
-            run_nextflow(working_dir, params, project_id, acc_file_db_name_csv)
+        num_imported = len(projects_to_import) - len(failed_projects)
+        logger.info(f"{num_imported} projects imported, {len(project_ids) - len(projects_to_import)} skipped and "
+                    f"{len(failed_projects)} failed in {time.perf_counter() - start_time:.1f}s")
+        if failed_projects:
+            raise Exception(f"Import failed for projects: {', '.join(sorted(failed_projects))}")
 
 
 if __name__ == "__main__":
@@ -155,6 +269,13 @@ if __name__ == "__main__":
                         required=True)
     parser.add_argument("--project-list", help="List of projects space-separated e.g. PRJEB123 PRJEB456",
                         required=True, nargs='+')
+    parser.add_argument("--state-file", help="/path/to/file recording the projects already imported "
+                                             "(default: completed_projects.txt in the working directory)")
+    parser.add_argument("--num-prefetch-workers", type=int, default=4,
+                        help="Number of projects whose accession reports are fetched concurrently")
+    parser.add_argument("--max-parallel-imports", type=int, default=2,
+                        help="Maximum number of imports running at once. Imports into the same database are "
+                             "always run one at a time")
     args = parser.parse_args()
 
     os.makedirs(args.working_dir, exist_ok=True)
@@ -162,5 +283,7 @@ if __name__ == "__main__":
     with open(args.params_file, 'r') as file:
         params = yaml.safe_load(file)
 
-    for project_id in args.project_list:
-        run_import_accession_job_for_project(args.working_dir, params, project_id.strip())
+    state_file = args.state_file or os.path.join(args.working_dir, 'completed_projects.txt')
+    scheduler = ImportScheduler(args.working_dir, params, state_file, num_prefetch_workers=args.num_prefetch_workers,
+                                max_parallel_imports=args.max_parallel_imports)
+    scheduler.run([project_id.strip() for project_id in args.project_list])
@@ -0,0 +1,127 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from tasks.eva_2038.storeSSIDsInVariantWarehouse import ImportScheduler, run_nextflow
+
+# Databases each project imports into
+PROJECT_DATABASES = {
+    'PRJEB1': {'eva_hsapiens_grch38'},
+    'PRJEB2': {'eva_hsapiens_grch38'},
+    'PRJEB3': {'eva_btaurus_arsucd12'},
+    'PRJEB4': {'eva_btaurus_arsucd12', 'eva_hsapiens_grch38'},
+    'PRJEB5': {'eva_ggallus_grcg6a'},
+}
+
+
+class StubImportScheduler(ImportScheduler):
+    """Scheduler whose preparation and import only record when they ran"""
+
+    def __init__(self, *args, import_duration=0.2, failing_projects=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.import_duration = import_duration
+        self.failing_projects = failing_projects
+        self.lock = threading.Lock()
+        self.prepared_projects = []
+        self.imports = []
+
+    def prepare(self, project_id):
+        with self.lock:
+            self.prepared_projects.append(project_id)
+        return f'{project_id}.csv', PROJECT_DATABASES[project_id]
+
+    def run_import(self, project_id, acc_file_db_name_csv):
+        start_time = time.perf_counter()
+        time.sleep(self.import_duration)
+        with self.lock:
+            self.imports.append((project_id, start_time, time.perf_counter()))
+        if project_id in self.failing_projects:
+            raise Exception(f'Import of {project_id} failed')
+
+
+class TestImportScheduler(TestCase):
+
+    def setUp(self) -> None:
+        self.working_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.working_dir, 'completed_projects.txt')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.working_dir)
+
+    def get_scheduler(self, **kwargs):
+        return StubImportScheduler(self.working_dir, {}, self.state_file, **kwargs)
+
+    def read_state_file(self):
+        with open(self.state_file) as open_file:
+            return open_file.read().split()
+
+    def test_imports_into_same_database_never_overlap(self):
+        scheduler = self.get_scheduler(max_parallel_imports=4)
+        scheduler.run(list(PROJECT_DATABASES))
+        self.assertEqual(sorted(PROJECT_DATABASES), sorted(project_id for project_id, _, _ in scheduler.imports))
+        for project1, start1, end1 in scheduler.imports:
+            for project2, start2, end2 in scheduler.imports:
+                if project1 != project2 and PROJECT_DATABASES[project1] & PROJECT_DATABASES[project2]:
+                    self.assertTrue(end1 <= start2 or end2 <= start1, f'{project1} and {project2} overlap')
+
+    def test_imports_into_different_databases_overlap(self):
+        scheduler = self.get_scheduler(max_parallel_imports=3)
+        scheduler.run(['PRJEB1', 'PRJEB3', 'PRJEB5'])
+        start_times = [start for _, start, _ in scheduler.imports]
+        end_times = [end for _, _, end in scheduler.imports]
+        # All three imports were running at the same time at some point
+        self.assertLess(max(start_times), min(end_times))
+
+    def test_completed_projects_skipped(self):
+        with open(self.state_file, 'w') as open_file:
+            open_file.write('PRJEB1\nPRJEB3\n')
+        scheduler = self.get_scheduler()
+        scheduler.run(['PRJEB1', 'PRJEB2', 'PRJEB3'])
+        self.assertEqual(['PRJEB2'], scheduler.prepared_projects)
+        self.assertEqual(['PRJEB1', 'PRJEB3', 'PRJEB2'], self.read_state_file())
+
+        scheduler = self.get_scheduler()
+        scheduler.run(['PRJEB1', 'PRJEB2', 'PRJEB3'])
+        self.assertEqual([], scheduler.prepared_projects)
+
+    def test_failed_project_not_completed(self):
+        scheduler = self.get_scheduler(failing_projects=('PRJEB2',))
+        with self.assertRaises(Exception):
+            scheduler.run(['PRJEB1', 'PRJEB2', 'PRJEB3'])
+        self.assertEqual(['PRJEB1', 'PRJEB3'], sorted(self.read_state_file()))
+
+        # Only the failed project is imported again on restart
+        scheduler = self.get_scheduler()
+        scheduler.run(['PRJEB1', 'PRJEB2', 'PRJEB3'])
+        self.assertEqual(['PRJEB2'], scheduler.prepared_projects)
+        self.assertEqual(['PRJEB1', 'PRJEB2', 'PRJEB3'], sorted(self.read_state_file()))
+
+
+class TestRunNextflow(TestCase):
+
+    def setUp(self) -> None:
+        self.working_dir = tempfile.mkdtemp()
+        # Stub Nextflow recording the directory it runs from and its arguments
+        self.nextflow_path = os.path.join(self.working_dir, 'nextflow')
+        with open(self.nextflow_path, 'w') as open_file:
+            open_file.write('#!/bin/sh\npwd > nextflow_run.txt\necho "$@" >> nextflow_run.txt\n')
+        os.chmod(self.nextflow_path, os.stat(self.nextflow_path).st_mode | stat.S_IEXEC)
+        self.params = {'nextflow_path': self.nextflow_path, 'nextflow_script': 'import_accession.nf',
+                       'java_app': 'accession-import.jar', 'acc_import_job_props': 'import.properties'}
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.working_dir)
+
+    def test_each_project_runs_from_its_own_directory(self):
+        cwd = os.getcwd()
+        for project_id in ('PRJEB1', 'PRJEB2'):
+            run_nextflow(self.working_dir, self.params, project_id, 'acc_file_db_name.csv')
+            with open(os.path.join(self.working_dir, project_id, 'nextflow_run.txt')) as open_file:
+                run_dir, arguments = open_file.read().splitlines()
+            self.assertEqual(os.path.realpath(os.path.join(self.working_dir, project_id)), os.path.realpath(run_dir))
+            self.assertNotIn('-name', arguments.split())
+        self.assertEqual(cwd, os.getcwd())
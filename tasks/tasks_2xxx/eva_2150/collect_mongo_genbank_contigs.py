@@ -15,11 +15,13 @@
 from eva_2150 import init_logger
 from ebi_eva_common_pyutils.variation import contig_utils
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile, get_mongo_uri_for_eva_profile
-from ebi_eva_common_pyutils.pg_utils import execute_query, get_all_results_for_query
+from ebi_eva_common_pyutils.pg_utils import execute_query
 
 import click
+import io
 import psycopg2
 import psycopg2.extras
+import shelve
 import sys
 import traceback
 
@@ -27,20 +29,59 @@ from pymongo import MongoClient
 
 logger = init_logger()
 mongo_genbank_contigs_table_name = "eva_tasks.eva2150_mongo_genbank_contigs"
-
-
-def get_chromosome_name_from_asm_report(metadata_connection_handle, assembly_accession, contig_accession):
-    query = "select chromosome_name from eva_tasks.eva2150_asm_report_genbank_contigs " \
-            "where assembly_accession = '{0}' and contig_accession = '{1}'"\
-        .format(assembly_accession, contig_accession)
-    results = get_all_results_for_query(metadata_connection_handle, query)
-    if len(results) == 0:
-        return None
-    if len(results) > 1:
-        logger.error(
-            "More than one chromosome name found for assembly: {0} and contig: {1}".format(assembly_accession,
-                                                                                           contig_accession))
-    return results[0][0]
+insert_page_size = 10000
+
+
+def get_chromosome_names_from_asm_report(metadata_connection_handle, assembly_accession, contig_accessions):
+    """
+    Get the chromosome name of all the contigs in a single join between a temporary table holding the contigs and the
+    assembly report contigs rather than with one query per contig
+    """
+    contig_to_chromosome_name = {}
+    if not contig_accessions:
+        return contig_to_chromosome_name
+    with metadata_connection_handle.cursor() as cursor:
+        cursor.execute("create temporary table if not exists eva2150_contigs_to_resolve (contig_accession text) "
+                       "on commit drop")
+        cursor.execute("truncate eva2150_contigs_to_resolve")
+        cursor.copy_from(io.StringIO("".join(contig + "\n" for contig in contig_accessions)),
+                         "eva2150_contigs_to_resolve", columns=("contig_accession",))
+        cursor.execute("select distinct asm.contig_accession, asm.chromosome_name "
+                       "from eva2150_contigs_to_resolve contigs "
+                       "join eva_tasks.eva2150_asm_report_genbank_contigs asm "
+                       "on asm.contig_accession = contigs.contig_accession "
+                       "where asm.assembly_accession = %s", (assembly_accession,))
+        for contig_accession, chromosome_name in cursor.fetchall():
+            if contig_accession in contig_to_chromosome_name:
+                logger.error(
+                    "More than one chromosome name found for assembly: {0} and contig: {1}".format(assembly_accession,
+                                                                                                   contig_accession))
+                continue
+            contig_to_chromosome_name[contig_accession] = chromosome_name
+    return contig_to_chromosome_name
+
+
+class RemoteChromosomeNameCache:
+    """
+    Chromosome names resolved remotely for the contigs missing from the assembly reports, kept in a shelve file so that
+    each contig is only looked up once across collections, assemblies and runs
+    """
+
+    def __init__(self, cache_file):
+        self.cache = shelve.open(cache_file)
+
+    def get_chromosome_names(self, contig_accessions):
+        contig_to_chromosome_name = {}
+        for contig_accession in contig_accessions:
+            if contig_accession not in self.cache:
+                self.cache[contig_accession] = \
+                    contig_utils.get_chromosome_name_for_contig_accession(contig_accession)
+            contig_to_chromosome_name[contig_accession] = self.cache[contig_accession]
+        self.cache.sync()
+        return contig_to_chromosome_name
+
+    def close(self):
+        self.cache.close()
 
 
 def create_table_to_collect_mongo_genbank_contigs(private_config_xml_file):
@@ -65,11 +106,10 @@ def insert_contigs_to_db(metadata_connection_handle, contig_info_list):
                                            "(source, assembly_accession, study, contig_accession, chromosome_name, "
                                            "num_entries_in_db, is_contig_in_asm_report) "
                                            "VALUES %s".format(mongo_genbank_contigs_table_name), contig_info_list,
-                                           page_size=100)
+                                           page_size=insert_page_size)
 
 
-def insert_contig_info_to_db(collection, assembly_accession, metadata_connection_handle, mongo_connection_handle,
-                             assembly_attribute_prefix=""):
+def get_contig_counts(collection, assembly_accession, mongo_connection_handle, assembly_attribute_prefix=""):
     collection_handle = mongo_connection_handle["eva_accession_sharded"][collection]
     with collection_handle.aggregate([{'$match': {assembly_attribute_prefix + 'seq': assembly_accession}},
                                       {'$group': {'_id': {'study': '$' + assembly_attribute_prefix + 'study',
@@ -78,28 +118,36 @@ def insert_contig_info_to_db(collection, assembly_accession, metadata_connection
                                       {"$project": {"study": "$_id.study", "contig": "$_id.contig",
                                                     "count": 1, "_id": 0}}
                                       ], allowDiskUse=True) as cursor:
-        insert_chunk_size = 100
-        contig_info_list = []
         for result in cursor:
-            is_contig_in_asm_report = False
             study = result["study"][0] if assembly_attribute_prefix else result["study"]
             genbank_accession = result["contig"][0] if assembly_attribute_prefix else result["contig"]
-            count = result["count"]
-            chromosome_name = get_chromosome_name_from_asm_report(metadata_connection_handle,
-                                                                  assembly_accession, genbank_accession)
-            if chromosome_name is not None:
-                is_contig_in_asm_report = True
-            else:
-                chromosome_name = contig_utils.get_chromosome_name_for_contig_accession(genbank_accession)
-            contig_info_list.append((collection, assembly_accession, study, genbank_accession,
-                                     chromosome_name, count, is_contig_in_asm_report))
-            if len(contig_info_list) == insert_chunk_size:
-                insert_contigs_to_db(metadata_connection_handle, contig_info_list)
-                contig_info_list = []
-        insert_contigs_to_db(metadata_connection_handle, contig_info_list)
-
-
-def collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession):
+            yield study, genbank_accession, result["count"]
+
+
+def insert_contig_info_to_db(collection, assembly_accession, metadata_connection_handle, mongo_connection_handle,
+                             remote_chromosome_name_cache, assembly_attribute_prefix=""):
+    contig_counts = list(get_contig_counts(collection, assembly_accession, mongo_connection_handle,
+                                           assembly_attribute_prefix))
+    contig_accessions = set(genbank_accession for _, genbank_accession, _ in contig_counts)
+    contigs_in_asm_report = get_chromosome_names_from_asm_report(metadata_connection_handle, assembly_accession,
+                                                                 contig_accessions)
+    contigs_resolved_remotely = remote_chromosome_name_cache.get_chromosome_names(
+        sorted(contig_accessions - contigs_in_asm_report.keys()))
+    logger.info("{0}: {1} rows for {2} contigs, {3} found in the assembly report, {4} resolved remotely"
+                .format(collection, len(contig_counts), len(contig_accessions), len(contigs_in_asm_report),
+                        len(contigs_resolved_remotely)))
+
+    contig_info_list = []
+    for study, genbank_accession, count in contig_counts:
+        is_contig_in_asm_report = genbank_accession in contigs_in_asm_report
+        chromosome_name = contigs_in_asm_report[genbank_accession] if is_contig_in_asm_report \
+            else contigs_resolved_remotely[genbank_accession]
+        contig_info_list.append((collection, assembly_accession, study, genbank_accession,
+                                 chromosome_name, count, is_contig_in_asm_report))
+    insert_contigs_to_db(metadata_connection_handle, contig_info_list)
+
+
+def collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession, remote_chromosome_name_cache):
     try:
         with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
                               user="evadev") \
@@ -109,23 +157,32 @@ def collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession):
             main_collections = ["dbsnpSubmittedVariantEntity", "submittedVariantEntity"]
             for collection in main_collections:
                 insert_contig_info_to_db(collection, assembly_accession,
-                                         metadata_connection_handle, mongo_connection_handle)
+                                         metadata_connection_handle, mongo_connection_handle,
+                                         remote_chromosome_name_cache)
             ops_collections = ["dbsnpSubmittedVariantOperationEntity", "submittedVariantOperationEntity"]
             for collection in ops_collections:
                 insert_contig_info_to_db(collection, assembly_accession,
                                          metadata_connection_handle, mongo_connection_handle,
+                                         remote_chromosome_name_cache,
                                          assembly_attribute_prefix="inactiveObjects.")
     except Exception:
         logger.error(traceback.format_exc())
 
 
 @click.option("--private-config-xml-file", help="ex: /path/to/eva-maven-settings.xml", required=True)
+@click.option("--remote-lookup-cache", help="File caching the chromosome names resolved remotely",
+              default="eva2150_remote_chromosome_names", show_default=True)
 @click.command()
-def main(private_config_xml_file):
+def main(private_config_xml_file, remote_lookup_cache):
     create_table_to_collect_mongo_genbank_contigs(private_config_xml_file)
-    for assembly_accession in sys.stdin:
-        logger.info("Processing assembly: " + assembly_accession)
-        collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession.strip())
+    remote_chromosome_name_cache = RemoteChromosomeNameCache(remote_lookup_cache)
+    try:
+        for assembly_accession in sys.stdin:
+            logger.info("Processing assembly: " + assembly_accession)
+            collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession.strip(),
+                                          remote_chromosome_name_cache)
+    finally:
+        remote_chromosome_name_cache.close()
 
 
 if __name__ == "__main__":
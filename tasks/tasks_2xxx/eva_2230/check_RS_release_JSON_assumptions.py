@@ -1,7 +1,14 @@
 import bz2
 import click
 import json
+import math
+import shutil
+import subprocess
+import time
 import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 
 from ebi_eva_common_pyutils.config_utils import get_mongo_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
@@ -12,59 +19,61 @@ logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
 
-updated_rs_that_should_not_exist_in_EVA = []
-non_updated_rs_that_should_exist_in_EVA = []
-min_rs_records_to_check = 1000
+default_database_name = "eva_accession_human_sharded"
+collections_to_check = ["dbsnpClusteredVariantEntity", "dbsnpClusteredVariantOperationEntity"]
+# Tools able to decompress a bz2 file using several threads, in order of preference
+parallel_bz2_decompressors = ["lbzip2", "pbzip2"]
 
 
-def get_mongo_query_result(rs_to_find, mongo_connection_handle):
-    results = []
-    dbsnpCVEHandle = mongo_connection_handle["eva_accession_human_sharded"]["dbsnpClusteredVariantEntity"]
-    dbsnpCVOEHandle = mongo_connection_handle["eva_accession_human_sharded"]["dbsnpClusteredVariantOperationEntity"]
-    for result in dbsnpCVEHandle.find({"accession": {"$in": rs_to_find}}):
-        results.append(result)
-    for result in dbsnpCVOEHandle.find({"accession": {"$in": rs_to_find}}):
-        results.append(result)
-    return [result["accession"] for result in results]
+def get_decompression_command(release_json_file):
+    for decompressor in parallel_bz2_decompressors + ["bzip2"]:
+        if shutil.which(decompressor):
+            return [decompressor, "-d", "-c", release_json_file]
+    return None
 
 
-def ensure_existing_rs_in_eva_human_accession_db(mongo_connection_handle: MongoClient, eva_production_human_dbsnp_build,
-                                                 rs_id=None):
-    global non_updated_rs_that_should_exist_in_EVA, min_rs_records_to_check
+@contextmanager
+def open_release_json(release_json_file):
+    """
+    Provide the lines of the bz2 release JSON file. The file is decompressed by a separate process, which uses several
+    threads when lbzip2 or pbzip2 is installed, so decompression runs alongside the parsing.
+    """
+    command = get_decompression_command(release_json_file)
+    if command is None:
+        with bz2.open(release_json_file) as release_json_file_handle:
+            yield release_json_file_handle
+        return
+    logger.info("Decompressing {0} with {1}".format(release_json_file, command[0]))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=16 * 1024 * 1024)
+    try:
+        yield process.stdout
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.stdout.close()
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
-    num_rs_records_to_check = min_rs_records_to_check
-    if rs_id:
-        non_updated_rs_that_should_exist_in_EVA.append(rs_id)
-    else:
-        num_rs_records_to_check = len(non_updated_rs_that_should_exist_in_EVA)
-    if len(non_updated_rs_that_should_exist_in_EVA) == num_rs_records_to_check or \
-            (rs_id is None and num_rs_records_to_check > 0):
-        results = get_mongo_query_result(non_updated_rs_that_should_exist_in_EVA, mongo_connection_handle)
-        if len(results) < num_rs_records_to_check:
-            logger.error("Could not find RS IDs {0} in EVA production even though they were marked in JSON "
-                         "as released on or before dbSNP build {1} currently in EVA production!!"
-                         .format(set(non_updated_rs_that_should_exist_in_EVA) - set(results),
-                                 eva_production_human_dbsnp_build))
-        non_updated_rs_that_should_exist_in_EVA = []
-    
-
-def ensure_new_rs_not_in_eva_human_accession_db(mongo_connection_handle: MongoClient, eva_production_human_dbsnp_build,
-                                                    rs_id=None):
-    global updated_rs_that_should_not_exist_in_EVA, min_rs_records_to_check
-
-    num_rs_records_to_check = min_rs_records_to_check
-    if rs_id:
-        updated_rs_that_should_not_exist_in_EVA.append(rs_id)
-    else:
-        num_rs_records_to_check = len(updated_rs_that_should_not_exist_in_EVA)
-    if len(updated_rs_that_should_not_exist_in_EVA) == num_rs_records_to_check or \
-            (rs_id is None and num_rs_records_to_check > 0):
-        results = get_mongo_query_result(updated_rs_that_should_not_exist_in_EVA, mongo_connection_handle)
-        if len(results) > 0:
-            logger.error("Found RS IDs {0} in EVA production even though they were marked in JSON "
-                         "as released after dbSNP build {1} currently in EVA production!!"
-                         .format(results, eva_production_human_dbsnp_build))
-        updated_rs_that_should_not_exist_in_EVA = []
+
+def read_line_chunks(lines, lines_per_chunk):
+    """Yield the lines in lists of lines_per_chunk lines along with the (1-based) number of their first line"""
+    chunk = []
+    first_line_number = 1
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == lines_per_chunk:
+            yield first_line_number, chunk
+            first_line_number += len(chunk)
+            chunk = []
+    if chunk:
+        yield first_line_number, chunk
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, math.ceil(len(sorted_values) * percent / 100) - 1)]
 
 
 def is_rs_id_mapped_to_assembly(rs_record, eva_production_human_dbsnp_assembly):
@@ -82,45 +91,194 @@ def is_rs_id_mapped_to_assembly(rs_record, eva_production_human_dbsnp_assembly):
     return False
 
 
-def check_RS_release_JSON_assumptions(private_config_xml_file, release_json_file, eva_production_human_dbsnp_build,
-                                      eva_production_human_dbsnp_assembly):
-    with bz2.open(release_json_file) as release_json_file_handle, \
-            MongoClient(get_mongo_uri_for_eva_profile("production", private_config_xml_file)) \
-                    as mongo_connection_handle:
-        line_index = 0
-        for json_line in release_json_file_handle:
-            if line_index % 100000 == 0:
-                logger.info("Processed {0} records...".format(line_index))
-            line_index += 1
-            rs_record = json.loads(json_line.decode("utf-8").strip())
-            if not (is_rs_id_mapped_to_assembly(rs_record, eva_production_human_dbsnp_assembly)):
-                logger.error("RS ID {0} is not mapped to assembly {1}".format(rs_record["refsnp_id"],
-                                                                              eva_production_human_dbsnp_assembly))
+def check_rs_records(first_line_number, json_lines, eva_production_human_dbsnp_build,
+                     eva_production_human_dbsnp_assembly):
+    """
+    Parse a chunk of lines of the release JSON and check the assumptions that do not involve EVA production.
+    Return the RS IDs that should be in EVA production, the ones that should not be there and the errors found.
+    """
+    rs_that_should_exist_in_EVA = []
+    rs_that_should_not_exist_in_EVA = []
+    errors = []
+    for line_index, json_line in enumerate(json_lines, start=first_line_number):
+        rs_record = json.loads(json_line)
+        if not (is_rs_id_mapped_to_assembly(rs_record, eva_production_human_dbsnp_assembly)):
+            errors.append("RS ID {0} is not mapped to assembly {1}".format(rs_record["refsnp_id"],
+                                                                          eva_production_human_dbsnp_assembly))
+            continue
+        rs_id = int(rs_record["refsnp_id"])
+
+        if "support" in rs_record["primary_snapshot_data"]:
+            support_record_last_updated_builds = set()
+            for support_record in rs_record["present_obs_movements"]:
+                if "last_added_to_this_rs" in support_record:
+                    support_record_last_updated_builds.add(int(support_record["last_added_to_this_rs"]))
+            if not support_record_last_updated_builds:
+                errors.append("Support record not found for RS {0} at line {1}!!".format(rs_id, line_index))
                 continue
-            rs_id = int(rs_record["refsnp_id"])
-
-            if "support" in rs_record["primary_snapshot_data"]:
-                support_record_count = 0
-                support_record_last_updated_builds = set()
-                for support_record in rs_record["present_obs_movements"]:
-                    if "last_added_to_this_rs" in support_record:
-                        support_record_count += 1
-                        support_record_last_updated_builds.add(int(support_record["last_added_to_this_rs"]))
-                if support_record_count == 0:
-                    logger.error("Support record not found for RS {0} at line {1}!!".format(rs_id, line_index))
-                    continue
-                rs_last_updated_build = min(support_record_last_updated_builds)
-                # Ensure newly added RS are not in production
-                if rs_last_updated_build > eva_production_human_dbsnp_build:
-                    ensure_new_rs_not_in_eva_human_accession_db(mongo_connection_handle,
-                                                                    eva_production_human_dbsnp_build, rs_id)
-                # Ensure RS in previous builds are present in production
-                if rs_last_updated_build <= eva_production_human_dbsnp_build:
-                    ensure_existing_rs_in_eva_human_accession_db(mongo_connection_handle, eva_production_human_dbsnp_build,
-                                                                 rs_id)
-        
-        ensure_new_rs_not_in_eva_human_accession_db(mongo_connection_handle, eva_production_human_dbsnp_build)
-        ensure_existing_rs_in_eva_human_accession_db(mongo_connection_handle, eva_production_human_dbsnp_build)
+            rs_last_updated_build = min(support_record_last_updated_builds)
+            # Ensure newly added RS are not in production
+            if rs_last_updated_build > eva_production_human_dbsnp_build:
+                rs_that_should_not_exist_in_EVA.append(rs_id)
+            # Ensure RS in previous builds are present in production
+            else:
+                rs_that_should_exist_in_EVA.append(rs_id)
+    return rs_that_should_exist_in_EVA, rs_that_should_not_exist_in_EVA, errors
+
+
+class RSPresenceChecker:
+    """
+    Check, in batches of batch_size RS IDs looked up with $in, that RS IDs are present in or absent from the dbSNP
+    clustered variant collections of EVA production. Lookups run in background threads with at most
+    max_pending_batches batches waiting or running so that the caller rarely waits for them.
+    """
+
+    def __init__(self, mongo_connection_handle: MongoClient, eva_production_human_dbsnp_build, batch_size=1000,
+                 num_threads=4, max_pending_batches=16, database_name=default_database_name):
+        self.collections = [mongo_connection_handle[database_name][collection_name]
+                            for collection_name in collections_to_check]
+        self.eva_production_human_dbsnp_build = eva_production_human_dbsnp_build
+        self.batch_size = batch_size
+        self.max_pending_batches = max_pending_batches
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.pending_batches = deque()
+        self.rs_that_should_exist_in_EVA = []
+        self.rs_that_should_not_exist_in_EVA = []
+        self.latencies = []
+        self.num_rs_checked = 0
+        self.num_rs_missing = 0
+        self.num_rs_unexpected = 0
+
+    def get_accessions_in_eva(self, rs_ids):
+        start_time = time.perf_counter()
+        accessions = set()
+        for collection in self.collections:
+            accessions.update(result["accession"] for result in
+                              collection.find({"accession": {"$in": rs_ids}}, {"accession": 1, "_id": 0}))
+        self.latencies.append(time.perf_counter() - start_time)
+        return accessions
+
+    def _ensure_existing_rs_in_eva(self, rs_ids):
+        missing_rs_ids = set(rs_ids) - self.get_accessions_in_eva(rs_ids)
+        if missing_rs_ids:
+            logger.error("Could not find RS IDs {0} in EVA production even though they were marked in JSON "
+                         "as released on or before dbSNP build {1} currently in EVA production!!"
+                         .format(missing_rs_ids, self.eva_production_human_dbsnp_build))
+        return len(missing_rs_ids), 0
+
+    def _ensure_new_rs_not_in_eva(self, rs_ids):
+        unexpected_rs_ids = self.get_accessions_in_eva(rs_ids)
+        if unexpected_rs_ids:
+            logger.error("Found RS IDs {0} in EVA production even though they were marked in JSON "
+                         "as released after dbSNP build {1} currently in EVA production!!"
+                         .format(sorted(unexpected_rs_ids), self.eva_production_human_dbsnp_build))
+        return 0, len(unexpected_rs_ids)
+
+    def _wait_for_oldest_batch(self):
+        num_rs_missing, num_rs_unexpected = self.pending_batches.popleft().result()
+        self.num_rs_missing += num_rs_missing
+        self.num_rs_unexpected += num_rs_unexpected
+
+    def _submit(self, check, rs_ids):
+        while len(self.pending_batches) >= self.max_pending_batches:
+            self._wait_for_oldest_batch()
+        self.pending_batches.append(self.executor.submit(check, rs_ids))
+        self.num_rs_checked += len(rs_ids)
+
+    def add_rs_that_should_exist(self, rs_ids):
+        self.rs_that_should_exist_in_EVA.extend(rs_ids)
+        while len(self.rs_that_should_exist_in_EVA) >= self.batch_size:
+            self._submit(self._ensure_existing_rs_in_eva, self.rs_that_should_exist_in_EVA[:self.batch_size])
+            self.rs_that_should_exist_in_EVA = self.rs_that_should_exist_in_EVA[self.batch_size:]
+
+    def add_rs_that_should_not_exist(self, rs_ids):
+        self.rs_that_should_not_exist_in_EVA.extend(rs_ids)
+        while len(self.rs_that_should_not_exist_in_EVA) >= self.batch_size:
+            self._submit(self._ensure_new_rs_not_in_eva, self.rs_that_should_not_exist_in_EVA[:self.batch_size])
+            self.rs_that_should_not_exist_in_EVA = self.rs_that_should_not_exist_in_EVA[self.batch_size:]
+
+    def flush(self):
+        """Check the RS IDs left in the buffers and wait for all the lookups to complete"""
+        if self.rs_that_should_exist_in_EVA:
+            self._submit(self._ensure_existing_rs_in_eva, self.rs_that_should_exist_in_EVA)
+            self.rs_that_should_exist_in_EVA = []
+        if self.rs_that_should_not_exist_in_EVA:
+            self._submit(self._ensure_new_rs_not_in_eva, self.rs_that_should_not_exist_in_EVA)
+            self.rs_that_should_not_exist_in_EVA = []
+        while self.pending_batches:
+            self._wait_for_oldest_batch()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        logger.info("Checked {0} RS IDs in EVA production with {1} lookups, latency p50: {2:.3f}s, p99: {3:.3f}s. "
+                    "{4} RS IDs missing, {5} RS IDs that should not be there"
+                    .format(self.num_rs_checked, len(latencies), percentile(latencies, 50),
+                            percentile(latencies, 99), self.num_rs_missing, self.num_rs_unexpected))
+
+
+class ReleaseJSONChecker:
+    """
+    Check the release JSON in a pipeline: the file is decompressed by a separate process, chunks of lines are parsed
+    and checked by num_processes processes and the RS IDs they return are looked up in EVA production by the
+    RSPresenceChecker while the next chunks are parsed.
+    """
+
+    def __init__(self, rs_presence_checker: RSPresenceChecker, eva_production_human_dbsnp_build,
+                 eva_production_human_dbsnp_assembly, num_processes=1, lines_per_chunk=2000):
+        self.rs_presence_checker = rs_presence_checker
+        self.eva_production_human_dbsnp_build = eva_production_human_dbsnp_build
+        self.eva_production_human_dbsnp_assembly = eva_production_human_dbsnp_assembly
+        self.num_processes = num_processes
+        self.lines_per_chunk = lines_per_chunk
+        self.num_lines = 0
+
+    def _process_chunk_result(self, chunk_future):
+        rs_that_should_exist_in_EVA, rs_that_should_not_exist_in_EVA, errors = chunk_future.result()
+        for error in errors:
+            logger.error(error)
+        self.rs_presence_checker.add_rs_that_should_not_exist(rs_that_should_not_exist_in_EVA)
+        self.rs_presence_checker.add_rs_that_should_exist(rs_that_should_exist_in_EVA)
+
+    def check(self, release_json_file):
+        start_time = time.perf_counter()
+        with open_release_json(release_json_file) as release_json_lines, \
+                ProcessPoolExecutor(max_workers=self.num_processes) as executor:
+            pending_chunks = deque()
+            for first_line_number, json_lines in read_line_chunks(release_json_lines, self.lines_per_chunk):
+                if (first_line_number - 1) // 100000 != (first_line_number - 1 + len(json_lines)) // 100000:
+                    logger.info("Processed {0} records...".format(first_line_number - 1))
+                pending_chunks.append(executor.submit(check_rs_records, first_line_number, json_lines,
+                                                      self.eva_production_human_dbsnp_build,
+                                                      self.eva_production_human_dbsnp_assembly))
+                self.num_lines += len(json_lines)
+                # Keep a few chunks ahead for each process without reading the whole file in memory
+                while len(pending_chunks) > self.num_processes * 2:
+                    self._process_chunk_result(pending_chunks.popleft())
+            while pending_chunks:
+                self._process_chunk_result(pending_chunks.popleft())
+        self.rs_presence_checker.flush()
+        duration = max(time.perf_counter() - start_time, 1e-9)
+        logger.info("Processed {0} records in {1:.1f}s ({2:.0f} lines/s)"
+                    .format(self.num_lines, duration, self.num_lines / duration))
+        self.rs_presence_checker.report()
+
+
+def check_RS_release_JSON_assumptions(private_config_xml_file, release_json_file, eva_production_human_dbsnp_build,
+                                      eva_production_human_dbsnp_assembly, num_processes=1, num_query_threads=4,
+                                      batch_size=1000):
+    with MongoClient(get_mongo_uri_for_eva_profile("production", private_config_xml_file)) \
+            as mongo_connection_handle:
+        rs_presence_checker = RSPresenceChecker(mongo_connection_handle, eva_production_human_dbsnp_build,
+                                                batch_size=batch_size, num_threads=num_query_threads)
+        try:
+            ReleaseJSONChecker(rs_presence_checker, eva_production_human_dbsnp_build,
+                               eva_production_human_dbsnp_assembly, num_processes=num_processes)\
+                .check(release_json_file)
+        finally:
+            rs_presence_checker.close()
 
 
 @click.option("--private-config-xml-file", help="ex: /path/to/eva-maven-settings.xml", required=True)
@@ -129,11 +287,15 @@ def check_RS_release_JSON_assumptions(private_config_xml_file, release_json_file
               help="Most recent dbSNP human release build in EVA production (ex: 152)", type=int, required=True)
 @click.option("--eva-production-human-dbsnp-assembly",
               help="Most recent dbSNP human assembly in EVA production (ex: GCF_000001405.38)", required=True)
+@click.option("--num-processes", help="Number of processes parsing the release JSON", type=int, default=1)
+@click.option("--num-query-threads", help="Number of concurrent lookups in EVA production", type=int, default=4)
+@click.option("--batch-size", help="Number of RS IDs looked up in each query", type=int, default=1000)
 @click.command()
 def main(private_config_xml_file, release_json_file, eva_production_human_dbsnp_build,
-         eva_production_human_dbsnp_assembly):
+         eva_production_human_dbsnp_assembly, num_processes, num_query_threads, batch_size):
     check_RS_release_JSON_assumptions(private_config_xml_file, release_json_file, eva_production_human_dbsnp_build,
-                                      eva_production_human_dbsnp_assembly)
+                                      eva_production_human_dbsnp_assembly, num_processes=num_processes,
+                                      num_query_threads=num_query_threads, batch_size=batch_size)
 
 
 if __name__ == "__main__":
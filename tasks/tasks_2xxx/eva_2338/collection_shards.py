@@ -0,0 +1,91 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import re
+
+from bson import ObjectId, json_util
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+# Queries on _id ranges only match values of the same type so documents with an _id of another type are
+# dumped in a separate shard
+id_type_aliases = {str: "string", ObjectId: "objectId", int: "number", float: "number"}
+# Number of _id sampled for each shard to find the boundaries of the ranges
+samples_per_shard = 100
+
+
+def get_safe_name(collection_name):
+    """Name usable in file and Nextflow process names"""
+    return re.sub(r'[^0-9a-zA-Z_]', '_', collection_name)
+
+
+class CollectionShard:
+    def __init__(self, db_name, collection_name, shard_index, query=None):
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.shard_index = shard_index
+        self.query = query
+
+    @property
+    def name(self):
+        return f"{get_safe_name(self.collection_name)}_{self.shard_index}"
+
+    def query_file(self, top_level_dump_dir):
+        return os.path.join(top_level_dump_dir, self.db_name, "shard_queries", f"{self.name}.json") \
+            if self.query else None
+
+    def write_query_file(self, top_level_dump_dir):
+        if self.query:
+            os.makedirs(os.path.dirname(self.query_file(top_level_dump_dir)), exist_ok=True)
+            with open(self.query_file(top_level_dump_dir), "w") as query_file_handle:
+                query_file_handle.write(json_util.dumps(self.query))
+
+
+def get_id_range_queries(sampled_ids, num_shards):
+    """Split the sorted sample of _id in num_shards ranges and return the queries selecting each range"""
+    id_types = set(id_type_aliases.get(type(_id)) for _id in sampled_ids)
+    if len(id_types) != 1 or None in id_types:
+        return []
+    sampled_ids = sorted(sampled_ids)
+    boundaries = sorted(set(sampled_ids[len(sampled_ids) * shard // num_shards] for shard in range(1, num_shards)))
+    if not boundaries:
+        return []
+    queries = [{"_id": {"$lt": boundaries[0]}}]
+    for lower, upper in zip(boundaries, boundaries[1:]):
+        queries.append({"_id": {"$gte": lower, "$lt": upper}})
+    queries.append({"_id": {"$gte": boundaries[-1]}})
+    queries.append({"_id": {"$not": {"$type": id_types.pop()}}})
+    return queries
+
+
+def get_collection_shards(mongo_source: MongoDatabase, collection_name, shard_size_in_mb):
+    """Split a collection larger than shard_size_in_mb into _id ranges that can be dumped and restored in parallel"""
+    database = mongo_source.mongo_handle[mongo_source.db_name]
+    collection_size = database.command("collStats", collection_name).get("size", 0)
+    num_shards = math.ceil(collection_size / (shard_size_in_mb * 1024 * 1024)) if shard_size_in_mb else 1
+    queries = []
+    if num_shards > 1:
+        sampled_ids = [document["_id"] for document in database[collection_name].aggregate(
+            [{"$sample": {"size": num_shards * samples_per_shard}}, {"$project": {"_id": 1}}])]
+        queries = get_id_range_queries(sampled_ids, num_shards)
+    if not queries:
+        return [CollectionShard(mongo_source.db_name, collection_name, 0)]
+    logger.info(f"Collection {collection_name} of {collection_size / 1024 / 1024:.0f} MB "
+                f"split in {len(queries)} shards")
+    return [CollectionShard(mongo_source.db_name, collection_name, shard_index, query)
+            for shard_index, query in enumerate(queries)]
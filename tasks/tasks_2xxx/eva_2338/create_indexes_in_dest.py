@@ -21,10 +21,17 @@ logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
 
-def create_indexes(mongo_source: MongoDatabase, mongo_dest: MongoDatabase):
-    logger.info(f"Creating indexes in the target database {mongo_dest.uri_with_db_name}....")
+def create_indexes(mongo_source: MongoDatabase, mongo_dest: MongoDatabase, collection_name=None):
+    logger.info(f"Creating indexes in the target database {mongo_dest.uri_with_db_name}"
+                + (f" for collection {collection_name}...." if collection_name else "...."))
     try:
-        mongo_dest.create_index_on_collections(mongo_source.get_indexes())
+        if collection_name:
+            collection_index_map = {
+                collection_name: mongo_source.mongo_handle[mongo_source.db_name][collection_name].index_information()
+            }
+        else:
+            collection_index_map = mongo_source.get_indexes()
+        mongo_dest.create_index_on_collections(collection_index_map)
     except Exception as ex:
         logger.error(f"Error while creating indexes!\n{ex.__str__()}")
         sys.exit(1)
@@ -45,12 +52,15 @@ def main():
                         help="Full path to the Mongo Source secrets file (ex: /path/to/mongo/source/secret)",
                         required=True)
     parser.add_argument("--db-name", help="Database to migrate (ex: eva_hsapiens_grch37)", required=True)
+    parser.add_argument("--collection", help="Only create the indexes of this collection (ex: variants_2_0)",
+                        required=False)
     parser.add_argument('--help', action='help', help='Show this help message and exit')
 
     args = parser.parse_args()
     create_indexes(
         MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file, db_name=args.db_name),
-        MongoDatabase(uri=args.mongo_dest_uri, secrets_file=args.mongo_dest_secrets_file, db_name=args.db_name))
+        MongoDatabase(uri=args.mongo_dest_uri, secrets_file=args.mongo_dest_secrets_file, db_name=args.db_name),
+        collection_name=args.collection)
 
 
 if __name__ == "__main__":
@@ -15,9 +15,14 @@
 import argparse
 import os
 import sys
+import time
+
+from bson import json_util
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
 from ebi_eva_common_pyutils.logger import logging_config
 
+from eva_2338.throughput_report import record_throughput
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
@@ -35,6 +40,39 @@ def dump_data_from_source(mongo_source: MongoDatabase, top_level_dump_dir):
         sys.exit(1)
 
 
+def get_shard_dump_dir(top_level_dump_dir, db_name, shard_name):
+    return os.path.join(top_level_dump_dir, db_name, "shards", shard_name)
+
+
+def dump_collection_shard_from_source(mongo_source: MongoDatabase, top_level_dump_dir, collection_name, shard_name,
+                                      query_file=None):
+    try:
+        logger.info(f"Running mongodump of {collection_name} shard {shard_name} from source...")
+        shard_dump_dir = get_shard_dump_dir(top_level_dump_dir, mongo_source.db_name, shard_name)
+        mongodump_args = {"collection": collection_name}
+        if query_file:
+            # The _id range query is resolved with the _id index rather than a table scan
+            mongodump_args["queryFile"] = query_file
+            with open(query_file) as query_file_handle:
+                query = json_util.loads(query_file_handle.read())
+        else:
+            mongodump_args["forceTableScan"] = ""
+            query = None
+        start_time = time.time()
+        mongo_source.dump_data(dump_dir=shard_dump_dir, mongodump_args=mongodump_args)
+        end_time = time.time()
+
+        collection = mongo_source.mongo_handle[mongo_source.db_name][collection_name]
+        num_documents = collection.count_documents(query) if query else collection.estimated_document_count()
+        bson_file = os.path.join(shard_dump_dir, mongo_source.db_name, f"{collection_name}.bson")
+        num_bytes = os.path.getsize(bson_file) if os.path.exists(bson_file) else 0
+        record_throughput(top_level_dump_dir, mongo_source.db_name, "dump_data_from_source", collection_name,
+                          shard_name, num_documents, num_bytes, start_time, end_time)
+    except Exception as ex:
+        logger.error(f"Error while dumping {collection_name} shard {shard_name} from source!\n{ex.__str__()}")
+        sys.exit(1)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Dump data from a given MongoDB source',
                                      formatter_class=argparse.RawTextHelpFormatter, add_help=False)
@@ -46,11 +84,22 @@ def main():
     parser.add_argument("--db-name", help="Database to migrate (ex: eva_hsapiens_grch37)", required=True)
     parser.add_argument("--dump-dir", help="Top-level directory where all dumps reside (ex: /path/to/dumps)",
                         required=True)
+    parser.add_argument("--collection", help="Only dump this collection (ex: variants_2_0)", required=False)
+    parser.add_argument("--shard-name", help="Name of the collection shard to dump (ex: variants_2_0_3)",
+                        required=False)
+    parser.add_argument("--query-file", help="File with the query selecting the documents in the collection shard",
+                        required=False)
     parser.add_argument('--help', action='help', help='Show this help message and exit')
 
     args = parser.parse_args()
-    dump_data_from_source(MongoDatabase(uri=args.mongo_source_uri, secrets_file= args.mongo_source_secrets_file,
-                                        db_name=args.db_name), top_level_dump_dir=args.dump_dir)
+    mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
+                                 db_name=args.db_name)
+    if args.collection:
+        dump_collection_shard_from_source(mongo_source, top_level_dump_dir=args.dump_dir,
+                                          collection_name=args.collection,
+                                          shard_name=args.shard_name or args.collection, query_file=args.query_file)
+    else:
+        dump_data_from_source(mongo_source, top_level_dump_dir=args.dump_dir)
 
 
 if __name__ == "__main__":
@@ -13,64 +13,158 @@
 # limitations under the License.
 
 import argparse
-import collections
 import os
+import networkx as nx
 import yaml
 
 from ebi_eva_common_pyutils.logger import logging_config
-from ebi_eva_common_pyutils.nextflow import LinearNextFlowPipeline
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
+from ebi_eva_common_pyutils.nextflow import NextFlowPipeline, NextFlowProcess
+
+from tasks.eva_2338.collection_shards import get_collection_shards, get_safe_name
 
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
 
+class FanOutNextFlowPipeline(NextFlowPipeline):
+    """
+    Pipeline where a process can be a dependency of several processes.
+    A Nextflow channel can only be consumed by one process so the success flag of a process is sent to a separate
+    channel for each of the processes depending on it.
+    """
+
+    @staticmethod
+    def _get_flag_channel(process: NextFlowProcess, dependent_process: NextFlowProcess):
+        return f"{process.success_flag}_{dependent_process.process_name}"
+
+    def _get_fan_out_process_repr(self, process: NextFlowProcess) -> str:
+        dependencies = list(self.process_dependency_map.successors(process))
+        dependent_processes = list(self.process_dependency_map.predecessors(process))
+        process_directives_str = "\n".join([f"{key}='{value}'" for key, value in process.process_directives.items()])
+        input_dependencies = "val flag from true"
+        if dependencies:
+            input_dependencies = "\n".join([f"val {dependency.success_flag} from "
+                                            f"{self._get_flag_channel(dependency, process)}"
+                                            for dependency in dependencies])
+        output_channels = ", ".join([self._get_flag_channel(process, dependent_process)
+                                     for dependent_process in dependent_processes]) or process.success_flag
+        return "\n".join(map(str.strip, f"""
+                    process {process.process_name} {{
+                    {process_directives_str}
+                    input:
+                    {input_dependencies}
+                    output:
+                    val true into {output_channels}
+                    script:
+                    \"\"\"
+                    {process.command_to_run}
+                    \"\"\"
+                    }}""".split("\n")))
+
+    def __str__(self):
+        ordered_list_of_processes_to_run = list(nx.dfs_postorder_nodes(self.process_dependency_map))
+        return "\n\n".join([self._get_fan_out_process_repr(process) for process in ordered_list_of_processes_to_run])
+
+
 class MoveMongoDBs:
+    """
+    Move databases with a Nextflow pipeline where, for each database:
+        * the destination database is prepared while every collection shard is dumped from the source
+        * each shard is restored as soon as it is dumped and the destination is prepared
+        * the indexes of a collection are created as soon as all its shards are restored
+        * the dump and restore throughput is reported once all the indexes are created
+    At most max-parallel-dbs databases are moved at the same time: databases are spread across that many lanes and
+    a database only starts when the previous database of its lane is done.
+    """
     def __init__(self, migration_config_file, dbs_to_migrate_list, batch_number, resume_flag):
         self.migration_config = yaml.load(open(migration_config_file), Loader=yaml.FullLoader)
         self.dbs_to_migrate = [x.strip() for x in open(dbs_to_migrate_list).readlines() if x.strip() != '']
         self.batch_number = batch_number
         self.resume_flag = resume_flag
-        # Processes, in order, that make up the workflow and the arguments that they take
-        self.workflow_process_arguments_map = collections.OrderedDict(
-            [("dump_data_from_source", ["mongo-source-uri", "mongo-source-secrets-file", "db-name", "dump-dir"]),
-             ("prepare_dest_db", ["mongo-source-uri", "mongo-source-secrets-file",
-                                  "mongo-dest-uri", "mongo-dest-secrets-file", "db-name"]),
-             ("restore_data_to_dest", ["mongo-dest-uri", "mongo-dest-secrets-file", "db-name", "dump-dir"]),
-             ("create_indexes_in_dest", ["mongo-source-uri", "mongo-source-secrets-file", "mongo-dest-uri",
-                                         "mongo-dest-secrets-file", "db-name"])
-             ])
+        self.max_parallel_dbs = int(self.migration_config.get("max-parallel-dbs", 1))
+        # Collections larger than this are split in _id ranges dumped and restored in parallel
+        self.shard_size_in_mb = int(self.migration_config.get("collection-shard-size-mb", 2048))
+        # Processes that make up the workflow and the arguments that they take
+        self.workflow_process_arguments_map = {
+            "dump_data_from_source": ["mongo-source-uri", "mongo-source-secrets-file", "db-name", "dump-dir",
+                                      "collection", "shard-name", "query-file"],
+            "prepare_dest_db": ["mongo-source-uri", "mongo-source-secrets-file",
+                                "mongo-dest-uri", "mongo-dest-secrets-file", "db-name"],
+            "restore_data_to_dest": ["mongo-dest-uri", "mongo-dest-secrets-file", "db-name", "dump-dir",
+                                     "collection", "shard-name"],
+            "create_indexes_in_dest": ["mongo-source-uri", "mongo-source-secrets-file", "mongo-dest-uri",
+                                       "mongo-dest-secrets-file", "db-name", "collection"],
+            "throughput_report": ["db-name", "dump-dir"]
+        }
         self.workflow_run_dir = os.path.join(self.migration_config["migration-folder"], f"batch{batch_number}")
         self.workflow_file_path = os.path.join(self.workflow_run_dir, f"batch{batch_number}_migration_workflow.nf")
         self.log_file_name = os.path.join(self.workflow_run_dir, f"batch{batch_number}_workflow_execution.log")
         os.makedirs(self.workflow_run_dir, exist_ok=True)
 
-        self.db_move_pipeline = LinearNextFlowPipeline(workflow_file_path=self.workflow_file_path
-                                                  , nextflow_binary_path=self.migration_config["nextflow-binary-path"]
-                                                  , nextflow_config_path=self.migration_config["nextflow-config-path"]
-                                                  , working_dir=self.workflow_run_dir)
+        self.db_move_pipeline = FanOutNextFlowPipeline()
+
+    def _get_process(self, workflow_process_name, process_name, process_config):
+        process_with_args = "{0} {1}".format(workflow_process_name,
+                                             " ".join(["--{0} {1}".format(
+                                                 arg,
+                                                 self.migration_config.get(arg, process_config.get(arg)))
+                                                 for arg in self.workflow_process_arguments_map[workflow_process_name]
+                                                 if self.migration_config.get(arg, process_config.get(arg))]))
+        command_to_run = f"export PYTHONPATH={self.migration_config['script-path']} &&  " \
+                         f"({self.migration_config['python3-path']} " \
+                         f"-m eva_2338.{process_with_args} " \
+                         f"1>> {self.log_file_name} 2>&1)"
+        return NextFlowProcess(process_name=process_name, command_to_run=command_to_run)
+
+    def add_db_processes_to_pipeline(self, db_name, previous_db_in_lane=None):
+        """Add the processes moving one database and return the process that completes it"""
+        process_config = {"dump-dir": self.workflow_run_dir, "db-name": db_name}
+        start_dependencies = [previous_db_in_lane] if previous_db_in_lane else []
+        prepare_process = self._get_process("prepare_dest_db", f"prepare_dest_db_{db_name}", process_config)
+        self.db_move_pipeline.add_dependencies({prepare_process: start_dependencies})
+
+        mongo_source = MongoDatabase(uri=self.migration_config["mongo-source-uri"],
+                                     secrets_file=self.migration_config["mongo-source-secrets-file"], db_name=db_name)
+        index_processes = []
+        for collection_name in sorted(mongo_source.get_collection_names()):
+            restore_processes = []
+            for shard in get_collection_shards(mongo_source, collection_name, self.shard_size_in_mb):
+                shard.write_query_file(self.workflow_run_dir)
+                shard_config = dict(process_config, **{"collection": collection_name, "shard-name": shard.name,
+                                                       "query-file": shard.query_file(self.workflow_run_dir)})
+                dump_process = self._get_process("dump_data_from_source",
+                                                 f"dump_data_from_source_{db_name}_{shard.name}", shard_config)
+                restore_process = self._get_process("restore_data_to_dest",
+                                                    f"restore_data_to_dest_{db_name}_{shard.name}", shard_config)
+                self.db_move_pipeline.add_dependencies({dump_process: start_dependencies,
+                                                        restore_process: [dump_process, prepare_process]})
+                restore_processes.append(restore_process)
+            index_process = self._get_process("create_indexes_in_dest",
+                                              f"create_indexes_in_dest_{db_name}_{get_safe_name(collection_name)}",
+                                              dict(process_config, collection=collection_name))
+            self.db_move_pipeline.add_dependencies({index_process: restore_processes})
+            index_processes.append(index_process)
+
+        report_process = self._get_process("throughput_report", f"throughput_report_{db_name}", process_config)
+        self.db_move_pipeline.add_dependencies({report_process: index_processes or [prepare_process]})
+        return report_process
 
     def add_processes_to_pipeline(self):
-        for db_name in self.dbs_to_migrate:
-            for workflow_process_name, workflow_process_args in self.workflow_process_arguments_map.items():
-                process_config = {"dump-dir": self.workflow_run_dir, "db-name": db_name}
-                process_with_args = "{0} {1}".format(workflow_process_name,
-                                                     " ".join(["--{0} {1}".format(
-                                                         arg,
-                                                         self.migration_config.get(arg,
-                                                                                   process_config.get(arg, '')))
-                                                         for arg in workflow_process_args]))
-                command_to_run = f"export PYTHONPATH={self.migration_config['script-path']} &&  " \
-                                 f"({self.migration_config['python3-path']} " \
-                                 f"-m eva_2338.{process_with_args} " \
-                                 f"1>> {self.log_file_name} 2>&1)"
-                self.db_move_pipeline.add_process(process_name=f"{workflow_process_name}_{db_name}",
-                                                  command_to_run=command_to_run)
+        last_process_per_lane = [None] * self.max_parallel_dbs
+        for db_index, db_name in enumerate(self.dbs_to_migrate):
+            lane = db_index % self.max_parallel_dbs
+            last_process_per_lane[lane] = self.add_db_processes_to_pipeline(db_name, last_process_per_lane[lane])
 
     def move(self):
         self.add_processes_to_pipeline()
         # Running without backgrounding can sometimes cause the Nextflow process to stop
         # See https://github.com/nextflow-io/nextflow/issues/937#issuecomment-630806451
-        self.db_move_pipeline.run_pipeline(resume=self.resume_flag, other_args={"bg": ""})
+        self.db_move_pipeline.run_pipeline(workflow_file_path=self.workflow_file_path,
+                                           nextflow_binary_path=self.migration_config["nextflow-binary-path"],
+                                           nextflow_config_path=self.migration_config["nextflow-config-path"],
+                                           working_dir=self.workflow_run_dir, resume=self.resume_flag,
+                                           other_args={"bg": ""})
 
 
 def main():
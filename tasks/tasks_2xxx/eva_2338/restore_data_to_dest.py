@@ -15,9 +15,14 @@
 import argparse
 import os
 import sys
+import time
+
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
 from ebi_eva_common_pyutils.logger import logging_config
 
+from eva_2338.dump_data_from_source import get_shard_dump_dir
+from eva_2338.throughput_report import read_throughput, record_throughput
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
@@ -36,6 +41,26 @@ def restore_data_to_dest(mongo_dest: MongoDatabase, top_level_dump_dir):
         sys.exit(1)
 
 
+def restore_collection_shard_to_dest(mongo_dest: MongoDatabase, top_level_dump_dir, collection_name, shard_name):
+    try:
+        shard_dump_dir = get_shard_dump_dir(top_level_dump_dir, mongo_dest.db_name, shard_name)
+        logger.info(f"Loading {collection_name} shard {shard_name} in target database from {shard_dump_dir}...")
+        start_time = time.time()
+        # noIndexRestore - Do not restore indexes because MongoDB 3.2 does not have index compatibility with MongoDB 4.0
+        mongo_dest.restore_data(dump_dir=shard_dump_dir,
+                                mongorestore_args={"nsInclude": f"{mongo_dest.db_name}.{collection_name}",
+                                                   "noIndexRestore": "",
+                                                   "numInsertionWorkersPerCollection": 4})
+        end_time = time.time()
+        dump_throughput = read_throughput(top_level_dump_dir, mongo_dest.db_name, "dump_data_from_source", shard_name)
+        record_throughput(top_level_dump_dir, mongo_dest.db_name, "restore_data_to_dest", collection_name,
+                          shard_name, dump_throughput["documents"], dump_throughput["bytes"], start_time, end_time)
+    except Exception as ex:
+        logger.error(f"Error while restoring {collection_name} shard {shard_name} to the destination database!\n"
+                     f"{ex.__str__()}")
+        sys.exit(1)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Restore data to a given MongoDB destination',
                                      formatter_class=argparse.RawTextHelpFormatter, add_help=False)
@@ -48,11 +73,18 @@ def main():
     parser.add_argument("--db-name", help="Database to migrate (ex: eva_hsapiens_grch37)", required=True)
     parser.add_argument("--dump-dir", help="Top-level directory where all dumps reside (ex: /path/to/dumps)",
                         required=True)
+    parser.add_argument("--collection", help="Only restore this collection (ex: variants_2_0)", required=False)
+    parser.add_argument("--shard-name", help="Name of the collection shard to restore (ex: variants_2_0_3)",
+                        required=False)
     parser.add_argument('--help', action='help', help='Show this help message and exit')
 
     args = parser.parse_args()
-    restore_data_to_dest(MongoDatabase(args.mongo_dest_uri, args.mongo_dest_secrets_file, args.db_name),
-                         top_level_dump_dir=args.dump_dir)
+    mongo_dest = MongoDatabase(args.mongo_dest_uri, args.mongo_dest_secrets_file, args.db_name)
+    if args.collection:
+        restore_collection_shard_to_dest(mongo_dest, top_level_dump_dir=args.dump_dir,
+                                         collection_name=args.collection, shard_name=args.shard_name or args.collection)
+    else:
+        restore_data_to_dest(mongo_dest, top_level_dump_dir=args.dump_dir)
 
 
 if __name__ == "__main__":
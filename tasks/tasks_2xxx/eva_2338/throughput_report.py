@@ -0,0 +1,84 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import glob
+import json
+import os
+from collections import defaultdict
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+logging_config.add_stdout_handler()
+
+
+def get_throughput_file(top_level_dump_dir, db_name, step, shard_name):
+    return os.path.join(top_level_dump_dir, db_name, "throughput", f"{step}_{shard_name}.json")
+
+
+def record_throughput(top_level_dump_dir, db_name, step, collection_name, shard_name, num_documents, num_bytes,
+                      start_time, end_time):
+    throughput_file = get_throughput_file(top_level_dump_dir, db_name, step, shard_name)
+    os.makedirs(os.path.dirname(throughput_file), exist_ok=True)
+    duration = max(end_time - start_time, 1e-9)
+    logger.info(f"{step} of {db_name}.{collection_name} shard {shard_name}: {num_documents} documents, "
+                f"{num_bytes / 1024 / 1024:.1f} MB in {duration:.1f}s "
+                f"({num_documents / duration:.0f} docs/s, {num_bytes / 1024 / 1024 / duration:.2f} MB/s)")
+    with open(throughput_file, "w") as throughput_file_handle:
+        json.dump({"step": step, "collection": collection_name, "shard": shard_name, "documents": num_documents,
+                   "bytes": num_bytes, "start": start_time, "end": end_time}, throughput_file_handle)
+
+
+def read_throughput(top_level_dump_dir, db_name, step, shard_name):
+    with open(get_throughput_file(top_level_dump_dir, db_name, step, shard_name)) as throughput_file_handle:
+        return json.load(throughput_file_handle)
+
+
+def report_throughput(top_level_dump_dir, db_name):
+    """
+    Aggregate the throughput of the shards of each collection. The rates are computed over the wall-clock time
+    between the start of the first shard and the end of the last one so that they reflect the parallelism.
+    """
+    records = defaultdict(list)
+    for throughput_file in glob.glob(os.path.join(top_level_dump_dir, db_name, "throughput", "*.json")):
+        with open(throughput_file) as throughput_file_handle:
+            record = json.load(throughput_file_handle)
+        records[(record["collection"], record["step"])].append(record)
+
+    logger.info(f"Throughput for {db_name}")
+    logger.info(f"{'Collection':<40}{'Step':<30}{'Shards':>8}{'Documents':>15}{'MB':>12}{'docs/s':>12}{'MB/s':>10}")
+    for (collection_name, step), shard_records in sorted(records.items()):
+        num_documents = sum(record["documents"] for record in shard_records)
+        num_mb = sum(record["bytes"] for record in shard_records) / 1024 / 1024
+        duration = max(max(record["end"] for record in shard_records) -
+                       min(record["start"] for record in shard_records), 1e-9)
+        logger.info(f"{collection_name:<40}{step:<30}{len(shard_records):>8}{num_documents:>15}{num_mb:>12.1f}"
+                    f"{num_documents / duration:>12.0f}{num_mb / duration:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the dump and restore throughput of each collection',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--db-name", help="Database to migrate (ex: eva_hsapiens_grch37)", required=True)
+    parser.add_argument("--dump-dir", help="Top-level directory where all dumps reside (ex: /path/to/dumps)",
+                        required=True)
+    parser.add_argument('--help', action='help', help='Show this help message and exit')
+
+    args = parser.parse_args()
+    report_throughput(args.dump_dir, args.db_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import hashlib
 import argparse
+import json
+import os
+import queue
+import threading
 from collections import defaultdict
 
 import pymongo
-import traceback
 from ebi_eva_common_pyutils.config_utils import get_mongo_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from pymongo import WriteConcern
@@ -11,6 +14,8 @@ from pymongo import WriteConcern
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
+END_OF_STREAM = object()
+
 
 def generate_update_statement(hash_to_variant_ids, hash_to_accession_info):
     variant_to_ids = defaultdict(set)
@@ -47,9 +52,12 @@ def get_from_accessioning_db(mongo_handle, mongo_accession_db, sve_hashes):
     return hash_to_accession_info
 
 
-def get_variants_from_variant_warehouse(variants_collection, batch_size):
+def get_variants_from_variant_warehouse(variants_collection, batch_size, last_processed_id=None):
     projection = {"_id": 1, "files.sid": 1, "chr": 1, "start": 1, "ref": 1, "alt": 1, "type": 1}
-    return variants_collection.find({}, projection=projection, batch_size=batch_size, no_cursor_timeout=True)
+    # Sorted by _id so that the last processed _id is enough to resume
+    query = {"_id": {"$gt": last_processed_id}} if last_processed_id is not None else {}
+    return variants_collection.find(query, projection=projection, batch_size=batch_size, no_cursor_timeout=True)\
+        .sort("_id", pymongo.ASCENDING)
 
 
 def load_synonyms_for_assembly(assembly_accession, assembly_report_file=None):
@@ -165,8 +173,97 @@ def update_variant_warehouse(mongo_handle, mongo_accession_db, variants_collecti
         return variants_modified_in_batch
 
 
-def populate_ids(private_config_xml_file, databases, profile='production', mongo_accession_db='eva_accession_sharded'):
+def load_checkpoint(checkpoint_file, db_name):
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as open_file:
+            return json.load(open_file).get(db_name)
+    return None
+
+
+def save_checkpoint(checkpoint_file, db_name, last_processed_id):
+    checkpoints = {}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as open_file:
+            checkpoints = json.load(open_file)
+    checkpoints[db_name] = last_processed_id
+    with open(checkpoint_file + '.tmp', 'w') as open_file:
+        json.dump(checkpoints, open_file)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def put_until_stopped(output_queue, item, stop_event):
+    """Put an item in a bounded queue, giving up if the pipeline is being stopped"""
+    while not stop_event.is_set():
+        try:
+            output_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_until_end(input_queue, stop_event):
+    """Yield the items of a queue until the end of the stream or until the pipeline is being stopped"""
+    while not stop_event.is_set():
+        try:
+            item = input_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        if item is END_OF_STREAM:
+            return
+        yield item
+
+
+def run_pipeline_stage(stage, output_queue, stop_event, errors, *args):
+    """Run one stage of the pipeline in its own thread, stopping the whole pipeline if it fails"""
+    def run():
+        try:
+            stage(*args, output_queue, stop_event)
+        except Exception as e:
+            logger.exception(f"Stage {stage.__name__} failed")
+            errors.append(e)
+            stop_event.set()
+        finally:
+            put_until_stopped(output_queue, END_OF_STREAM, stop_event)
+    thread = threading.Thread(target=run, name=stage.__name__, daemon=True)
+    thread.start()
+    return thread
+
+
+def read_variant_windows(variants_cursor, window_size, window_queue, stop_event):
+    window = []
+    for variant_query_result in variants_cursor:
+        window.append(variant_query_result)
+        if len(window) == window_size:
+            if not put_until_stopped(window_queue, window, stop_event):
+                return
+            window = []
+    if window:
+        put_until_stopped(window_queue, window, stop_event)
+
+
+def lookup_accessions(mongo_handle, mongo_accession_db, assembly, contig_synonym_dictionaries, window_queue,
+                      update_queue, stop_event):
+    for window in get_until_end(window_queue, stop_event):
+        hash_to_variant_ids = {}
+        for variant_query_result in window:
+            hash_to_variant_id, _ = get_hash_to_variant_id(assembly, contig_synonym_dictionaries, variant_query_result)
+            hash_to_variant_ids.update(hash_to_variant_id)
+        hash_to_accession_info = get_from_accessioning_db(mongo_handle, mongo_accession_db, hash_to_variant_ids.keys())
+        update_statements = generate_update_statement(hash_to_variant_ids, hash_to_accession_info)
+        if not put_until_stopped(update_queue, (update_statements, window[-1]['_id']), stop_event):
+            return
+
+
+def populate_ids(private_config_xml_file, databases, profile='production', mongo_accession_db='eva_accession_sharded',
+                 window_size=1000, queue_size=4, checkpoint_file=None):
+    """
+    Stream the variants of each database through three concurrent stages connected by bounded queues:
+    read windows of variants, look up their accessions and write the updates. Memory stays bounded by the queue size
+    and, when a checkpoint file is provided, the last _id written is saved after each window so a run can be resumed.
+    """
     db_assembly = get_db_name_and_assembly_accession(databases)
+    modified_count = 0
     for db_name, info in db_assembly.items():
         assembly = info['assembly']
         asm_report = info['asm_report']
@@ -176,53 +273,48 @@ def populate_ids(private_config_xml_file, databases, profile='production', mongo
 
         with pymongo.MongoClient(get_mongo_uri_for_eva_profile(profile, private_config_xml_file)) as mongo_handle:
             variants_collection = mongo_handle[db_name]["variants_2_0"]
+            last_processed_id = load_checkpoint(checkpoint_file, db_name)
+            if last_processed_id is not None:
+                logger.info(f"Resuming database {db_name} after variant {last_processed_id}")
             logger.info(f"Querying variants from variant warehouse, database {db_name}")
-            batch_size = 1
-            variants_cursor = get_variants_from_variant_warehouse(variants_collection, batch_size)
-            hash_to_variant_ids = {}
-            update_statements = []
+            variants_cursor = get_variants_from_variant_warehouse(variants_collection, window_size, last_processed_id)
+
+            window_queue = queue.Queue(maxsize=queue_size)
+            update_queue = queue.Queue(maxsize=queue_size)
+            stop_event = threading.Event()
+            errors = []
+            threads = [
+                run_pipeline_stage(read_variant_windows, window_queue, stop_event, errors, variants_cursor,
+                                   window_size),
+                run_pipeline_stage(lookup_accessions, update_queue, stop_event, errors, mongo_handle,
+                                   mongo_accession_db, assembly, contig_synonym_dictionaries, window_queue)
+            ]
+            db_modified_count = 0
+            batch_number = 0
             try:
-                count_variants = 0
-                batch_number = 0
-                for variant_query_result in variants_cursor:
-                    hash_to_variant_id, contigs_no_genbank = get_hash_to_variant_id(assembly,
-                                                                                    contig_synonym_dictionaries,
-                                                                                    variant_query_result)
-                    hash_to_variant_ids.update(hash_to_variant_id)
-                    count_variants += 1
-                    if count_variants == batch_size:
-                        batch_number += 1
-                        # Generate update statements
-                        logger.info(f"Generating update statements: database {db_name} (batch {batch_number})")
-                        sve_hashes = hash_to_variant_ids.keys()
-                        hash_to_accession_info = get_from_accessioning_db(mongo_handle, mongo_accession_db, sve_hashes)
-                        update_statements.extend(generate_update_statement(hash_to_variant_ids, hash_to_accession_info))
-
-                        hash_to_variant_ids.clear()
-                        count_variants = 0
-                if count_variants > 0:
-                    logger.info(f"Generating update statements: database {db_name} (batch {batch_number+1})")
-                    sve_hashes = hash_to_variant_ids.keys()
-                    hash_to_accession_info = get_from_accessioning_db(mongo_handle, mongo_accession_db, sve_hashes)
-                    update_statements.extend(generate_update_statement(hash_to_variant_ids, hash_to_accession_info))
-            except ValueError as e:
-                print(traceback.format_exc())
-                raise e
+                for update_statements, last_id_in_window in get_until_end(update_queue, stop_event):
+                    batch_number += 1
+                    if update_statements:
+                        result_update = variants_collection.with_options(
+                            write_concern=WriteConcern(w="majority", wtimeout=1200000)) \
+                            .bulk_write(requests=update_statements, ordered=False)
+                        db_modified_count += result_update.modified_count if result_update else 0
+                    if checkpoint_file:
+                        save_checkpoint(checkpoint_file, db_name, last_id_in_window)
+                    logger.info(f"Updated database {db_name} (batch {batch_number}): "
+                                f"{db_modified_count} variants modified so far")
             finally:
+                stop_event.set()
+                for thread in threads:
+                    thread.join()
                 variants_cursor.close()
+            if errors:
+                raise errors[0]
 
-            if len(contigs_no_genbank) > 0:
-                raise ValueError(f"Contigs {contigs_no_genbank} don't have a genbank equivalent, check assembly report")
-
-            modified_count = 0
-            if update_statements:
-                result_update = variants_collection.with_options(
-                    write_concern=WriteConcern(w="majority", wtimeout=1200000)) \
-                    .bulk_write(requests=update_statements, ordered=False)
-                modified_count = result_update.modified_count if result_update else 0
-                logger.info(f"{modified_count} variants modified in {db_name}")
+            logger.info(f"{db_modified_count} variants modified in {db_name}")
+            modified_count += db_modified_count
 
-        return modified_count
+    return modified_count
 
 
 def check_all_contigs(private_config_xml_file, databases, profile='production'):
@@ -273,10 +365,15 @@ if __name__ == "__main__":
                              "with SS and RS ids (ex: /path/to/dbs/to/populate.txt)", required=True)
     parser.add_argument('--only_check', help='Check the contigs have a genbank equivalent in the assembly report',
                         default=False, action='store_true')
+    parser.add_argument('--window-size', type=int, default=1000,
+                        help='Number of variants looked up and updated together')
+    parser.add_argument('--checkpoint-file', required=False, default=None,
+                        help='File where the last variant processed in each database is saved to resume from')
     parser.add_argument('--fail-on-first-error', help='Stop execution if one contig does not have a genbank equivalent',
                         default=False, action='store_true')
     args = parser.parse_args()
 
     check_all_contigs(args.private_config_xml_file, args.dbs_to_populate_list)
     if not args.only_check:
-        populate_ids(args.private_config_xml_file, args.dbs_to_populate_list)
+        populate_ids(args.private_config_xml_file, args.dbs_to_populate_list, window_size=args.window_size,
+                     checkpoint_file=args.checkpoint_file)
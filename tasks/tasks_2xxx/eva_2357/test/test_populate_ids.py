@@ -1,3 +1,4 @@
+import json
 import os
 
 from pymongo import MongoClient
@@ -141,6 +142,26 @@ class TestCorrectChr(TestCase):
         # elements regardless of the order
         self.assertCountEqual(variant['ids'], ['ss1', 'ss5318166021', 'rs1000', 'ss2000'])
 
+    @patch('tasks.eva_2357.populate_ids.get_mongo_uri_for_eva_profile')
+    def test_populate_ids_resume_from_checkpoint(self, mock_get_mongo_uri_for_eva_profile):
+        mock_get_mongo_uri_for_eva_profile.return_value = 'mongodb://127.0.0.1:27017'
+        settings = self.get_test_resource("settings.xml")
+        databases_file = self.get_test_resource("databases.txt")
+        checkpoint_file = self.get_test_resource("checkpoint.json")
+        try:
+            self.assertEqual(1, populate_ids(settings, databases_file, profile='localhost',
+                                             mongo_accession_db=self.accession_db, window_size=1,
+                                             checkpoint_file=checkpoint_file))
+            with open(checkpoint_file) as open_file:
+                self.assertEqual({self.variant_warehouse_db: 'NC_018728.3_76166296_C_T'}, json.load(open_file))
+            # All the variants were processed so resuming does not update anything
+            self.assertEqual(0, populate_ids(settings, databases_file, profile='localhost',
+                                             mongo_accession_db=self.accession_db, window_size=1,
+                                             checkpoint_file=checkpoint_file))
+        finally:
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+
     @patch('tasks.eva_2357.populate_ids.get_mongo_uri_for_eva_profile')
     def test_populate_ids_fail(self, mock_get_mongo_uri_for_eva_profile):
         logging.getLogger().setLevel(logging.DEBUG)
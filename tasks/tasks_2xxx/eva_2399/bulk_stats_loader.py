@@ -0,0 +1,65 @@
+import time
+
+import psycopg2.extras
+from psycopg2 import sql
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+
+class BulkStatsLoader:
+    """
+    Stage rows for a statistics table and write them with a single parameterised multi-row upsert.
+    Rows sharing the key columns with an existing row replace its other columns. Without key columns the rows are
+    plainly inserted. The loader uses the connection it is given and commits once per flush.
+    """
+
+    def __init__(self, connection, table_name, columns, key_columns=None, page_size=1000):
+        self.connection = connection
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.key_columns = list(key_columns) if key_columns else []
+        self.page_size = page_size
+        self.rows = []
+
+    def add(self, row):
+        """Stage a row provided either as a dict keyed by column name or as a sequence in the column order"""
+        if isinstance(row, dict):
+            row = tuple(row[column] for column in self.columns)
+        elif len(row) != len(self.columns):
+            raise ValueError(f'Expected {len(self.columns)} values for {self.table_name} but got {len(row)}: {row}')
+        self.rows.append(tuple(row))
+
+    def _upsert_query(self):
+        query = sql.SQL('INSERT INTO {table} ({columns}) VALUES %s').format(
+            table=sql.Identifier(*self.table_name.split('.')),
+            columns=sql.SQL(', ').join(sql.Identifier(column) for column in self.columns)
+        )
+        if self.key_columns:
+            updated_columns = [column for column in self.columns if column not in self.key_columns]
+            if updated_columns:
+                conflict_action = sql.SQL('DO UPDATE SET {}').format(sql.SQL(', ').join(
+                    sql.SQL('{column} = EXCLUDED.{column}').format(column=sql.Identifier(column))
+                    for column in updated_columns
+                ))
+            else:
+                conflict_action = sql.SQL('DO NOTHING')
+            query = sql.SQL('{query} ON CONFLICT ({keys}) {action}').format(
+                query=query, keys=sql.SQL(', ').join(sql.Identifier(column) for column in self.key_columns),
+                action=conflict_action
+            )
+        return query
+
+    def flush(self):
+        """Write all the staged rows in one transaction and return the number of rows written"""
+        if not self.rows:
+            return 0
+        start_time = time.perf_counter()
+        with self.connection.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, self._upsert_query(), self.rows, page_size=self.page_size)
+        self.connection.commit()
+        num_rows = len(self.rows)
+        self.rows = []
+        logger.info(f'Loaded {num_rows} rows in {self.table_name} in {time.perf_counter() - start_time:.2f}s')
+        return num_rows
@@ -2,21 +2,26 @@ import argparse
 from datetime import datetime
 
 import psycopg2
-import psycopg2.extras
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
 from ebi_eva_common_pyutils.pg_utils import execute_query
 from retry import retry
 
+from tasks.eva_2399.bulk_stats_loader import BulkStatsLoader
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 mongo_migration_count_validation_table_name = "eva_tasks.mongo4_migration_count_validation"
+count_validation_columns = ['mongo_host', 'database', 'collection', 'document_count', 'report_time']
+count_validation_key_columns = ['mongo_host', 'database', 'collection', 'report_time']
 
 
-def create_collection_count_validation_report(mongo_source: MongoDatabase, database_list, private_config_xml_file):
+def create_collection_count_validation_report(mongo_source: MongoDatabase, database_list, metadata_connection_handle):
     report_timestamp = datetime.now()
     mongo_host = mongo_source.mongo_handle.address[0]
+    loader = BulkStatsLoader(metadata_connection_handle, mongo_migration_count_validation_table_name,
+                             count_validation_columns, key_columns=count_validation_key_columns)
 
     for db in database_list:
         mongo_source.db_name = db
@@ -32,8 +37,10 @@ def create_collection_count_validation_report(mongo_source: MongoDatabase, datab
             no_of_documents = get_documents_count_for_collection(mongo_source, db, coll)
             logger.info(f"Found {no_of_documents} documents in database ({db}) - collection ({coll})")
 
-            insert_count_validation_result_to_db(private_config_xml_file,
-                                                 (mongo_host, db, coll, no_of_documents, report_timestamp))
+            loader.add((mongo_host, db, coll, no_of_documents, report_timestamp))
+
+        # the counts of a database are committed together so the ones already gathered are kept if a later one fails
+        loader.flush()
 
 
 @retry(logger=logger, tries=3, delay=3, backoff=2)
@@ -41,30 +48,16 @@ def get_documents_count_for_collection(mongo_server: MongoDatabase, db, coll):
     return mongo_server.mongo_handle[db][coll].count_documents({})
 
 
-def create_table_for_count_validation(private_config_xml_file):
-    with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
-                          user="evadev") as metadata_connection_handle:
-        query_create_table_for_count_validation = "create table if not exists {0} " \
-                                                  "(mongo_host text, database text, collection text, " \
-                                                  "document_count bigint not null, report_time timestamp, " \
-                                                  "primary key(mongo_host, database, collection, report_time))" \
-            .format(mongo_migration_count_validation_table_name)
+def create_table_for_count_validation(metadata_connection_handle):
+    query_create_table_for_count_validation = "create table if not exists {0} " \
+                                              "(mongo_host text, database text, collection text, " \
+                                              "document_count bigint not null, report_time timestamp, " \
+                                              "primary key(mongo_host, database, collection, report_time))" \
+        .format(mongo_migration_count_validation_table_name)
 
     execute_query(metadata_connection_handle, query_create_table_for_count_validation)
 
 
-def insert_count_validation_result_to_db(private_config_xml_file, count_validation_res_list):
-    if len(count_validation_res_list) > 0:
-        with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
-                              user="evadev") as metadata_connection_handle:
-            with metadata_connection_handle.cursor() as cursor:
-                psycopg2.extras.execute_values(cursor,
-                                               "INSERT INTO {0} "
-                                               "(mongo_host, database, collection, document_count,report_time) "
-                                               "VALUES %s".format(mongo_migration_count_validation_table_name),
-                                               [count_validation_res_list])
-
-
 def get_databases_list_for_validation(file_path):
     database_list = []
     try:
@@ -101,8 +94,10 @@ def main():
     mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file)
     database_list = get_databases_list_for_validation(args.db_list)
 
-    create_table_for_count_validation(args.private_config_xml_file)
-    create_collection_count_validation_report(mongo_source, database_list, args.private_config_xml_file)
+    with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", args.private_config_xml_file),
+                          user="evadev") as metadata_connection_handle:
+        create_table_for_count_validation(metadata_connection_handle)
+        create_collection_count_validation_report(mongo_source, database_list, metadata_connection_handle)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,13 @@
 #!/usr/bin/env python
 import csv
-import json
 import operator
-import os
 import re
+import threading
+import time
 from argparse import ArgumentParser
 from collections import defaultdict
-
-import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.etree import ElementTree
 
 import pandas as pd
 import psycopg2
@@ -17,6 +17,8 @@ from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_prof
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.pg_utils import execute_query, get_all_results_for_query
 
+from tasks.eva_2406.lookup_cache import LookupCache
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
@@ -28,42 +30,54 @@ efetch_url = eutils_url + 'efetch.fcgi'
 ensembl_url = 'http://rest.ensembl.org/info/assembly'
 
 
-cache_file = 'cache.json'
+cache_file = 'cache.sqlite'
+cache = LookupCache(cache_file)
 
 
-def load_cache():
-    global cache
-    if os.path.exists(cache_file):
-        with open(cache_file) as open_file:
-            cache.update(json.load(open_file))
+class RateLimiter:
+    """Space the requests sent from all the threads so that no more than requests_per_second are sent"""
 
+    def __init__(self, requests_per_second):
+        self.lock = threading.Lock()
+        self.next_request_time = 0
+        self.set_rate(requests_per_second)
 
-def save_cache():
-    with open(cache_file, 'w') as open_file:
-        json.dump(cache, open_file)
+    def set_rate(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
 
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
 
-atexit.register(save_cache)
 
+# NCBI allows 3 requests per second without an API key and Ensembl 15 requests per second
+ncbi_rate_limiter = RateLimiter(3)
+ensembl_rate_limiter = RateLimiter(15)
 
-cache = defaultdict(dict)
-load_cache()
+
+def ncbi_request(method, url, **kwargs):
+    ncbi_rate_limiter.wait()
+    return requests.request(method, url, **kwargs)
 
 
 def retrieve_assembly_summary_from_species_name(species):
     """Search for all ids of assemblies associated with a species by depaginating the results of the search query"""
     payload = {'db': 'Assembly', 'term': '"{}[ORGN]"'.format(species), 'retmode': 'JSON', 'retmax': 100}
-    response = requests.get(esearch_url, params=payload)
+    response = ncbi_request('get', esearch_url, params=payload)
     data = response.json()
     search_results = data.get('esearchresult', {})
     id_list = search_results.get('idlist', [])
     while int(search_results.get('retstart')) + int(search_results.get('retmax')) < int(search_results.get('count')):
         payload['retstart'] = int(search_results.get('retstart')) + int(search_results.get('retmax'))
-        response = requests.get(esearch_url, params=payload)
+        response = ncbi_request('get', esearch_url, params=payload)
         data = response.json()
         search_results = data.get('esearchresult', {})
         id_list += search_results.get('idlist', [])
-    response = requests.get(esummary_url, params={'db': 'Assembly', 'id': ','.join(id_list), 'retmode': 'JSON'})
+    response = ncbi_request('get', esummary_url, params={'db': 'Assembly', 'id': ','.join(id_list), 'retmode': 'JSON'})
     summary_list = response.json()
     if summary_list and 'result' in summary_list:
         return [summary_list.get('result').get(uid) for uid in summary_list.get('result').get('uids')]
@@ -81,46 +95,111 @@ def best_assembly(assembly_list):
         return sorted(assembly_list, key=operator.itemgetter('scaffoldn50'))[-1]
 
 
+def query_ncbi_for_species_name_from_tax_id(taxid):
+    logger.info(f'Query NCBI for taxonomy {taxid}', )
+    payload = {'db': 'Taxonomy', 'id': taxid}
+    r = ncbi_request('get', efetch_url, params=payload)
+    match = re.search('<Rank>(.+?)</Rank>', r.text, re.MULTILINE)
+    rank = None
+    if match:
+        rank = match.group(1)
+    if rank not in ['species', 'subspecies']:
+        logger.warning('Taxonomy id %s does not point to a species', taxid)
+    match = re.search('<ScientificName>(.+?)</ScientificName>', r.text, re.MULTILINE)
+    if match:
+        return match.group(1)
+    logger.warning('No species found for %s' % taxid)
+
+
+def query_ncbi_for_species_names_from_tax_ids(taxids):
+    """Retrieve the scientific names of several taxonomies in one query. Taxonomies not returned are left out."""
+    logger.info(f'Query NCBI for {len(taxids)} taxonomies')
+    response = ncbi_request('get', efetch_url, params={'db': 'Taxonomy', 'id': ','.join(taxids)})
+    response.raise_for_status()
+    taxid_to_name = {}
+    for taxon in ElementTree.fromstring(response.content).findall('Taxon'):
+        taxid = taxon.findtext('TaxId')
+        if taxon.findtext('Rank') not in ['species', 'subspecies']:
+            logger.warning('Taxonomy id %s does not point to a species', taxid)
+        taxid_to_name[taxid] = taxon.findtext('ScientificName')
+    return taxid_to_name
+
+
 def retrieve_species_names_from_tax_id(taxid):
     """Search for a species scientific name based on the taxonomy id"""
-    if str(taxid) not in cache['taxid_to_name']:
-        logger.info(f'Query NCBI for taxonomy {taxid}', )
-        payload = {'db': 'Taxonomy', 'id': taxid}
-        r = requests.get(efetch_url, params=payload)
-        match = re.search('<Rank>(.+?)</Rank>', r.text, re.MULTILINE)
-        rank = None
-        if match:
-            rank = match.group(1)
-        if rank not in ['species', 'subspecies']:
-            logger.warning('Taxonomy id %s does not point to a species', taxid)
-        match = re.search('<ScientificName>(.+?)</ScientificName>', r.text, re.MULTILINE)
-        if match:
-            cache['taxid_to_name'][str(taxid)] = match.group(1)
-        else:
-            logger.warning('No species found for %s' % taxid)
-            cache['taxid_to_name'][str(taxid)] = None
-    return taxid, cache['taxid_to_name'].get(str(taxid))
+    return taxid, cache.get_or_fetch('taxid_to_name', str(taxid), query_ncbi_for_species_name_from_tax_id)
+
+
+def query_ncbi_for_species_from_assembly_accession(assembly_accession):
+    logger.info(f'Query NCBI for assembly {assembly_accession}', )
+    payload = {'db': 'Assembly', 'term': '"{}"'.format(assembly_accession), 'retmode': 'JSON'}
+    data = ncbi_request('get', esearch_url, params=payload).json()
+    if data:
+        assembly_id_list = data.get('esearchresult').get('idlist')
+        payload = {'db': 'Assembly', 'id': ','.join(assembly_id_list), 'retmode': 'JSON'}
+        summary_list = ncbi_request('get', esummary_url, params=payload).json()
+        all_species_names = set()
+        for assembly_id in summary_list.get('result', {}).get('uids', []):
+            assembly_info = summary_list.get('result').get(assembly_id)
+            all_species_names.add((assembly_info.get('speciestaxid'), assembly_info.get('speciesname')))
+        if len(all_species_names) == 1:
+            return all_species_names.pop()
+        logger.warning('%s taxons found for assembly %s ' % (len(all_species_names), assembly_accession))
+
+
+def query_ncbi_for_species_from_assembly_accessions(assembly_accessions):
+    """
+    Retrieve the species of several assemblies with one search and one summary query. Only the assemblies whose
+    summaries all point to the same species are returned, the others are left to the individual lookup.
+    """
+    logger.info(f'Query NCBI for {len(assembly_accessions)} assemblies')
+    payload = {'db': 'Assembly', 'term': ' OR '.join('"{}"'.format(accession) for accession in assembly_accessions),
+               'retmode': 'JSON', 'retmax': 10000}
+    response = ncbi_request('get', esearch_url, params=payload)
+    response.raise_for_status()
+    assembly_id_list = response.json().get('esearchresult', {}).get('idlist', [])
+    if not assembly_id_list:
+        return {}
+    payload = {'db': 'Assembly', 'id': ','.join(assembly_id_list), 'retmode': 'JSON'}
+    response = ncbi_request('post', esummary_url, data=payload)
+    response.raise_for_status()
+    summary_list = response.json()
+    species_per_assembly = defaultdict(set)
+    for assembly_id in summary_list.get('result', {}).get('uids', []):
+        assembly_info = summary_list.get('result').get(assembly_id)
+        species = (assembly_info.get('speciestaxid'), assembly_info.get('speciesname'))
+        for accession in [assembly_info.get('assemblyaccession')] + list(assembly_info.get('synonym', {}).values()):
+            species_per_assembly[accession].add(species)
+    return {
+        assembly_accession: species_per_assembly[assembly_accession].pop()
+        for assembly_accession in assembly_accessions
+        if len(species_per_assembly.get(assembly_accession, ())) == 1
+    }
 
 
 def retrieve_species_name_from_assembly_accession(assembly_accession):
     """Search for a species scientific name based on an assembly accession"""
-    if assembly_accession not in cache['assembly_to_species']:
-        logger.info(f'Query NCBI for assembly {assembly_accession}', )
-        payload = {'db': 'Assembly', 'term': '"{}"'.format(assembly_accession), 'retmode': 'JSON'}
-        data = requests.get(esearch_url, params=payload).json()
-        if data:
-            assembly_id_list = data.get('esearchresult').get('idlist')
-            payload = {'db': 'Assembly', 'id': ','.join(assembly_id_list), 'retmode': 'JSON'}
-            summary_list = requests.get(esummary_url, params=payload).json()
-            all_species_names = set()
-            for assembly_id in summary_list.get('result', {}).get('uids', []):
-                assembly_info = summary_list.get('result').get(assembly_id)
-                all_species_names.add((assembly_info.get('speciestaxid'), assembly_info.get('speciesname')))
-            if len(all_species_names) == 1:
-                cache['assembly_to_species'][assembly_accession] = all_species_names.pop()
-            else:
-                logger.warning('%s taxons found for assembly %s ' % (len(all_species_names), assembly_accession))
-    return cache['assembly_to_species'].get(assembly_accession) or (None, None)
+    return cache.get_or_fetch('assembly_to_species', assembly_accession,
+                              query_ncbi_for_species_from_assembly_accession) or (None, None)
+
+
+def query_ensembl_for_current_assembly(scientific_name):
+    logger.info(f'Query Ensembl for species {scientific_name}', )
+    url = ensembl_url + '/' + scientific_name.lower().replace(' ', '_')
+    ensembl_rate_limiter.wait()
+    response = requests.get(url, params={'content-type': 'application/json'})
+    data = response.json()
+    return str(data.get('assembly_accession'))
+
+
+def prefetch_species_lookups(taxids_or_assemblies):
+    """Retrieve in batches the NCBI species lookups that retrieve_current_ensembl_assemblies will need"""
+    taxids_or_assemblies = set(str(taxid_or_assembly) for taxid_or_assembly in taxids_or_assemblies
+                               if taxid_or_assembly)
+    cache.prefetch('taxid_to_name', [taxid for taxid in taxids_or_assemblies if taxid.isdigit()],
+                   query_ncbi_for_species_names_from_tax_ids)
+    cache.prefetch('assembly_to_species', [assembly for assembly in taxids_or_assemblies if not assembly.isdigit()],
+                   query_ncbi_for_species_from_assembly_accessions)
 
 
 def retrieve_current_ensembl_assemblies(taxid_or_assembly):
@@ -139,19 +218,31 @@ def retrieve_current_ensembl_assemblies(taxid_or_assembly):
         taxid, scientific_name = retrieve_species_name_from_assembly_accession(taxid_or_assembly)
     if scientific_name:
         logger.debug('Found %s', scientific_name)
-        if scientific_name not in cache['scientific_name_to_ensembl']:
-            logger.info(f'Query Ensembl for species {scientific_name}', )
-            url = ensembl_url + '/' + scientific_name.lower().replace(' ', '_')
-            response = requests.get(url, params={'content-type': 'application/json'})
-            data = response.json()
-            assembly_accession = str(data.get('assembly_accession'))
-            cache['scientific_name_to_ensembl'][scientific_name] = assembly_accession
-        return [str(taxid), str(scientific_name), cache['scientific_name_to_ensembl'].get(scientific_name)]
+        ensembl_assembly = cache.get_or_fetch('scientific_name_to_ensembl', scientific_name,
+                                              query_ensembl_for_current_assembly)
+        return [str(taxid), str(scientific_name), ensembl_assembly]
 
     return ['NA', 'NA', 'NA']
 
 
-def find_all_eva_studies(accession_counts, private_config_xml_file):
+def retrieve_all_current_ensembl_assemblies(taxids_or_assemblies, num_workers=8):
+    """
+    Run retrieve_current_ensembl_assemblies once for each distinct taxonomy or assembly, concurrently, and return the
+    results keyed by taxonomy or assembly
+    """
+    taxids_or_assemblies = set(taxids_or_assemblies)
+    prefetch_species_lookups(taxids_or_assemblies)
+    results = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(retrieve_current_ensembl_assemblies, taxid_or_assembly): taxid_or_assembly
+                   for taxid_or_assembly in taxids_or_assemblies}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    logger.info(f'Retrieved the Ensembl assemblies for {len(results)} taxonomies and assemblies')
+    return results
+
+
+def find_all_eva_studies(accession_counts, private_config_xml_file, num_workers=8):
     metadata_uri = get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file)
     with psycopg2.connect(metadata_uri, user="evadev") as pg_conn:
         query = (
@@ -163,46 +254,42 @@ def find_all_eva_studies(accession_counts, private_config_xml_file):
             'WHERE p.ena_status=4 '   # Ensure that the project is public
             'ORDER BY pt.taxonomy_id, a.vcf_reference_accession'
         )
-        data = []
-        for assembly, tax_id, study in filter_studies(get_all_results_for_query(pg_conn, query)):
-            taxid_from_ensembl, scientific_name, ensembl_assembly_from_taxid = retrieve_current_ensembl_assemblies(tax_id)
-            _, _, ensembl_assembly_from_assembly = retrieve_current_ensembl_assemblies(assembly)
-
-            count_ssid = 0
-            if study in accession_counts:
-                assembly_from_mongo, taxid_from_mongo, project_accession, count_ssid = accession_counts.pop(study)
-                if assembly_from_mongo != assembly:
-                    logger.error(
-                        'For study %s, assembly from accessioning (%s) is different'
-                        ' from assembly from metadata (%s) database.', study, assembly_from_mongo, assembly
-                    )
-                if taxid_from_mongo != tax_id:
-                    logger.error(
-                        'For study %s, taxonomy from accessioning (%s) is different'
-                        ' from taxonomy from metadata (%s) database.', study, taxid_from_mongo, tax_id
-                    )
-            data.append({
-                'Source': 'EVA',
-                'Assembly': assembly,
-                'Taxid': tax_id,
-                'Scientific Name': scientific_name,
-                'Study': study,
-                'Number Of Variants (submitted variants)': count_ssid or 0,
-                'Ensembl assembly from taxid': ensembl_assembly_from_taxid,
-                'Ensembl assembly from assembly': ensembl_assembly_from_assembly,
-                'Target Assembly': ensembl_assembly_from_taxid or ensembl_assembly_from_assembly
-            })
+        studies = list(filter_studies(get_all_results_for_query(pg_conn, query)))
+
+    ensembl_assemblies = retrieve_all_current_ensembl_assemblies(
+        [tax_id for _, tax_id, _ in studies] + [assembly for assembly, _, _ in studies], num_workers
+    )
+    # Number of studies and of submitted variants aggregated per group of the output
+    aggregated_counts = defaultdict(lambda: [0, 0])
+    for assembly, tax_id, study in studies:
+        taxid_from_ensembl, scientific_name, ensembl_assembly_from_taxid = ensembl_assemblies[tax_id]
+        _, _, ensembl_assembly_from_assembly = ensembl_assemblies[assembly]
+
+        count_ssid = 0
+        if study in accession_counts:
+            assembly_from_mongo, taxid_from_mongo, project_accession, count_ssid = accession_counts.pop(study)
+            if assembly_from_mongo != assembly:
+                logger.error(
+                    'For study %s, assembly from accessioning (%s) is different'
+                    ' from assembly from metadata (%s) database.', study, assembly_from_mongo, assembly
+                )
+            if taxid_from_mongo != tax_id:
+                logger.error(
+                    'For study %s, taxonomy from accessioning (%s) is different'
+                    ' from taxonomy from metadata (%s) database.', study, taxid_from_mongo, tax_id
+                )
+        group = ('EVA', assembly, tax_id, scientific_name, ensembl_assembly_from_taxid,
+                 ensembl_assembly_from_assembly, ensembl_assembly_from_taxid or ensembl_assembly_from_assembly)
+        aggregated_counts[group][0] += 1
+        aggregated_counts[group][1] += count_ssid or 0
     if len(accession_counts) > 0:
         logger.error('Accessioning database has studies (%s) absent from the metadata database', ', '.join(accession_counts))
-    df = pd.DataFrame(data)
-    df = df.groupby(
-        ['Source', 'Assembly', 'Taxid', 'Scientific Name', 'Ensembl assembly from taxid',
-         'Ensembl assembly from assembly', 'Target Assembly']
-    ).agg(
-        {'Study': 'count', 'Number Of Variants (submitted variants)': 'sum'}
+    group_columns = ['Source', 'Assembly', 'Taxid', 'Scientific Name', 'Ensembl assembly from taxid',
+                     'Ensembl assembly from assembly', 'Target Assembly']
+    return pd.DataFrame(
+        [list(group) + counts for group, counts in sorted(aggregated_counts.items())],
+        columns=group_columns + ['number Of Studies', 'Number Of Variants (submitted variants)']
     )
-    df.rename(columns={'Study': 'number Of Studies'}, inplace=True)
-    return df.reset_index()
 
 
 def parse_accession_counts(accession_counts_file):
@@ -258,7 +345,7 @@ def filter_studies(query_results):
             yield assembly, tax_id, study
 
 
-def parse_dbsnp_csv(input_file, accession_counts):
+def parse_dbsnp_csv(input_file, accession_counts, num_workers=8):
     """Parse the CSV file generated in the past year to get the DBSNP data"""
     df = pd.read_csv(input_file)
     df = df[df.Source != 'EVA']
@@ -268,9 +355,11 @@ def parse_dbsnp_csv(input_file, accession_counts):
     ensembl_assemblies_from_assembly = []
     target_assemblies = []
 
+    ensembl_assemblies = retrieve_all_current_ensembl_assemblies(list(df['Taxid']) + list(df['Assembly']),
+                                                                 num_workers)
     for index, record in df.iterrows():
-        taxid, scientific_name, ensembl_assembly_from_taxid = retrieve_current_ensembl_assemblies(record['Taxid'])
-        _, _, ensembl_assembly_from_assembly = retrieve_current_ensembl_assemblies(record['Assembly'])
+        taxid, scientific_name, ensembl_assembly_from_taxid = ensembl_assemblies[record['Taxid']]
+        _, _, ensembl_assembly_from_assembly = ensembl_assemblies[record['Assembly']]
         taxids.append(taxid)
         scientific_names.append(scientific_name)
         ensembl_assemblies_from_taxid.append(ensembl_assembly_from_taxid)
@@ -333,15 +422,23 @@ def main():
     argparse.add_argument('--private_config_xml_file', required=True,
                           help='Path to the file containing the username/passwords tp access '
                                'production and development databases')
+    argparse.add_argument('--num_lookup_workers', type=int, default=8,
+                          help='Number of NCBI and Ensembl lookups run concurrently')
+    argparse.add_argument('--ncbi_requests_per_second', type=float, default=3,
+                          help='Maximum number of requests per second sent to NCBI. NCBI allows 3 without an API key')
+    argparse.add_argument('--ensembl_requests_per_second', type=float, default=15,
+                          help='Maximum number of requests per second sent to Ensembl')
     args = argparse.parse_args()
+    ncbi_rate_limiter.set_rate(args.ncbi_requests_per_second)
+    ensembl_rate_limiter.set_rate(args.ensembl_requests_per_second)
     output_header = ['Source', 'Taxid', 'Scientific Name', 'Assembly', 'number Of Studies',
                      'Number Of Variants (submitted variants)', 'Ensembl assembly from taxid',
                      'Ensembl assembly from assembly', 'Target Assembly']
 
     accession_counts_dbsnp = get_accession_counts_per_assembly(args.private_config_xml_file, 'dbSNP')
-    df1 = parse_dbsnp_csv(args.input, accession_counts_dbsnp)
+    df1 = parse_dbsnp_csv(args.input, accession_counts_dbsnp, args.num_lookup_workers)
     accession_counts_eva = get_accession_counts_per_study(args.private_config_xml_file, 'EVA')
-    df2 = find_all_eva_studies(accession_counts_eva, args.private_config_xml_file)
+    df2 = find_all_eva_studies(accession_counts_eva, args.private_config_xml_file, args.num_lookup_workers)
     df = pd.concat([df1, df2])
     df = df[output_header]
     df.to_csv(args.output, quoting=False, sep='\t', index=False)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+LOADED = 'LOADED'
+ALREADY_LOADED = 'ALREADY_LOADED'
+FAILED = 'FAILED'
+# Outcomes that do not need to be loaded again when the load is resumed
+COMPLETED_OUTCOMES = (LOADED, ALREADY_LOADED)
+RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class AssemblyOutcome:
+
+    def __init__(self, status, http_status=None, message=None):
+        self.status = status
+        self.http_status = http_status
+        self.message = message
+
+
+class HostRateLimiter:
+    """Space the requests sent to each host so that none receives more than max_requests_per_second"""
+
+    def __init__(self, max_requests_per_second=None):
+        self.interval = 1 / max_requests_per_second if max_requests_per_second else 0
+        self.next_request_time = defaultdict(float)
+
+    async def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        now = time.monotonic()
+        request_time = max(now, self.next_request_time[host])
+        self.next_request_time[host] = request_time + self.interval
+        if request_time > now:
+            await asyncio.sleep(request_time - now)
+
+
+class LoadJournal:
+    """
+    Record the outcome of each assembly in a JSON lines file so that a resumed load can skip the assemblies already
+    loaded. The last outcome recorded for an assembly is the one that counts.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.outcomes = {}
+        if os.path.exists(journal_path):
+            with open(journal_path) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line might be incomplete if the previous load was interrupted while writing it
+                        continue
+                    self.outcomes[record['assembly']] = record['status']
+
+    def is_completed(self, assembly):
+        return self.outcomes.get(assembly) in COMPLETED_OUTCOMES
+
+    def record(self, assembly, outcome, attempts, duration):
+        with open(self.journal_path, 'a') as journal:
+            journal.write(json.dumps({'assembly': assembly, 'status': outcome.status,
+                                      'http_status': outcome.http_status, 'attempts': attempts,
+                                      'duration': round(duration, 3), 'message': outcome.message,
+                                      'time': time.time()}) + '\n')
+        self.outcomes[assembly] = outcome.status
+
+
+class ContigAliasLoader:
+    """
+    Load assemblies into the contig-alias database with a bounded number of concurrent requests.
+    Each assembly is loaded by a coroutine, provided to run(), that sends its requests through request(). Requests are
+    rate limited per host and retried with exponential backoff and full jitter when the server is unavailable or returns
+    an error that might be transient. The outcome of each assembly is recorded in the journal, which a resumed load
+    uses to skip the assemblies already loaded.
+    """
+
+    def __init__(self, journal_path, max_concurrent_requests=8, max_requests_per_second=None, max_attempts=5,
+                 base_delay=1, max_delay=60, timeout=600):
+        self.journal = LoadJournal(journal_path)
+        self.max_concurrent_requests = max_concurrent_requests
+        self.rate_limiter = HostRateLimiter(max_requests_per_second)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.thread_local = threading.local()
+        self.executor = None
+        self.latencies = []
+        self.attempts = Counter()
+
+    def _send(self, method, url, **kwargs):
+        # Sessions are not shared between threads but each thread keeps its connections open across requests
+        if not hasattr(self.thread_local, 'session'):
+            self.thread_local.session = requests.Session()
+        return self.thread_local.session.request(method, url, timeout=self.timeout, **kwargs)
+
+    def _backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def request(self, assembly, method, url, **kwargs):
+        """Send the request, retrying transient errors, and return the last response"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.max_attempts + 1):
+            await self.rate_limiter.wait(url)
+            self.attempts[assembly] += 1
+            start_time = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(self.executor, lambda: self._send(method, url, **kwargs))
+            except requests.RequestException as e:
+                if attempt == self.max_attempts:
+                    raise
+                logger.warning(f'{method} for assembly {assembly} failed on attempt {attempt}: {e}')
+            else:
+                self.latencies.append(time.perf_counter() - start_time)
+                if response.status_code not in RETRIABLE_STATUS_CODES or attempt == self.max_attempts:
+                    return response
+                logger.warning(f'{method} for assembly {assembly} returned {response.status_code} '
+                               f'on attempt {attempt}: {response.text}')
+            await asyncio.sleep(self._backoff_delay(attempt))
+
+    async def _load_assemblies(self, assembly_queue, load_assembly, outcomes):
+        while True:
+            try:
+                assembly = assembly_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start_time = time.perf_counter()
+            try:
+                outcome = await load_assembly(self, assembly)
+            except Exception as e:
+                outcome = AssemblyOutcome(FAILED, message=str(e))
+            if outcome.status == FAILED:
+                logger.error(f'Could not load assembly {assembly} to Contig-Alias DB. Error: {outcome.message}')
+            self.journal.record(assembly, outcome, self.attempts[assembly], time.perf_counter() - start_time)
+            outcomes[assembly] = outcome
+
+    async def _run(self, assemblies, load_assembly):
+        assembly_queue = asyncio.Queue()
+        for assembly in assemblies:
+            assembly_queue.put_nowait(assembly)
+        outcomes = {}
+        # Each worker has at most one request in flight
+        await asyncio.gather(*(self._load_assemblies(assembly_queue, load_assembly, outcomes)
+                               for _ in range(self.max_concurrent_requests)))
+        return outcomes
+
+    def run(self, assemblies, load_assembly, resume=False):
+        """
+        Load the assemblies, skipping the ones completed in a previous run if resume is set, and return the outcome of
+        each assembly loaded
+        """
+        assemblies_to_load = [assembly for assembly in dict.fromkeys(assemblies)
+                              if not (resume and self.journal.is_completed(assembly))]
+        logger.info(f'{len(assemblies_to_load)} assemblies to load, '
+                    f'{len(set(assemblies)) - len(assemblies_to_load)} already loaded according to the journal')
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            self.executor = executor
+            outcomes = asyncio.run(self._run(assemblies_to_load, load_assembly))
+        self.report(outcomes, time.perf_counter() - start_time)
+        return outcomes
+
+    def report(self, outcomes, duration):
+        num_requests = sum(self.attempts.values())
+        latencies = sorted(self.latencies)
+        duration = max(duration, 1e-9)
+        logger.info(f'{num_requests} requests in {duration:.1f}s ({num_requests / duration:.1f} requests/s), '
+                    f'latency p50: {percentile(latencies, 50):.3f}s, p99: {percentile(latencies, 99):.3f}s')
+        statuses = Counter(outcome.status for outcome in outcomes.values())
+        logger.info(', '.join(f'{count} {status}' for status, count in sorted(statuses.items())) or 'Nothing loaded')
+        failed = sorted(assembly for assembly, outcome in outcomes.items() if outcome.status == FAILED)
+        if failed:
+            logger.error(f'Assemblies that could not be loaded: {failed}')
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, math.ceil(len(sorted_values) * percent / 100) - 1)]
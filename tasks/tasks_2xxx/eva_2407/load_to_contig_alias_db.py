@@ -1,12 +1,12 @@
 import argparse
 import base64
-import urllib.request
 
 import psycopg2
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile, get_properties_from_xml_file
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
-from retry import retry
+
+from tasks.eva_2407.contig_alias_loader import ContigAliasLoader, AssemblyOutcome, LOADED, FAILED
 
 logger = logging_config.get_logger(__name__)
 
@@ -30,29 +30,45 @@ def get_contig_alias_auth(private_config_xml_file):
     return base64_auth.decode()
 
 
-@retry(tries=4, delay=2, backoff=1.2, jitter=(1, 3))
-def load_assembly_to_contig_alias(assemblies, admin_credentials):
-    for assembly in assemblies:
-        url = f"https://www.ebi.ac.uk/eva/webservices/contig-alias/v1/admin/assemblies/{assembly}"
-        headers = {'Authorization': 'Basic ' + admin_credentials}
-        request = urllib.request.Request(url, None, headers)
-        try:
-            with urllib.request.urlopen(request) as response:
-                logger.info(f"Assembly {assembly} loaded into contig alias database")
-        except Exception:
-            logger.error(f"Error loading assembly {assembly}")
+async def load_assembly(loader, assembly, admin_credentials):
+    url = f"https://www.ebi.ac.uk/eva/webservices/contig-alias/v1/admin/assemblies/{assembly}"
+    headers = {'Authorization': 'Basic ' + admin_credentials}
+    response = await loader.request(assembly, 'GET', url, headers=headers)
+    if response.ok:
+        logger.info(f"Assembly {assembly} loaded into contig alias database")
+        return AssemblyOutcome(LOADED, response.status_code)
+    return AssemblyOutcome(FAILED, response.status_code, response.text)
+
+
+def load_assembly_to_contig_alias(assemblies, admin_credentials, journal_file, resume=False, max_concurrent_requests=8,
+                                  max_requests_per_second=None):
+    loader = ContigAliasLoader(journal_file, max_concurrent_requests=max_concurrent_requests,
+                               max_requests_per_second=max_requests_per_second)
+    return loader.run(assemblies, lambda loader, assembly: load_assembly(loader, assembly, admin_credentials),
+                      resume=resume)
 
 
-def load_data_to_contig_alias(private_config_xml_file, assembly_list):
+def load_data_to_contig_alias(private_config_xml_file, assembly_list, journal_file, resume=False,
+                              max_concurrent_requests=8, max_requests_per_second=None):
     assemblies = assembly_list if assembly_list else get_assemblies_from_evapro(private_config_xml_file)
     admin_credentials = get_contig_alias_auth(private_config_xml_file)
     logger.info(f"Assemblies to be loaded into contig alias database: {assemblies}")
-    load_assembly_to_contig_alias(assemblies, admin_credentials)
+    load_assembly_to_contig_alias(assemblies, admin_credentials, journal_file, resume, max_concurrent_requests,
+                                  max_requests_per_second)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Load data into contig alias database', add_help=False)
     parser.add_argument("--private-config-xml-file", help="ex: /path/to/eva-maven-settings.xml", required=True)
     parser.add_argument("--assembly-list", help="Assembly list e.g. GCA_000181335.4", required=False, nargs='+')
+    parser.add_argument("--journal-file", default='eva2407_contig_alias_load_journal.jsonl',
+                        help="File recording the outcome of each assembly")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Skip the assemblies already loaded according to the journal file")
+    parser.add_argument("--max-concurrent-requests", type=int, default=8,
+                        help="Maximum number of requests sent to the contig-alias API at once")
+    parser.add_argument("--max-requests-per-second", type=float, default=None,
+                        help="Maximum number of requests per second sent to the contig-alias host")
     args = parser.parse_args()
-    load_data_to_contig_alias(args.private_config_xml_file, args.assembly_list)
+    load_data_to_contig_alias(args.private_config_xml_file, args.assembly_list, args.journal_file, args.resume,
+                              args.max_concurrent_requests, args.max_requests_per_second)
@@ -13,17 +13,16 @@
 # limitations under the License.
 
 from ebi_eva_common_pyutils.logger import logging_config
-from ebi_eva_common_pyutils.assembly import NCBIAssembly
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
 from ebi_eva_common_pyutils.pg_utils import execute_query
 
 import argparse
-import os
 import psycopg2
 import psycopg2.extras
 import sys
 import traceback
-import wget
+
+from tasks.eva_2469.contig_assembly_index import ContigAssemblyIndex, get_assembly_report_rows
 
 # This script is adapted from  https://github.com/EBIvariation/eva-tasks/blob/5411bd9a1187140480efd04fa159bd0b4aad0123/tasks/eva_2150/collect_assembly_report_genbank_contigs.py
 # Few changes have been made to add 2 additional columns to the table:
@@ -56,33 +55,29 @@ def insert_contigs_to_db(metadata_connection_handle, contig_info_list):
                                            page_size=100)
 
 
-def collect_assembly_report_genbank_contigs(private_config_xml_file, assembly_accession):
+def collect_assembly_report_genbank_contigs(private_config_xml_file, assembly_accession,
+                                            contig_index: ContigAssemblyIndex):
     try:
         with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
                               user="evadev") \
                 as metadata_connection_handle:
-            asm = NCBIAssembly(assembly_accession, species_scientific_name=None,
-                               reference_directory=None)
-            assembly_report_file_name = os.path.basename(asm.assembly_report_url)
-            os.system("rm -f " + assembly_report_file_name)
-            wget.download(asm.assembly_report_url)
+            # The report is shared with the contig index so it is only downloaded if no previous run did
+            assembly_report_file_name = contig_index.get_assembly_report(assembly_accession)
 
             insert_chunk_size = 100
             contig_info_list = []
-            for line in open(assembly_report_file_name, 'r'):
-                if not line.strip().startswith("#"):
-                    line_components = line.strip().split("\t")
-                    chromosome_name, genbank_accession, accession_equivalence, refseq_accession = \
-                        line_components[0], line_components[4], line_components[5], line_components[6]
-                    # Equivalence "Relationship" column in the assembly report indicates if
-                    # Genbank and RefSeq contig accessions are equivalent
-                    is_equivalent_genbank_available = (accession_equivalence.strip() == "=")
-                    contig_info_list.append((assembly_accession, genbank_accession, chromosome_name,
-                                             is_equivalent_genbank_available, refseq_accession))
-                    if len(contig_info_list) == insert_chunk_size:
-                        insert_contigs_to_db(metadata_connection_handle, contig_info_list)
-                        contig_info_list = []
+            for chromosome_name, genbank_accession, accession_equivalence, refseq_accession in \
+                    get_assembly_report_rows(assembly_report_file_name):
+                # Equivalence "Relationship" column in the assembly report indicates if
+                # Genbank and RefSeq contig accessions are equivalent
+                is_equivalent_genbank_available = (accession_equivalence.strip() == "=")
+                contig_info_list.append((assembly_accession, genbank_accession, chromosome_name,
+                                         is_equivalent_genbank_available, refseq_accession))
+                if len(contig_info_list) == insert_chunk_size:
+                    insert_contigs_to_db(metadata_connection_handle, contig_info_list)
+                    contig_info_list = []
             insert_contigs_to_db(metadata_connection_handle, contig_info_list)
+            contig_index.add_assembly_report(assembly_accession, assembly_report_file_name)
     except Exception:
         logger.error(traceback.format_exc())
 
@@ -92,11 +87,17 @@ def main():
                                      formatter_class=argparse.RawTextHelpFormatter, add_help=False)
     parser.add_argument("--private-config-xml-file",
                         help="Full path to private configuration file (ex: /path/to/settings.xml)", required=True)
+    parser.add_argument("--contig-index-file", help="SQLite file holding the contig to assembly index",
+                        default="contig_assembly_index.sqlite")
+    parser.add_argument("--assembly-report-dir", help="Directory where the assembly reports indexed are kept",
+                        default="assembly_reports")
     args = parser.parse_args()
 
     create_table_to_collect_assembly_report_genbank_contigs(args.private_config_xml_file)
+    contig_index = ContigAssemblyIndex(args.contig_index_file, args.assembly_report_dir)
     for assembly_accession in sys.stdin:
-        collect_assembly_report_genbank_contigs(args.private_config_xml_file, assembly_accession.strip())
+        collect_assembly_report_genbank_contigs(args.private_config_xml_file, assembly_accession.strip(), contig_index)
+    contig_index.close()
 
 
 if __name__ == "__main__":
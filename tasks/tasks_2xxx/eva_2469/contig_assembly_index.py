@@ -0,0 +1,138 @@
+# Copyright 2020 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local index of the contigs (Genbank and RefSeq accessions) found in the assembly reports of the assemblies indexed
+
+from ebi_eva_common_pyutils.assembly import NCBIAssembly
+from ebi_eva_common_pyutils.logger import logging_config
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+import os
+import sqlite3
+import time
+import wget
+
+logger = logging_config.get_logger(__name__)
+
+# Number of contigs looked up per query, below the maximum number of SQLite host parameters
+lookup_batch_size = 500
+
+
+def get_assembly_report_rows(assembly_report_file_name):
+    """
+    Yield, for each sequence of the assembly report, the chromosome name, the Genbank accession, the Genbank/RefSeq
+    equivalence relationship and the RefSeq accession
+    """
+    with open(assembly_report_file_name, 'r') as assembly_report:
+        for line in assembly_report:
+            if not line.strip() or line.strip().startswith("#"):
+                continue
+            line_components = line.rstrip("\r\n").split("\t")
+            yield line_components[0], line_components[4], line_components[5], line_components[6]
+
+
+class ContigAssemblyIndex:
+    """
+    Inverted index from contig accession to the accessions of the assemblies whose report lists the contig, stored in
+    SQLite. Assembly reports are kept in report_dir and only downloaded when missing from there. An assembly is indexed
+    once, in a single transaction, so an interrupted run only has to index the assemblies it had not finished.
+    """
+
+    def __init__(self, index_file, report_dir):
+        self.index_file = index_file
+        self.report_dir = report_dir
+        os.makedirs(report_dir, exist_ok=True)
+        self.connection = sqlite3.connect(index_file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS indexed_assembly (assembly_accession TEXT PRIMARY KEY, '
+                                'report_file TEXT, num_contigs INTEGER, indexed_at REAL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS contig_assembly (contig_accession TEXT, '
+                                'assembly_accession TEXT, PRIMARY KEY (contig_accession, assembly_accession)) '
+                                'WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS contig_assembly_by_assembly '
+                                'ON contig_assembly (assembly_accession)')
+        self.connection.commit()
+
+    def is_indexed(self, assembly_accession):
+        return self.connection.execute('SELECT 1 FROM indexed_assembly WHERE assembly_accession = ?',
+                                       (assembly_accession,)).fetchone() is not None
+
+    def get_assembly_report(self, assembly_accession):
+        """Return the path to the assembly report in report_dir, downloading it if it is not there yet"""
+        # Reports are named after the assembly accession so that finding one does not require listing the NCBI FTP
+        assembly_report_file_name = os.path.join(self.report_dir, f"{assembly_accession}_assembly_report.txt")
+        if not os.path.exists(assembly_report_file_name):
+            logger.info(f"Downloading assembly report for {assembly_accession}...")
+            asm = NCBIAssembly(assembly_accession, species_scientific_name=None, reference_directory=None)
+            # Download to a temporary name so that an interrupted download is not mistaken for a complete report
+            partial_file_name = assembly_report_file_name + ".part"
+            if os.path.exists(partial_file_name):
+                os.remove(partial_file_name)
+            wget.download(asm.assembly_report_url, out=partial_file_name)
+            os.rename(partial_file_name, assembly_report_file_name)
+        return assembly_report_file_name
+
+    def add_assembly_report(self, assembly_accession, assembly_report_file_name):
+        """Index the Genbank and RefSeq accessions listed in the assembly report, replacing any previous entries"""
+        contigs = set()
+        for _, genbank_accession, _, refseq_accession in get_assembly_report_rows(assembly_report_file_name):
+            for accession in (genbank_accession.strip(), refseq_accession.strip()):
+                if accession and accession != "na":
+                    # Accessions are also indexed without their version so that they can be looked up either way
+                    contigs.update((accession, accession.rsplit(".", 1)[0]))
+        with self.connection:
+            self.connection.execute('DELETE FROM contig_assembly WHERE assembly_accession = ?', (assembly_accession,))
+            self.connection.executemany('INSERT INTO contig_assembly (contig_accession, assembly_accession) '
+                                        'VALUES (?, ?)', [(contig, assembly_accession) for contig in sorted(contigs)])
+            self.connection.execute('INSERT OR REPLACE INTO indexed_assembly (assembly_accession, report_file, '
+                                    'num_contigs, indexed_at) VALUES (?, ?, ?, ?)',
+                                    (assembly_accession, assembly_report_file_name, len(contigs), time.time()))
+        return len(contigs)
+
+    def index_assemblies(self, assembly_accessions: Iterable[str]):
+        """Index the assemblies not indexed yet. Return the assemblies whose report could not be obtained."""
+        failed_assemblies = []
+        for assembly_accession in assembly_accessions:
+            if self.is_indexed(assembly_accession):
+                continue
+            try:
+                num_contigs = self.add_assembly_report(assembly_accession, self.get_assembly_report(assembly_accession))
+                logger.info(f"Indexed {num_contigs} contigs of assembly {assembly_accession}")
+            except Exception as ex:
+                logger.error(f"Could not index assembly report for {assembly_accession} due to: " + ex.__str__())
+                failed_assemblies.append(assembly_accession)
+        return failed_assemblies
+
+    def get_assemblies_for_contigs(self, contig_accessions: Iterable[str],
+                                   assembly_accessions: Iterable[str] = None) -> Dict[str, List[str]]:
+        """
+        Return, for each contig, the sorted accessions of the indexed assemblies whose report lists it, optionally
+        restricted to the assemblies provided
+        """
+        contig_accessions = list(dict.fromkeys(contig_accessions))
+        assemblies_to_keep = set(assembly_accessions) if assembly_accessions is not None else None
+        assemblies_per_contig = defaultdict(list)
+        for start in range(0, len(contig_accessions), lookup_batch_size):
+            batch = contig_accessions[start:start + lookup_batch_size]
+            for contig_accession, assembly_accession in self.connection.execute(
+                    'SELECT contig_accession, assembly_accession FROM contig_assembly WHERE contig_accession IN '
+                    f'({", ".join("?" * len(batch))}) ORDER BY contig_accession, assembly_accession', batch):
+                if assemblies_to_keep is None or assembly_accession in assemblies_to_keep:
+                    assemblies_per_contig[contig_accession].append(assembly_accession)
+        return {contig_accession: assemblies_per_contig[contig_accession] for contig_accession in contig_accessions}
+
+    def close(self):
+        self.connection.close()
@@ -16,19 +16,18 @@
 # is present and insert it into a table
 
 from Bio import Entrez
-from ebi_eva_common_pyutils.assembly import NCBIAssembly
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.pg_utils import execute_query
-from typing import List
+from collections import defaultdict
+from typing import Dict, List
 
 import argparse
-import os
 import psycopg2
 import psycopg2.extras
 import sys
-import wget
+
+from tasks.eva_2469.contig_assembly_index import ContigAssemblyIndex
 
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
@@ -38,6 +37,10 @@ Entrez.tool = "eva"
 
 contig_analysis_table_name = "eva_tasks.eva2469_contig_analysis"
 possible_assemblies_table_name = "eva_tasks.eva2469_possible_assemblies_for_contigs"
+# Number of assembly ids summarised per EUtils request
+esummary_batch_size = 200
+# Assemblies of each taxonomy already retrieved from EUtils in this run
+assemblies_per_taxonomy = {}
 
 
 def create_table_to_collect_possible_assemblies(private_config_xml_file):
@@ -64,45 +67,60 @@ def insert_possible_assemblies_for_contig(metadata_connection_handle, contig_acc
             metadata_connection_handle.commit()
 
 
-def _does_contig_exist_in_assembly(contig_accession: str, assembly_accession: str):
-    logger.info(f"Obtaining assembly report for {assembly_accession}...")
-    asm = NCBIAssembly(assembly_accession, species_scientific_name=None,
-                       reference_directory=None)
-    try:
-        assembly_report_file_name = os.path.basename(asm.assembly_report_url)
-        os.system("rm -f " + assembly_report_file_name)
-        wget.download(asm.assembly_report_url)
-        output = run_command_with_output(f"Checking if contig {contig_accession} exists in assembly {assembly_accession}",
-                                         f'grep -w "{contig_accession}" "{assembly_report_file_name}" | cat',
-                                         return_process_output=True)
-        return output.strip() != ""
-    except Exception as ex:
-        logger.error(f"Could not download assembly report for {assembly_accession} due to: " + ex.__str__())
-        return False
-
+def _get_assembly_accessions_for_ids(assembly_ids: List[str]) -> List[str]:
+    assembly_accessions = []
+    for start in range(0, len(assembly_ids), esummary_batch_size):
+        assembly_results_handle = Entrez.esummary(db="assembly",
+                                                  id=",".join(assembly_ids[start:start + esummary_batch_size]),
+                                                  report="full")
+        assembly_results = Entrez.read(assembly_results_handle)
+        assembly_accessions.extend(document_summary["Synonym"]["Genbank"]
+                                   for document_summary in assembly_results["DocumentSummarySet"]["DocumentSummary"])
+    return [accession for accession in assembly_accessions if accession.strip() != ""]
 
-def _get_assembly_accession_for_id(assembly_id: str):
-    assembly_results_handle = Entrez.esummary(db="assembly", id=assembly_id, report="full")
-    assembly_results = Entrez.read(assembly_results_handle)
-    return assembly_results["DocumentSummarySet"]["DocumentSummary"][0]["Synonym"]["Genbank"]
 
-
-def get_assemblies_where_contig_appears(contig_accession: str) -> List[str]:
+def get_taxonomy_for_contig(contig_accession: str):
     contig_results_handle = Entrez.esummary(db="nuccore", id=contig_accession)
     contig_results = list(Entrez.parse(contig_results_handle))
     if len(contig_results) == 0:
         logger.error(f"No records returned for contig {contig_accession} when querying with eutils!")
-        return []
+        return None
     if len(contig_results) > 1:
         logger.error(f"More than one record returned for contig {contig_accession} when querying with eutils!")
-        return []
-
-    taxonomy_id = int.__repr__(contig_results[0]['TaxId'])
-    assembly_results = Entrez.read(Entrez.esearch(db="assembly", term=f"txid{taxonomy_id}", retmax=100000))
-    assemblies_to_check = filter(lambda accession: accession.strip() != "",  [_get_assembly_accession_for_id(assembly_id)
-                                  for assembly_id in assembly_results["IdList"]])
-    return list(filter(lambda assembly_accession: _does_contig_exist_in_assembly(contig_accession, assembly_accession),
-                       assemblies_to_check))
+        return None
+    return int.__repr__(contig_results[0]['TaxId'])
+
+
+def get_assemblies_for_taxonomy(taxonomy_id: str) -> List[str]:
+    if taxonomy_id not in assemblies_per_taxonomy:
+        assembly_results = Entrez.read(Entrez.esearch(db="assembly", term=f"txid{taxonomy_id}", retmax=100000))
+        assemblies_per_taxonomy[taxonomy_id] = _get_assembly_accessions_for_ids(assembly_results["IdList"])
+    return assemblies_per_taxonomy[taxonomy_id]
+
+
+def get_assemblies_where_contigs_appear(contig_accessions: List[str],
+                                        contig_index: ContigAssemblyIndex) -> Dict[str, List[str]]:
+    """
+    Look up, for each contig, the assemblies of its taxonomy whose assembly report lists it. The assemblies of each
+    taxonomy are indexed once and the contigs are then resolved against the local index.
+    """
+    assemblies_per_contig = {}
+    contigs_per_taxonomy = defaultdict(list)
+    for contig_accession in contig_accessions:
+        taxonomy_id = get_taxonomy_for_contig(contig_accession)
+        if taxonomy_id is None:
+            assemblies_per_contig[contig_accession] = []
+        else:
+            contigs_per_taxonomy[taxonomy_id].append(contig_accession)
+    for taxonomy_id, taxonomy_contigs in contigs_per_taxonomy.items():
+        assemblies_to_check = get_assemblies_for_taxonomy(taxonomy_id)
+        contig_index.index_assemblies(assemblies_to_check)
+        assemblies_per_contig.update(contig_index.get_assemblies_for_contigs(taxonomy_contigs, assemblies_to_check))
+    return assemblies_per_contig
+
+
+def get_assemblies_where_contig_appears(contig_accession: str, contig_index: ContigAssemblyIndex) -> List[str]:
+    return get_assemblies_where_contigs_appear([contig_accession], contig_index)[contig_accession]
 
 
 def main():
@@ -111,18 +129,28 @@ def main():
     parser.add_argument("--private-config-xml-file",
                         help="Full path to private configuration file (ex: /path/to/settings.xml)", required=True)
     parser.add_argument("--eutils-api-key", help="EUtils API key", required=True)
+    parser.add_argument("--contig-index-file", help="SQLite file holding the contig to assembly index",
+                        default="contig_assembly_index.sqlite")
+    parser.add_argument("--assembly-report-dir", help="Directory where the assembly reports indexed are kept",
+                        default="assembly_reports")
+    parser.add_argument("--batch-size", help="Number of contigs resolved together", type=int, default=1000)
     args = parser.parse_args()
 
     Entrez.api_key = args.eutils_api_key
     create_table_to_collect_possible_assemblies(args.private_config_xml_file)
+    contig_index = ContigAssemblyIndex(args.contig_index_file, args.assembly_report_dir)
+    contig_accessions = list(dict.fromkeys(line.strip() for line in sys.stdin if line.strip()))
     with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", args.private_config_xml_file),
                           user="evadev") \
             as metadata_connection_handle:
-        for contig_accession in sys.stdin:
-            contig_accession = contig_accession.strip()
-            logger.info(f"Getting possible assemblies for {contig_accession} from EUtils...")
-            possible_assemblies = get_assemblies_where_contig_appears(contig_accession)
-            insert_possible_assemblies_for_contig(metadata_connection_handle, contig_accession, possible_assemblies)
+        for start in range(0, len(contig_accessions), args.batch_size):
+            batch = contig_accessions[start:start + args.batch_size]
+            logger.info(f"Getting possible assemblies for {len(batch)} contigs starting with {batch[0]}...")
+            for contig_accession, possible_assemblies in \
+                    get_assemblies_where_contigs_appear(batch, contig_index).items():
+                insert_possible_assemblies_for_contig(metadata_connection_handle, contig_accession,
+                                                      possible_assemblies)
+    contig_index.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import time
+
+import psycopg2.extras
+from psycopg2 import sql
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+
+class BulkStatsLoader:
+    """
+    Stage rows for a statistics table and write them with a single parameterised multi-row insert.
+    Rows sharing the key columns with existing rows replace them: the existing rows are deleted in the same transaction
+    so that the key columns do not need a unique constraint. Without key columns the rows are plainly inserted.
+    The loader uses the connection it is given and commits once per flush.
+    """
+
+    def __init__(self, connection, table_name, columns, key_columns=None, page_size=1000):
+        self.connection = connection
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.key_columns = list(key_columns) if key_columns else []
+        self.page_size = page_size
+        self.rows = []
+
+    def add(self, row):
+        """Stage a row provided either as a dict keyed by column name or as a sequence in the column order"""
+        if isinstance(row, dict):
+            row = tuple(row[column] for column in self.columns)
+        elif len(row) != len(self.columns):
+            raise ValueError(f'Expected {len(self.columns)} values for {self.table_name} but got {len(row)}: {row}')
+        self.rows.append(tuple(row))
+
+    @property
+    def _table(self):
+        return sql.Identifier(*self.table_name.split('.'))
+
+    def _delete_query(self):
+        return sql.SQL('DELETE FROM {table} WHERE ({keys}) IN (VALUES %s)').format(
+            table=self._table, keys=sql.SQL(', ').join(sql.Identifier(column) for column in self.key_columns)
+        )
+
+    def _insert_query(self):
+        return sql.SQL('INSERT INTO {table} ({columns}) VALUES %s').format(
+            table=self._table, columns=sql.SQL(', ').join(sql.Identifier(column) for column in self.columns)
+        )
+
+    def flush(self):
+        """Write all the staged rows in one transaction and return the number of rows written"""
+        if not self.rows:
+            return 0
+        start_time = time.perf_counter()
+        with self.connection.cursor() as cursor:
+            if self.key_columns:
+                key_indices = [self.columns.index(column) for column in self.key_columns]
+                keys = list(dict.fromkeys(tuple(row[i] for i in key_indices) for row in self.rows))
+                psycopg2.extras.execute_values(cursor, self._delete_query(), keys, page_size=self.page_size)
+            psycopg2.extras.execute_values(cursor, self._insert_query(), self.rows, page_size=self.page_size)
+        self.connection.commit()
+        num_rows = len(self.rows)
+        self.rows = []
+        logger.info(f'Loaded {num_rows} rows in {self.table_name} in {time.perf_counter() - start_time:.2f}s')
+        return num_rows
@@ -2,27 +2,30 @@ import argparse
 import glob
 import os
 import psycopg2
+from psycopg2 import sql
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
-from ebi_eva_common_pyutils.pg_utils import execute_query, get_all_results_for_query
+
+from tasks.eva_2750.bulk_stats_loader import BulkStatsLoader
 
 
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
 
-def gather_count_from_mongo(clustering_dir, mongo_source, private_config_xml_file):
+def gather_count_from_mongo(clustering_dir, mongo_source, private_config_xml_file, num_workers=4):
     # Assume the directory structure:
     # clustering_dir --> <scientific_name_taxonomy_id> --> <assembly_accession> --> cluster_<date>.log_dict
 
     all_log_pattern = os.path.join(clustering_dir, '*', 'GCA_*', 'cluster_*.log')
     all_log_files = glob.glob(all_log_pattern)
     ranges_per_assembly = get_assembly_info_and_date_ranges(all_log_files)
-    metrics_per_assembly = get_metrics_per_assembly(mongo_source, ranges_per_assembly)
+    metrics_per_assembly = get_metrics_per_assembly(mongo_source, ranges_per_assembly, num_workers)
     insert_counts_in_db(private_config_xml_file, metrics_per_assembly, ranges_per_assembly)
 
 
@@ -88,201 +91,185 @@ def get_assembly_info_and_date_ranges(all_log_files):
     return ranges_per_assembly
 
 
-def get_metrics_per_assembly(mongo_source, ranges_per_assembly):
+def get_metrics_per_assembly(mongo_source, ranges_per_assembly, num_workers=4):
     """
-    Perform queries to mongodb to get counts based on the date ranges for the different metrics
+    Perform queries to mongodb to get counts based on the date ranges for the different metrics.
+    The assemblies are queried concurrently.
     """
     metrics_per_assembly = defaultdict(dict)
-    for asm, asm_dict in ranges_per_assembly.items():
-        new_remapped_current_rs, new_clustered_current_rs, merged_rs, split_rs, new_ss_clustered = 0, 0, 0, 0, 0
-        for metric, log_dict in asm_dict['metrics'].items():
-            expressions = []
-            for log_name, query_range in log_dict.items():
-                expressions.append({"createdDate": {"$gt": query_range["from"], "$lt": query_range["to"]}})
-
-            date_range_filter = expressions
-            if metric == 'new_remapped_current_rs':
-                filter_criteria = {'asm': asm, '$or': date_range_filter}
-                new_remapped_current_rs = query_mongo(mongo_source, filter_criteria, metric)
-                logger.info(f'{metric} = {new_remapped_current_rs}')
-            elif metric == 'new_clustered_current_rs':
-                filter_criteria = {'asm': asm, '$or': date_range_filter}
-                new_clustered_current_rs = query_mongo(mongo_source, filter_criteria, metric)
-                logger.info(f'{metric} = {new_clustered_current_rs}')
-            elif metric == 'merged_rs':
-                filter_criteria = {'inactiveObjects.asm': asm, 'eventType': 'MERGED',
-                                   '$or': date_range_filter}
-                merged_rs = query_mongo(mongo_source, filter_criteria, metric)
-                logger.info(f'{metric} = {merged_rs}')
-            elif metric == 'split_rs':
-                filter_criteria = {'inactiveObjects.asm': asm, 'eventType': 'RS_SPLIT',
-                                   '$or': date_range_filter}
-                split_rs = query_mongo(mongo_source, filter_criteria, metric)
-                logger.info(f'{metric} = {split_rs}')
-            elif metric == 'new_ss_clustered':
-                filter_criteria = {'inactiveObjects.seq': asm, 'eventType': 'UPDATED',
-                                   '$or': date_range_filter}
-                new_ss_clustered = query_mongo(mongo_source, filter_criteria, metric)
-                logger.info(f'{metric} = {new_ss_clustered}')
-
-        metrics_per_assembly[asm]["assembly_accession"] = asm
-        metrics_per_assembly[asm]["new_remapped_current_rs"] = new_remapped_current_rs
-        metrics_per_assembly[asm]["new_clustered_current_rs"] = new_clustered_current_rs
-        metrics_per_assembly[asm]["merged_rs"] = merged_rs
-        metrics_per_assembly[asm]["split_rs"] = split_rs
-        metrics_per_assembly[asm]["new_ss_clustered"] = new_ss_clustered
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(get_metrics_for_assembly, mongo_source, asm, asm_dict['metrics']): asm
+                   for asm, asm_dict in ranges_per_assembly.items()}
+        for future in as_completed(futures):
+            asm = futures[future]
+            metrics_per_assembly[asm]["assembly_accession"] = asm
+            metrics_per_assembly[asm].update(future.result())
     return metrics_per_assembly
 
 
-def query_mongo(mongo_source, filter_criteria, metric):
-    total_count = 0
-    for collection_name in collections[metric]:
-        logger.info(f'Querying mongo: db.{collection_name}.countDocuments({filter_criteria})')
+def get_metrics_for_assembly(mongo_source, asm, metric_ranges):
+    """
+    Count all the metrics of one assembly with a single aggregation per collection. The aggregation selects the
+    documents of the assembly created in any of the date ranges of the metrics counted in this collection, then counts
+    the documents of each metric in one $group.
+    """
+    metrics = {metric: 0 for metric in collections}
+    metrics_per_collection = defaultdict(list)
+    for metric, log_dict in metric_ranges.items():
+        if log_dict:
+            for collection_name in collections[metric]:
+                metrics_per_collection[collection_name].append(metric)
+
+    for collection_name, collection_metrics in metrics_per_collection.items():
+        # All the metrics counted in one collection select the assembly with the same attribute
+        assembly_attribute = metric_filters[collection_metrics[0]]['assembly_attribute']
+        metric_conditions = {}
+        for metric in collection_metrics:
+            date_ranges = metric_ranges[metric].values()
+            condition = {"$or": [{"createdDate": {"$gt": query_range["from"], "$lt": query_range["to"]}}
+                                 for query_range in date_ranges]}
+            expression = {"$or": [{"$and": [{"$gt": ["$createdDate", query_range["from"]]},
+                                            {"$lt": ["$createdDate", query_range["to"]]}]}
+                                  for query_range in date_ranges]}
+            if metric_filters[metric]['event_type']:
+                condition['eventType'] = metric_filters[metric]['event_type']
+                expression = {"$and": [{"$eq": ["$eventType", metric_filters[metric]['event_type']]}, expression]}
+            metric_conditions[metric] = (condition, expression)
+
+        pipeline = [
+            {"$match": {assembly_attribute: asm,
+                        "$or": [condition for condition, _ in metric_conditions.values()]}},
+            {"$group": dict({"_id": None}, **{
+                metric: {"$sum": {"$cond": [expression, 1, 0]}}
+                for metric, (_, expression) in metric_conditions.items()
+            })}
+        ]
+        logger.info(f'Querying mongo: db.{collection_name}.aggregate({pipeline})')
         collection = mongo_source.mongo_handle[mongo_source.db_name][collection_name]
-        count = collection.count_documents(filter_criteria)
-        total_count += count
-        logger.info(f'{count}')
-    return total_count
+        counts = next(collection.aggregate(pipeline, allowDiskUse=True), {})
+        for metric in collection_metrics:
+            metrics[metric] += counts.get(metric, 0)
+        logger.info(f'{asm} {collection_name}: {({metric: counts.get(metric, 0) for metric in collection_metrics})}')
+    logger.info(f'Metrics for {asm}: {metrics}')
+    return metrics
+
+
+RELEASE_STATISTICS_TABLE = 'dbsnp_ensembl_species.release_rs_statistics_per_assembly'
+RELEASE_STATISTICS_COLUMNS = [
+    'taxonomy_id', 'scientific_name', 'assembly_accession', 'release_folder', 'release_version', 'current_rs',
+    'multi_mapped_rs', 'merged_rs', 'deprecated_rs', 'merged_deprecated_rs', 'new_current_rs', 'new_multi_mapped_rs',
+    'new_merged_rs', 'new_deprecated_rs', 'new_merged_deprecated_rs', 'new_ss_clustered', 'remapped_current_rs',
+    'new_remapped_current_rs', 'split_rs', 'new_split_rs', 'ss_clustered', 'clustered_current_rs',
+    'new_clustered_current_rs'
+]
+RELEASE_STATISTICS_KEY = ['taxonomy_id', 'assembly_accession', 'release_version']
+
+
+def get_release_statistics(metadata_connection_handle, release_version):
+    """Retrieve the statistics of every assembly in one release as dicts keyed by column name"""
+    query = sql.SQL('select {columns} from {table} where release_version = %s').format(
+        columns=sql.SQL(', ').join(sql.Identifier(column) for column in RELEASE_STATISTICS_COLUMNS),
+        table=sql.Identifier(*RELEASE_STATISTICS_TABLE.split('.'))
+    )
+    with metadata_connection_handle.cursor() as cursor:
+        cursor.execute(query, (release_version,))
+        return [dict(zip(RELEASE_STATISTICS_COLUMNS, row)) for row in cursor]
+
+
+def get_ss_clustered_before_release(metadata_connection_handle, release_version):
+    """Sum the new_ss_clustered of all the releases preceding release_version for every assembly"""
+    query = sql.SQL('select assembly_accession, sum(new_ss_clustered) from {table} '
+                    'where release_version < %s group by assembly_accession').format(
+        table=sql.Identifier(*RELEASE_STATISTICS_TABLE.split('.'))
+    )
+    with metadata_connection_handle.cursor() as cursor:
+        cursor.execute(query, (release_version,))
+        return dict(cursor.fetchall())
 
 
 def insert_counts_in_db(private_config_xml_file, metrics_per_assembly, ranges_per_assembly):
+    release_version = 3
     with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file), user="evadev") \
             as metadata_connection_handle:
-        for asm in metrics_per_assembly:
-            # get last release data for assembly
-            query_release2 = f"select * from dbsnp_ensembl_species.release_rs_statistics_per_assembly "\
-                             f"where assembly_accession = '{asm}' and release_version = 2"
-            logger.info(query_release2)
-            asm_last_release_data = get_all_results_for_query(metadata_connection_handle, query_release2)
-
-            # insert data for release 3
-            taxid = ranges_per_assembly[asm]['taxid']
-            scientific_name = ranges_per_assembly[asm]['scientific_name'].capitalize().replace('_', ' ')
-            folder = f"{ranges_per_assembly[asm]['scientific_name']}/{asm}"
-            release_version = 3
-
-            release3_new_remapped_current_rs = metrics_per_assembly[asm]['new_remapped_current_rs']
-
-            release3_new_clustered_current_rs = metrics_per_assembly[asm]['new_clustered_current_rs']
-            release3_new_current_rs = release3_new_clustered_current_rs + release3_new_remapped_current_rs
-
-            release3_new_merged_rs = metrics_per_assembly[asm]['merged_rs']
-            release3_new_split_rs = metrics_per_assembly[asm]['split_rs']
-            release3_new_ss_clustered = metrics_per_assembly[asm]['new_ss_clustered']
-
-            insert_query = f"insert into dbsnp_ensembl_species.release_rs_statistics_per_assembly "\
-                           f"(taxonomy_id, scientific_name, assembly_accession, release_folder, release_version, " \
-                           f"current_rs, multi_mapped_rs, merged_rs, deprecated_rs, merged_deprecated_rs, " \
-                           f"new_current_rs, new_multi_mapped_rs, new_merged_rs, new_deprecated_rs, " \
-                           f"new_merged_deprecated_rs, new_ss_clustered, remapped_current_rs, " \
-                           f"new_remapped_current_rs, split_rs, new_split_rs, ss_clustered, clustered_current_rs," \
-                           f"new_clustered_current_rs) " \
-                           f"values ({taxid}, '{scientific_name}', '{asm}', '{folder}', {release_version}, " \
-
-            if asm_last_release_data:
-                release2_current_rs = asm_last_release_data[0][5]
-                release2_merged_rs = asm_last_release_data[0][7]
-                release2_multi_mapped_rs = asm_last_release_data[0][6]
-                release2_deprecated_rs = asm_last_release_data[0][8]
-                release2_merged_deprecated_rs = asm_last_release_data[0][9]
-
-                # get ss clustered
-                query_ss_clustered = f"select sum(new_ss_clustered) " \
-                                     f"from dbsnp_ensembl_species.release_rs_statistics_per_assembly " \
-                                     f"where assembly_accession = '{asm}'"
-                logger.info(query_ss_clustered)
-                ss_clustered_previous_releases = get_all_results_for_query(metadata_connection_handle,
-                                                                           query_ss_clustered)
-                release3_ss_clustered = ss_clustered_previous_releases[0][0] + release3_new_ss_clustered
+        # Previous releases are read before anything is written so that the statistics loaded are the same when the
+        # script is run again
+        last_release_statistics = get_release_statistics(metadata_connection_handle, release_version - 1)
+        last_release_statistics_per_assembly = {}
+        for last_release in last_release_statistics:
+            last_release_statistics_per_assembly.setdefault(last_release['assembly_accession'], last_release)
+        ss_clustered_previous_releases = get_ss_clustered_before_release(metadata_connection_handle, release_version)
+        loader = BulkStatsLoader(metadata_connection_handle, RELEASE_STATISTICS_TABLE, RELEASE_STATISTICS_COLUMNS,
+                                 key_columns=RELEASE_STATISTICS_KEY)
 
+        for asm in metrics_per_assembly:
+            new_remapped_current_rs = metrics_per_assembly[asm]['new_remapped_current_rs']
+            new_clustered_current_rs = metrics_per_assembly[asm]['new_clustered_current_rs']
+            new_current_rs = new_clustered_current_rs + new_remapped_current_rs
+            new_merged_rs = metrics_per_assembly[asm]['merged_rs']
+            new_split_rs = metrics_per_assembly[asm]['split_rs']
+            new_ss_clustered = metrics_per_assembly[asm]['new_ss_clustered']
+
+            statistics = {
+                'taxonomy_id': ranges_per_assembly[asm]['taxid'],
+                'scientific_name': ranges_per_assembly[asm]['scientific_name'].capitalize().replace('_', ' '),
+                'assembly_accession': asm,
+                'release_folder': f"{ranges_per_assembly[asm]['scientific_name']}/{asm}",
+                'release_version': release_version,
+                'new_current_rs': new_current_rs,
+                'new_multi_mapped_rs': 0,
+                'new_merged_rs': new_merged_rs,
+                'new_deprecated_rs': 0,
+                'new_merged_deprecated_rs': 0,
+                'new_ss_clustered': new_ss_clustered,
+                'remapped_current_rs': new_remapped_current_rs,
+                'new_remapped_current_rs': new_remapped_current_rs,
+                'split_rs': new_split_rs,
+                'new_split_rs': new_split_rs,
+                'new_clustered_current_rs': new_clustered_current_rs
+            }
+            if asm in last_release_statistics_per_assembly:
                 # if assembly already existed -> add counts
-                release3_current_rs = release2_current_rs + release3_new_current_rs
-                release3_merged_rs = release2_merged_rs + release3_new_merged_rs
-                # current_rs in previous releases (1 and 2) were all new clustered
-                release3_clustered_current_rs = release2_current_rs + release3_new_clustered_current_rs
-
-                insert_query_values = f"{release3_current_rs}, " \
-                                      f"{release2_multi_mapped_rs}, " \
-                                      f"{release3_merged_rs}, " \
-                                      f"{release2_deprecated_rs}, " \
-                                      f"{release2_merged_deprecated_rs}, " \
-                                      f"{release3_new_current_rs}, " \
-                                      f"0, " \
-                                      f"{release3_new_merged_rs}, " \
-                                      f"0, " \
-                                      f"0, " \
-                                      f"{release3_new_ss_clustered}, " \
-                                      f"{release3_new_remapped_current_rs}, " \
-                                      f"{release3_new_remapped_current_rs}, " \
-                                      f"{release3_new_split_rs}, " \
-                                      f"{release3_new_split_rs}, " \
-                                      f"{release3_ss_clustered}," \
-                                      f"{release3_clustered_current_rs}," \
-                                      f"{release3_new_clustered_current_rs})"
+                last_release = last_release_statistics_per_assembly[asm]
+                statistics.update({
+                    'current_rs': last_release['current_rs'] + new_current_rs,
+                    'multi_mapped_rs': last_release['multi_mapped_rs'],
+                    'merged_rs': last_release['merged_rs'] + new_merged_rs,
+                    'deprecated_rs': last_release['deprecated_rs'],
+                    'merged_deprecated_rs': last_release['merged_deprecated_rs'],
+                    'ss_clustered': ss_clustered_previous_releases[asm] + new_ss_clustered,
+                    # current_rs in previous releases (1 and 2) were all new clustered
+                    'clustered_current_rs': last_release['current_rs'] + new_clustered_current_rs
+                })
             else:
                 # if new assembly
-                insert_query_values = f"{release3_new_current_rs}, " \
-                                      f"0, " \
-                                      f"{release3_new_merged_rs}, " \
-                                      f"0, " \
-                                      f"0, " \
-                                      f"{release3_new_current_rs}, " \
-                                      f"0, " \
-                                      f"{release3_new_merged_rs}, " \
-                                      f"0, " \
-                                      f"0, " \
-                                      f"{release3_new_ss_clustered}, " \
-                                      f"{release3_new_remapped_current_rs}, " \
-                                      f"{release3_new_remapped_current_rs}, " \
-                                      f"{release3_new_split_rs}, " \
-                                      f"{release3_new_split_rs}, " \
-                                      f"{release3_new_ss_clustered}," \
-                                      f"{release3_new_clustered_current_rs}," \
-                                      f"{release3_new_clustered_current_rs})"
-            insert_query = f"{insert_query} {insert_query_values}"
-            logger.info(insert_query)
-            execute_query(metadata_connection_handle, insert_query)
-
-        # get assemblies in from release 1 and 2 not in release 3
-        assemblies_in_logs = ",".join(f"'{a}'" for a in ranges_per_assembly.keys())
-        query_missing_assemblies_stats = f"select * " \
-                                         f"from dbsnp_ensembl_species.release_rs_statistics_per_assembly " \
-                                         f"where release_version = 2 " \
-                                         f"and assembly_accession not in ({assemblies_in_logs});"
-        logger.info(query_missing_assemblies_stats)
-        missing_assemblies_stats = get_all_results_for_query(metadata_connection_handle, query_missing_assemblies_stats)
-        for assembly_stats in missing_assemblies_stats:
-            taxonomy_id = assembly_stats[0]
-            scientific_name = assembly_stats[1]
-            assembly_accession = assembly_stats[2]
-            release_folder = assembly_stats[3]
-            current_rs = assembly_stats[5]
-            multi_mapped_rs = assembly_stats[6]
-            merged_rs = assembly_stats[7]
-            deprecated_rs = assembly_stats[8]
-            merged_deprecated_rs = assembly_stats[9]
-
-            # get ss clustered
-            query_ss_clustered = f"select sum(new_ss_clustered) " \
-                                 f"from dbsnp_ensembl_species.release_rs_statistics_per_assembly " \
-                                 f"where assembly_accession = '{assembly_accession}'"
-            logger.info(query_ss_clustered)
-            ss_clustered_previous_releases = get_all_results_for_query(metadata_connection_handle,
-                                                                       query_ss_clustered)
-            ss_clustered = ss_clustered_previous_releases[0][0]
-
-            insert_query = f"insert into dbsnp_ensembl_species.release_rs_statistics_per_assembly "\
-                           f"(taxonomy_id, scientific_name, assembly_accession, release_folder, release_version, " \
-                           f"current_rs, multi_mapped_rs, merged_rs, deprecated_rs, merged_deprecated_rs, " \
-                           f"new_current_rs, new_multi_mapped_rs, new_merged_rs, new_deprecated_rs, " \
-                           f"new_merged_deprecated_rs, new_ss_clustered, remapped_current_rs, " \
-                           f"new_remapped_current_rs, split_rs, new_split_rs, ss_clustered, clustered_current_rs, " \
-                           f"new_clustered_current_rs) " \
-                           f"values ({taxonomy_id}, '{scientific_name}', '{assembly_accession}', '{release_folder}', " \
-                           f"3, {current_rs}, {multi_mapped_rs}, {merged_rs}, {deprecated_rs}, " \
-                           f"{merged_deprecated_rs}, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, {ss_clustered}, 0, 0);"
-            logger.info(insert_query)
-            execute_query(metadata_connection_handle, insert_query)
+                statistics.update({
+                    'current_rs': new_current_rs,
+                    'multi_mapped_rs': 0,
+                    'merged_rs': new_merged_rs,
+                    'deprecated_rs': 0,
+                    'merged_deprecated_rs': 0,
+                    'ss_clustered': new_ss_clustered,
+                    'clustered_current_rs': new_clustered_current_rs
+                })
+            logger.info(f'Statistics for {asm} in release {release_version}: {statistics}')
+            loader.add(statistics)
+
+        # carry over the assemblies from the last release that are not in this release
+        for last_release in last_release_statistics:
+            assembly_accession = last_release['assembly_accession']
+            if assembly_accession in ranges_per_assembly:
+                continue
+            statistics = {column: 0 for column in RELEASE_STATISTICS_COLUMNS}
+            statistics.update({column: last_release[column] for column in (
+                'taxonomy_id', 'scientific_name', 'assembly_accession', 'release_folder', 'current_rs',
+                'multi_mapped_rs', 'merged_rs', 'deprecated_rs', 'merged_deprecated_rs'
+            )})
+            statistics['release_version'] = release_version
+            statistics['ss_clustered'] = ss_clustered_previous_releases.get(assembly_accession)
+            logger.info(f'Statistics for {assembly_accession} carried over to release {release_version}: {statistics}')
+            loader.add(statistics)
+
+        loader.flush()
 
 
 collections = {
@@ -308,6 +295,16 @@ collections = {
 }
 
 
+# How the documents counted for each metric are selected in addition to their creation date
+metric_filters = {
+    "new_remapped_current_rs": {"assembly_attribute": "asm", "event_type": None},
+    "new_clustered_current_rs": {"assembly_attribute": "asm", "event_type": None},
+    "merged_rs": {"assembly_attribute": "inactiveObjects.asm", "event_type": "MERGED"},
+    "split_rs": {"assembly_attribute": "inactiveObjects.asm", "event_type": "RS_SPLIT"},
+    "new_ss_clustered": {"assembly_attribute": "inactiveObjects.seq", "event_type": "UPDATED"}
+}
+
+
 def parse_log_file_path(log_file_path):
     scientific_name_taxonomy_id, assembly_accession, file_name = log_file_path.split('/')[-3:]
     scientific_name = '_'.join(scientific_name_taxonomy_id.split('_')[:-1])
@@ -365,11 +362,12 @@ def main():
                         help="Full path to the Mongo Source secrets file (ex: /path/to/mongo/source/secret)",
                         required=True)
     parser.add_argument('--private_config_xml_file', help='Path to the file containing the ', required=True)
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of assemblies queried concurrently')
 
     args = parser.parse_args()
     mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
                                  db_name="eva_accession_sharded")
-    gather_count_from_mongo(args.clustering_root_path, mongo_source, args.private_config_xml_file)
+    gather_count_from_mongo(args.clustering_root_path, mongo_source, args.private_config_xml_file, args.num_workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+import random
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
+
+from tasks.eva_2750.gather_clustering_counts_from_mongo import get_metrics_for_assembly, get_metrics_per_assembly, \
+    collections
+
+ASSEMBLIES = ['GCA_000001215.4', 'GCA_000002315.5', 'GCA_000003025.6']
+START_DATE = datetime(2021, 1, 1)
+
+
+def count_documents_per_metric(mongo_source, asm, metric_ranges):
+    """Count the metrics of an assembly with one count_documents per metric and collection, as was done before"""
+    assembly_filters = {
+        'new_remapped_current_rs': {'asm': asm},
+        'new_clustered_current_rs': {'asm': asm},
+        'merged_rs': {'inactiveObjects.asm': asm, 'eventType': 'MERGED'},
+        'split_rs': {'inactiveObjects.asm': asm, 'eventType': 'RS_SPLIT'},
+        'new_ss_clustered': {'inactiveObjects.seq': asm, 'eventType': 'UPDATED'}
+    }
+    metrics = {metric: 0 for metric in collections}
+    for metric, log_dict in metric_ranges.items():
+        filter_criteria = dict(assembly_filters[metric], **{'$or': [
+            {'createdDate': {'$gt': query_range['from'], '$lt': query_range['to']}}
+            for query_range in log_dict.values()
+        ]})
+        for collection_name in collections[metric]:
+            collection = mongo_source.mongo_handle[mongo_source.db_name][collection_name]
+            metrics[metric] += collection.count_documents(filter_criteria)
+    return metrics
+
+
+class TestGatherClusteringCounts(TestCase):
+
+    def setUp(self) -> None:
+        self.uri = 'mongodb://localhost:27017/'
+        self.db = 'eva_2750_test'
+        self.mongo_source = MongoDatabase(uri=self.uri, db_name=self.db)
+        self.mongo_source.mongo_handle.drop_database(self.db)
+        rng = random.Random(2750)
+        database = self.mongo_source.mongo_handle[self.db]
+
+        def random_date():
+            return START_DATE + timedelta(minutes=rng.randrange(30 * 24 * 60))
+
+        for collection_name in ('clusteredVariantEntity', 'dbsnpClusteredVariantEntity'):
+            database[collection_name].insert_many([
+                {'asm': rng.choice(ASSEMBLIES), 'createdDate': random_date()} for _ in range(1000)
+            ])
+        for collection_name in ('clusteredVariantOperationEntity', 'dbsnpClusteredVariantOperationEntity'):
+            database[collection_name].insert_many([
+                {'inactiveObjects': [{'asm': rng.choice(ASSEMBLIES)}], 'createdDate': random_date(),
+                 'eventType': rng.choice(['MERGED', 'RS_SPLIT', 'DEPRECATED'])} for _ in range(1000)
+            ])
+        for collection_name in ('submittedVariantOperationEntity', 'dbsnpSubmittedVariantOperationEntity'):
+            database[collection_name].insert_many([
+                {'inactiveObjects': [{'seq': rng.choice(ASSEMBLIES)}], 'createdDate': random_date(),
+                 'eventType': rng.choice(['UPDATED', 'MERGED'])} for _ in range(1000)
+            ])
+
+        self.ranges_per_assembly = {}
+        for asm in ASSEMBLIES:
+            metric_ranges = {}
+            for metric in collections:
+                metric_ranges[metric] = {}
+                for log_number in range(rng.randint(1, 3)):
+                    range_start = random_date()
+                    metric_ranges[metric][f'cluster_{log_number}.log'] = {
+                        'from': range_start, 'to': range_start + timedelta(days=rng.randint(1, 10))
+                    }
+            self.ranges_per_assembly[asm] = {'metrics': metric_ranges}
+
+    def tearDown(self) -> None:
+        self.mongo_source.mongo_handle.drop_database(self.db)
+        self.mongo_source.mongo_handle.close()
+
+    def test_same_counts_as_count_documents(self):
+        for asm in ASSEMBLIES:
+            metric_ranges = self.ranges_per_assembly[asm]['metrics']
+            expected = count_documents_per_metric(self.mongo_source, asm, metric_ranges)
+            self.assertTrue(all(expected.values()))
+            self.assertEqual(expected, get_metrics_for_assembly(self.mongo_source, asm, metric_ranges))
+
+    def test_documents_matching_several_metrics(self):
+        # With a range covering all the documents, each variant of clusteredVariantEntity is counted in both
+        # new_remapped_current_rs and new_clustered_current_rs, and the operations of clusteredVariantOperationEntity
+        # in merged_rs or split_rs depending on their event type
+        date_range = {'cluster.log': {'from': START_DATE - timedelta(days=1), 'to': START_DATE + timedelta(days=31)}}
+        metric_ranges = {metric: date_range for metric in collections}
+        database = self.mongo_source.mongo_handle[self.db]
+        for asm in ASSEMBLIES:
+            metrics = get_metrics_for_assembly(self.mongo_source, asm, metric_ranges)
+            self.assertEqual(count_documents_per_metric(self.mongo_source, asm, metric_ranges), metrics)
+            num_clustered_variants = database['clusteredVariantEntity'].count_documents({'asm': asm})
+            self.assertEqual(num_clustered_variants, metrics['new_clustered_current_rs'])
+            self.assertEqual(num_clustered_variants + database['dbsnpClusteredVariantEntity'].count_documents(
+                {'asm': asm}), metrics['new_remapped_current_rs'])
+
+    def test_metric_without_ranges(self):
+        asm = ASSEMBLIES[0]
+        metric_ranges = dict(self.ranges_per_assembly[asm]['metrics'], split_rs={})
+        # count_documents rejects the empty $or that the previous function built for a metric without ranges
+        expected = count_documents_per_metric(
+            self.mongo_source, asm, {metric: log_dict for metric, log_dict in metric_ranges.items() if log_dict}
+        )
+        metrics = get_metrics_for_assembly(self.mongo_source, asm, metric_ranges)
+        self.assertEqual(0, metrics['split_rs'])
+        self.assertEqual(expected, metrics)
+
+    def test_metrics_per_assembly(self):
+        metrics_per_assembly = get_metrics_per_assembly(self.mongo_source, self.ranges_per_assembly, num_workers=2)
+        self.assertEqual(sorted(ASSEMBLIES), sorted(metrics_per_assembly))
+        for asm in ASSEMBLIES:
+            expected = count_documents_per_metric(self.mongo_source, asm, self.ranges_per_assembly[asm]['metrics'])
+            expected['assembly_accession'] = asm
+            self.assertEqual(expected, metrics_per_assembly[asm])
@@ -1,16 +1,16 @@
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.metadata_utils import get_metadata_connection_handle
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query, execute_query
 
+from tasks.eva_2770.release_rs_counter import ReleaseRSCounter, count_unmapped, release_files, write_count_log
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
-shell_script_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bash')
-
 species_table_name = 'dbsnp_ensembl_species.release_rs_statistics_per_species'
 assembly_table_name = 'dbsnp_ensembl_species.release_rs_statistics_per_assembly'
 tracker_table_name = 'eva_progress_tracker.clustering_release_tracker'
@@ -76,52 +76,53 @@ def get_taxonomy_and_scientific_name(private_config_xml_file, release_version, s
     return results[0][0], results[0][1]
 
 
-def run_count_script(script_name, species_dir, metric_id):
-    log_file = f'{os.path.basename(species_dir)}_count_{metric_id}_rsid.log'
-    if not os.path.exists(log_file):
-        run_command_with_output(
-            f'Run {script_name}',
-            f'{os.path.join(shell_script_dir, script_name)} {species_dir} {metric_id}'
-        )
-    return log_file
+def count_rs_for_species(counter, species_dir, metric_ids):
+    """Count the RS of the metrics without a count log, write their logs and return the path to all the logs"""
+    species_name = os.path.basename(species_dir)
+    log_files = {metric_id: f'{species_name}_count_{metric_id}_rsid.log' for metric_id in metric_ids}
+    metrics_to_count = [metric_id for metric_id in metric_ids if not os.path.exists(log_files[metric_id])]
+    release_file_metrics = [metric_id for metric_id in metrics_to_count if metric_id in release_files]
+    if release_file_metrics:
+        for metric_id, histogram in counter.count_species(species_dir, release_file_metrics).items():
+            write_count_log(histogram, log_files[metric_id])
+    if 'unmapped' in metrics_to_count:
+        with open(log_files['unmapped'], 'w') as open_file:
+            open_file.write(f'{count_unmapped(species_dir)}\n')
+    return log_files
 
 
-def gather_counts(private_config_xml_file, release_version, release_dir):
+def gather_counts(private_config_xml_file, release_version, release_dir, num_processes=1, memory_limit_mb=4096):
     results = []
-    for species_dir in os.listdir(release_dir):
-        full_species_dir = os.path.join(release_dir, species_dir)
-
-        # Get data from other tables
-        taxid, sci_name = get_taxonomy_and_scientific_name(private_config_xml_file, release_version, species_dir)
-        if not taxid or not sci_name:
-            continue
-        new_ss_clustered = get_new_ss_clustered(private_config_xml_file, release_version, taxid)
-        per_species_results = {
-            'taxonomy_id': taxid,
-            'scientific_name': f"'{sci_name}'",
-            'release_folder': f"'{species_dir}'",
-            'release_version': release_version,
-            'new_ss_clustered': new_ss_clustered
-        }
-
-        # Get metrics from release files
-        for metric_id in id_to_column.keys():
-            if metric_id in {'current', 'merged', 'multimap'}:
-                output_log = run_count_script('count_rs_for_release.sh', full_species_dir, metric_id)
-            elif metric_id in {'deprecated', 'merged_deprecated'}:
-                output_log = run_count_script('count_rs_for_release_for_txt.sh', full_species_dir, metric_id)
-            else:
-                output_log = run_count_script('count_rs_for_release_unmapped.sh', full_species_dir, metric_id)
-
-            with open(output_log) as f:
-                total = sum(int(l.strip().split(' ')[0]) for l in f)
-            per_species_results[id_to_column[metric_id]] = total
-
-            # Include diff with previous release
-            last_release_total = get_last_release_metric(private_config_xml_file, release_version, taxid, id_to_column[metric_id])
-            per_species_results[f'new_{id_to_column[metric_id]}'] = max(0, total-last_release_total)
-
-        results.append(per_species_results)
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        counter = ReleaseRSCounter(executor, memory_limit_mb=memory_limit_mb)
+        for species_dir in os.listdir(release_dir):
+            full_species_dir = os.path.join(release_dir, species_dir)
+
+            # Get data from other tables
+            taxid, sci_name = get_taxonomy_and_scientific_name(private_config_xml_file, release_version, species_dir)
+            if not taxid or not sci_name:
+                continue
+            new_ss_clustered = get_new_ss_clustered(private_config_xml_file, release_version, taxid)
+            per_species_results = {
+                'taxonomy_id': taxid,
+                'scientific_name': f"'{sci_name}'",
+                'release_folder': f"'{species_dir}'",
+                'release_version': release_version,
+                'new_ss_clustered': new_ss_clustered
+            }
+
+            # Get metrics from release files, all read in one pass
+            output_logs = count_rs_for_species(counter, full_species_dir, list(id_to_column.keys()))
+            for metric_id in id_to_column.keys():
+                with open(output_logs[metric_id]) as f:
+                    total = sum(int(l.strip().split(' ')[0]) for l in f)
+                per_species_results[id_to_column[metric_id]] = total
+
+                # Include diff with previous release
+                last_release_total = get_last_release_metric(private_config_xml_file, release_version, taxid, id_to_column[metric_id])
+                per_species_results[f'new_{id_to_column[metric_id]}'] = max(0, total-last_release_total)
+
+            results.append(per_species_results)
     return results
 
 
@@ -132,9 +133,14 @@ def main():
                         help="base directory where all the release was run.", required=True)
     parser.add_argument("--private-config-xml-file", help="ex: /path/to/eva-maven-settings.xml", required=True)
     parser.add_argument("--release-version", type=int, help="current release version", required=True)
+    parser.add_argument("--num-processes", type=int, default=1,
+                        help="Number of release files read in parallel")
+    parser.add_argument("--memory-limit-mb", type=int, default=4096,
+                        help="Memory used to combine the RS ids of all assemblies before processing them in chunks")
 
     args = parser.parse_args()
-    counts = gather_counts(args.private_config_xml_file, args.release_version, args.release_root_path)
+    counts = gather_counts(args.private_config_xml_file, args.release_version, args.release_root_path,
+                           args.num_processes, args.memory_limit_mb)
     write_counts_to_table(args.private_config_xml_file, counts)
 
 
@@ -0,0 +1,207 @@
+import glob
+import gzip
+import math
+import os
+import re
+import tempfile
+from collections import Counter, defaultdict
+
+import numpy as np
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+# Release files read for each metric: per assembly file suffix and the column holding the RS id
+release_files = {
+    'current': ('vcf.gz', 2),
+    'merged': ('vcf.gz', 2),
+    'multimap': ('vcf.gz', 2),
+    'deprecated': ('txt.gz', 0),
+    'merged_deprecated': ('txt.gz', 0),
+}
+# Memory needed per RS id while computing the histogram: the ids, the assembly they come from, the sort order and the
+# assembly bit masks along with their temporary copies
+BYTES_PER_ID = 48
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def get_assemblies(species_dir):
+    return sorted(os.path.basename(assembly_dir) for assembly_dir in glob.glob(os.path.join(species_dir, 'GC*')))
+
+
+def get_release_file(species_dir, assembly, metric_id):
+    suffix, _ = release_files[metric_id]
+    return os.path.join(species_dir, assembly, f'{assembly}_{metric_id}_ids.{suffix}')
+
+
+def get_id_pattern(id_column):
+    """
+    Match the id in column id_column of every line not starting with #. Ids of the form rs<number> are captured in the
+    first group as their numeric part, any other id in the second group.
+    """
+    return re.compile(rb'^(?!#)(?:\S+[ \t]+){%d}(?:rs([1-9][0-9]{0,17})(?!\S)|(\S+))' % id_column, re.MULTILINE)
+
+
+def read_line_blocks(open_file, block_size=READ_BLOCK_SIZE):
+    """Read the file in blocks of about block_size bytes that end at the end of a line"""
+    remainder = b''
+    while True:
+        block = open_file.read(block_size)
+        if not block:
+            if remainder:
+                yield remainder
+            return
+        block = remainder + block
+        end_of_last_line = block.rfind(b'\n') + 1
+        remainder = block[end_of_last_line:]
+        yield block[:end_of_last_line]
+
+
+def sorted_unique(ids):
+    """Sort the ids in place and return the unique ones, faster than np.unique on large integer arrays"""
+    ids.sort()
+    return ids[np.concatenate(([True], ids[1:] != ids[:-1]))] if len(ids) else ids
+
+
+def read_rs_ids(release_file, id_column, ids_file):
+    """
+    Read the RS ids of a release file and save the numeric part of the ids of the form rs<number> as a sorted array of
+    unique integers in ids_file. Return the number of integer ids saved and the set of the other ids.
+    """
+    id_pattern = get_id_pattern(id_column)
+    id_arrays = [np.empty(0, dtype=np.int64)]
+    other_ids = set()
+    with gzip.open(release_file, 'rb') as open_file:
+        # Lines are parsed a block at a time with a regular expression, which is much faster than splitting each line
+        for block in read_line_blocks(open_file):
+            matches = id_pattern.findall(block)
+            id_arrays.append(sorted_unique(np.array([number for number, _ in matches if number], dtype=np.int64)))
+            other_ids.update(other_id.decode() for _, other_id in matches if other_id)
+    unique_ids = sorted_unique(np.concatenate(id_arrays))
+    np.save(ids_file, unique_ids)
+    return len(unique_ids), other_ids
+
+
+def get_chunk_boundaries(id_arrays, num_chunks, samples_per_chunk=100):
+    """Split the range of ids in num_chunks ranges holding roughly the same number of ids"""
+    if num_chunks <= 1:
+        return []
+    total = sum(len(ids) for ids in id_arrays)
+    step = max(1, total // (num_chunks * samples_per_chunk))
+    samples = np.sort(np.concatenate([ids[::step] for ids in id_arrays]))
+    return sorted(set(int(samples[len(samples) * chunk // num_chunks]) for chunk in range(1, num_chunks)))
+
+
+def count_assembly_sets(id_arrays):
+    """Return, for the ids of one chunk, the number of ids found in each combination of assemblies"""
+    ids = np.concatenate(id_arrays)
+    if not len(ids):
+        return {}
+    assembly_indexes = np.repeat(np.arange(len(id_arrays), dtype=np.uint64), [len(a) for a in id_arrays])
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    assembly_indexes = assembly_indexes[order]
+    del order
+    group_starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    del ids
+    # The set of assemblies of each id is a bit mask spread over as many 64 bits words as needed
+    words = []
+    for word in range(math.ceil(len(id_arrays) / 64)):
+        bits = np.where(assembly_indexes // 64 == word,
+                        np.left_shift(np.uint64(1), assembly_indexes % np.uint64(64)), np.uint64(0))
+        words.append(np.bitwise_or.reduceat(bits, group_starts))
+    # Count identical masks by sorting them, np.unique with axis=0 being much slower
+    masks = np.stack(words, axis=1)
+    masks = masks[np.lexsort(masks.T[::-1])]
+    mask_starts = np.flatnonzero(np.concatenate(([True], np.any(masks[1:] != masks[:-1], axis=1))))
+    counts = np.diff(np.append(mask_starts, len(masks)))
+    masks = masks[mask_starts]
+    return {
+        tuple(index for index in range(len(id_arrays)) if int(mask[index // 64]) >> (index % 64) & 1): int(count)
+        for mask, count in zip(masks, counts)
+    }
+
+
+def count_rs_per_assembly_set(ids_files, other_ids_per_assembly, memory_limit_mb):
+    """
+    Count the RS ids found in each combination of assemblies. The sorted id arrays are memory mapped and processed
+    in ranges of ids small enough to stay under the memory limit.
+    """
+    id_arrays = [np.load(ids_file, mmap_mode='r') for ids_file in ids_files]
+    total = sum(len(ids) for ids in id_arrays)
+    num_chunks = max(1, math.ceil(total * BYTES_PER_ID / (memory_limit_mb * 1024 * 1024)))
+    boundaries = get_chunk_boundaries(id_arrays, num_chunks)
+    if boundaries:
+        logger.info(f'{total} RS ids processed in {len(boundaries) + 1} chunks')
+    histogram = Counter()
+    for lower, upper in zip([None] + boundaries, boundaries + [None]):
+        chunk = [ids[(np.searchsorted(ids, lower) if lower is not None else 0):
+                     (np.searchsorted(ids, upper) if upper is not None else len(ids))]
+                 for ids in id_arrays]
+        histogram.update(count_assembly_sets(chunk))
+
+    assemblies_per_other_id = defaultdict(set)
+    for index, other_ids in enumerate(other_ids_per_assembly):
+        for rs_id in other_ids:
+            assemblies_per_other_id[rs_id].add(index)
+    histogram.update(Counter(tuple(sorted(assemblies)) for assemblies in assemblies_per_other_id.values()))
+    return histogram
+
+
+def count_unmapped(species_dir):
+    """Count the distinct lines of the unmapped ids files of the species"""
+    unique_lines = set()
+    for unmapped_file in glob.glob(os.path.join(species_dir, '*_unmapped_ids.txt.gz')):
+        with gzip.open(unmapped_file, 'rt') as open_file:
+            unique_lines.update(line for line in open_file if not line.startswith('#'))
+    return len(unique_lines)
+
+
+class ReleaseRSCounter:
+    """
+    Count the RS ids of the release files of a species and how many are shared by each combination of assemblies.
+    Every release file is read once, in parallel across assemblies and metrics using the executor provided. The ids are
+    stored on disk as sorted integer arrays which are then combined in chunks that fit in memory_limit_mb.
+    """
+
+    def __init__(self, executor, work_dir=None, memory_limit_mb=4096):
+        self.executor = executor
+        self.work_dir = work_dir
+        self.memory_limit_mb = memory_limit_mb
+
+    def count_species(self, species_dir, metric_ids):
+        """Return, for each metric, the number of RS ids found in each combination of assemblies (named)"""
+        assemblies = get_assemblies(species_dir)
+        histograms = {}
+        with tempfile.TemporaryDirectory(dir=self.work_dir, prefix='rs_ids_') as ids_dir:
+            futures = defaultdict(list)
+            for metric_id in metric_ids:
+                for assembly in assemblies:
+                    release_file = get_release_file(species_dir, assembly, metric_id)
+                    if not os.path.exists(release_file):
+                        logger.warning(f'{release_file} does not exist')
+                        continue
+                    ids_file = os.path.join(ids_dir, f'{assembly}_{metric_id}.npy')
+                    futures[metric_id].append((assembly, ids_file, self.executor.submit(
+                        read_rs_ids, release_file, release_files[metric_id][1], ids_file
+                    )))
+            for metric_id in metric_ids:
+                metric_assemblies = [assembly for assembly, _, _ in futures[metric_id]]
+                ids_files = [ids_file for _, ids_file, _ in futures[metric_id]]
+                other_ids = [future.result()[1] for _, _, future in futures[metric_id]]
+                histogram = count_rs_per_assembly_set(ids_files, other_ids, self.memory_limit_mb)
+                histograms[metric_id] = Counter({
+                    tuple(metric_assemblies[index] for index in assembly_set): count
+                    for assembly_set, count in histogram.items()
+                })
+                for ids_file in ids_files:
+                    os.remove(ids_file)
+                logger.info(f'{os.path.basename(species_dir)} {metric_id}: {sum(histograms[metric_id].values())} RS')
+        return histograms
+
+
+def write_count_log(histogram, log_file):
+    """Write the histogram in the format of uniq -c sorted by decreasing count"""
+    with open(log_file, 'w') as open_file:
+        for assembly_set, count in sorted(histogram.items(), key=lambda item: (-item[1], item[0])):
+            open_file.write(f'{count:>7}  {" ".join(assembly_set)}\n')
@@ -0,0 +1,191 @@
+import hashlib
+import heapq
+import os
+import pickle
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+ASSEMBLY_STARTED = 'assembly_started'
+RS_BATCH = 'rs_batch'
+MERGE_EVENT_CREATED = 'merge_event_created'
+SVE_RS_UPDATED = 'sve_rs_updated'
+RS_MERGED_INTO = 'rs_merged_into'
+RS_CORRECTED = 'rs_corrected'
+RS_INSERTED = 'rs_inserted'
+
+LogEvent = namedtuple('LogEvent', ['kind', 'assembly', 'batch', 'rs', 'other_rs', 'rs_hash', 'offset'])
+
+
+class LogFileEvents:
+    """
+    Events parsed from one clustering log file, stored column by column and indexed by kind, RS and batch number.
+    The byte offset of every line mentioning a numeric token is kept so the original lines can be retrieved
+    without scanning the file again.
+    """
+
+    def __init__(self, log_file_path):
+        self.log_file_path = log_file_path
+        self.columns = {field: [] for field in LogEvent._fields}
+        self.batches = []
+        self.line_offsets_by_token = defaultdict(list)
+        self.rows_by_kind = defaultdict(list)
+        self.rows_by_rs = defaultdict(list)
+        self.rows_by_batch = defaultdict(list)
+
+    def __len__(self):
+        return len(self.columns['kind'])
+
+    def add_event(self, kind, offset, assembly=None, rs=None, other_rs=None, rs_hash=None, rs_batch=None):
+        row = len(self)
+        if rs_batch is not None:
+            self.batches.append(rs_batch)
+        batch = len(self.batches) - 1 if self.batches else None
+        for field, value in zip(LogEvent._fields, (kind, assembly, batch, rs, other_rs, rs_hash, offset)):
+            self.columns[field].append(value)
+        self.rows_by_kind[kind].append(row)
+        self.rows_by_batch[batch].append(row)
+        for rs_in_event in (rs, other_rs):
+            if rs_in_event is not None:
+                self.rows_by_rs[rs_in_event].append(row)
+
+    def get_event(self, row):
+        return LogEvent(*(self.columns[field][row] for field in LogEvent._fields))
+
+    def get_rows(self, kinds):
+        return heapq.merge(*(self.rows_by_kind[kind] for kind in kinds))
+
+    def get_batch(self, batch):
+        return self.batches[batch]
+
+
+def parse_log_file(log_file_path):
+    file_events = LogFileEvents(log_file_path)
+    start_time = time.perf_counter()
+    offset = 0
+    with open(log_file_path, 'rb') as log_file:
+        for raw_line in log_file:
+            line = raw_line.decode()
+            parse_log_line(file_events, line, offset)
+            offset += len(raw_line)
+    return file_events, offset, time.perf_counter() - start_time
+
+
+def parse_log_line(file_events, line, offset):
+    if "RS_list ->" in line:
+        rs_id_list = [s.replace("[", "").replace("]", "").strip() for s in line[line.find('['):].split(",")]
+        file_events.add_event(RS_BATCH, offset, rs_batch=[int(rs) for rs in rs_id_list if rs])
+        return
+
+    for token in line.split(" "):
+        token = token.strip().replace(",", "")
+        if token.isdigit():
+            file_events.line_offsets_by_token[int(token)].append(offset)
+
+    if 'Started processing assembly :' in line:
+        file_events.add_event(ASSEMBLY_STARTED, offset, assembly=line.split(':')[1].strip())
+    if "creating merge event for" in line:
+        fields = line[line.index("creating merge event for"):].split(":")
+        file_events.add_event(MERGE_EVENT_CREATED, offset, rs=int(fields[1].split(" ")[1].strip()),
+                              other_rs=int(fields[2].strip()))
+    if "updating submittedVariantEntity with old_rs:" in line:
+        fields = line[line.index("updating submittedVariantEntity with old_rs:"):].split(":")
+        file_events.add_event(SVE_RS_UPDATED, offset, rs=int(fields[1].strip().split(" ")[0].strip()),
+                              other_rs=int(fields[2].strip()))
+    if "has been merged into RS" in line:
+        fields = line[line.index("RS"):].split(" ")
+        file_events.add_event(RS_MERGED_INTO, offset, rs=int(fields[1].strip()),
+                              other_rs=int(fields[7].replace(".", "").strip()))
+    if "Correct Discordant variants for RS" in line:
+        rs = line[line.index("Correct Discordant variants for RS"):].split(" ")[-1].strip()
+        file_events.add_event(RS_CORRECTED, offset, rs=int(rs))
+    if "Insert rs with new start and id" in line or "insert rs with new start and hash :" in line:
+        id_field = line[line.index("{"):].split(",")[0]
+        file_events.add_event(RS_INSERTED, offset, rs_hash=id_field.split(":")[1].replace("'", "").strip())
+
+
+class ClusteringLogEventStore:
+    """
+    Parse every clustering log file once, in parallel, into per file event stores that the analyses can query.
+    When a cache directory is provided the parsed events are saved there and reused as long as the log file
+    size and modification time do not change.
+    """
+
+    def __init__(self, all_log_files, cache_dir=None, num_processes=None):
+        self.cache_dir = cache_dir
+        self.all_log_files = sorted(all_log_files, key=lambda x: os.stat(x).st_size)
+        file_events = {}
+        files_to_parse = []
+        for log_file_path in self.all_log_files:
+            cached_file_events = self._load_from_cache(log_file_path)
+            if cached_file_events is not None:
+                file_events[log_file_path] = cached_file_events
+            else:
+                files_to_parse.append(log_file_path)
+
+        if files_to_parse:
+            with ProcessPoolExecutor(max_workers=num_processes) as executor:
+                for parsed_file_events, num_bytes, duration in executor.map(parse_log_file, files_to_parse):
+                    log_file_path = parsed_file_events.log_file_path
+                    duration = max(duration, 1e-9)
+                    logger.info(f"Parsed {log_file_path}: {len(parsed_file_events)} events in {duration:.2f}s "
+                                f"({num_bytes / duration / 1024 / 1024:.2f} MB/s, "
+                                f"{len(parsed_file_events) / duration:.0f} events/s)")
+                    file_events[log_file_path] = parsed_file_events
+                    self._save_to_cache(parsed_file_events)
+        self.file_events = [file_events[log_file_path] for log_file_path in self.all_log_files]
+
+    def _cache_file(self, log_file_path):
+        path_digest = hashlib.sha1(os.path.abspath(log_file_path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{os.path.basename(log_file_path)}.{path_digest}.events')
+
+    @staticmethod
+    def _file_signature(log_file_path):
+        file_stat = os.stat(log_file_path)
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def _load_from_cache(self, log_file_path):
+        if not self.cache_dir or not os.path.exists(self._cache_file(log_file_path)):
+            return None
+        with open(self._cache_file(log_file_path), 'rb') as cache_file:
+            signature, file_events = pickle.load(cache_file)
+        if signature != self._file_signature(log_file_path):
+            return None
+        logger.info(f"Loaded {len(file_events)} events for {log_file_path} from cache")
+        return file_events
+
+    def _save_to_cache(self, file_events):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._cache_file(file_events.log_file_path), 'wb') as cache_file:
+            pickle.dump((self._file_signature(file_events.log_file_path), file_events), cache_file)
+
+    def get_events(self, *kinds):
+        """Iterate over the events of the provided kinds in the order they appear in the logs"""
+        for file_events in self.file_events:
+            for row in file_events.get_rows(kinds):
+                yield file_events, file_events.get_event(row)
+
+    def get_events_for_rs(self, rs, *kinds):
+        """Iterate over the events involving an RS, optionally restricted to some kinds, in log order"""
+        for file_events in self.file_events:
+            for row in file_events.rows_by_rs.get(rs, []):
+                event = file_events.get_event(row)
+                if not kinds or event.kind in kinds:
+                    yield file_events, event
+
+    def get_lines_mentioning(self, rs_ids):
+        """Retrieve, in log order, the lines that mention any of the RS ids provided"""
+        for file_events in self.file_events:
+            offsets = sorted(set(offset for rs in rs_ids for offset in file_events.line_offsets_by_token.get(rs, [])))
+            if not offsets:
+                continue
+            with open(file_events.log_file_path, 'rb') as log_file:
+                for offset in offsets:
+                    log_file.seek(offset)
+                    yield log_file.readline().decode()
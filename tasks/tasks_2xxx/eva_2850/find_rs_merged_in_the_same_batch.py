@@ -1,49 +1,116 @@
 import argparse
+import json
 import os
 import signal
 from collections import defaultdict
 
+import pymongo
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.metadata_utils import get_metadata_connection_handle
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
 from ebi_eva_common_pyutils.network_utils import forward_remote_port_to_local_port, get_available_local_port
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
+from pymongo.read_concern import ReadConcern
 
+from tasks.eva_2850.clustering_log_events import ClusteringLogEventStore, RS_BATCH, MERGE_EVENT_CREATED, \
+    SVE_RS_UPDATED, RS_INSERTED, ASSEMBLY_STARTED, RS_CORRECTED, RS_MERGED_INTO
 from tasks.eva_2850.fix_discordant_variants import get_variants, DBSNP_SUBMITTED_VARIANT_ENTITY, \
     EVA_SUBMITTED_VARIANT_ENTITY, merge_all_records, DBSNP_CLUSTERED_VARIANT_ENTITY, get_SHA1, \
-    DBSNP_CLUSTERED_VARIANT_OPERATION_ENTITY, find_documents
+    DBSNP_CLUSTERED_VARIANT_OPERATION_ENTITY, EVA_CLUSTERED_VARIANT_OPERATION_ENTITY, find_documents
 
 logger = logging_config.get_logger(__name__)
 
 
-def merged_rs_ids_present_in_same_batch(all_log_files):
+class MergeChainResolver:
+    """
+    In-memory map of the MERGED operations of an assembly used to find the final RS an RS was merged into.
+    All the merge events are loaded once (or read from a snapshot file) and chains are compressed as they are followed,
+    so resolving an RS does not need any query to the database.
+    """
+
+    def __init__(self, mongo_source, assembly, snapshot_dir=None):
+        self.mongo_source = mongo_source
+        self.assembly = assembly
+        self.snapshot_file = os.path.join(snapshot_dir, f'{assembly}_merged_rs.json') if snapshot_dir else None
+        self.num_queries = 0
+        self.num_resolved = 0
+        self.merged_into = self._load_merged_into()
+
+    def _load_merged_into(self):
+        if self.snapshot_file and os.path.exists(self.snapshot_file):
+            logger.info(f"Loading merge events for assembly {self.assembly} from snapshot {self.snapshot_file}")
+            with open(self.snapshot_file) as snapshot:
+                return dict(json.load(snapshot))
+
+        logger.info(f"Loading merge events for assembly {self.assembly} from the database")
+        merged_into = {}
+        # dbsnp events are loaded first so they take precedence like in the query based resolution
+        for collection_name in [DBSNP_CLUSTERED_VARIANT_OPERATION_ENTITY, EVA_CLUSTERED_VARIANT_OPERATION_ENTITY]:
+            collection = self.mongo_source.mongo_handle[self.mongo_source.db_name][collection_name]
+            cursor = collection.with_options(read_concern=ReadConcern("majority"),
+                                             read_preference=pymongo.ReadPreference.PRIMARY) \
+                .find({'eventType': 'MERGED', 'inactiveObjects.asm': self.assembly},
+                      projection={'_id': 0, 'accession': 1, 'mergeInto': 1}, batch_size=10000, no_cursor_timeout=True)
+            self.num_queries += 1
+            try:
+                for event in cursor:
+                    merged_into.setdefault(event['accession'], event['mergeInto'])
+            finally:
+                cursor.close()
+        logger.info(f"Loaded {len(merged_into)} merge events for assembly {self.assembly}")
+
+        if self.snapshot_file:
+            with open(self.snapshot_file, 'w') as snapshot:
+                json.dump(list(merged_into.items()), snapshot)
+        return merged_into
+
+    def get_final_merged_rs(self, rs):
+        """Return the last RS in the merge chain starting from rs or None if rs was never merged"""
+        self.num_resolved += 1
+        if rs not in self.merged_into:
+            return None
+        path = []
+        final_rs = rs
+        while final_rs in self.merged_into and final_rs not in path:
+            path.append(final_rs)
+            final_rs = self.merged_into[final_rs]
+        # Path compression: every RS visited now points straight at the final RS
+        for visited_rs in path:
+            self.merged_into[visited_rs] = final_rs
+        return final_rs
+
+    def report(self):
+        queries_per_rs = self.num_queries / self.num_resolved if self.num_resolved else 0
+        logger.info(f"Merge chains for assembly {self.assembly}: resolved {self.num_resolved} RS "
+                    f"with {self.num_queries} queries ({queries_per_rs:.6f} queries per RS)")
+
+
+def merged_rs_ids_present_in_same_batch(log_event_store):
     merged_rs_ids = {}
     merged_rs_with_further_hash_collision = []
 
-    for log_file_path in sorted(all_log_files, key=lambda x: os.stat(x).st_size):
-        with open(log_file_path, 'r') as log_file:
+    curr_file_events = None
+    for file_events, event in log_event_store.get_events(RS_BATCH, MERGE_EVENT_CREATED):
+        if file_events is not curr_file_events:
+            curr_file_events = file_events
             curr_rs_id_batch = []
-            for line in log_file:
-                if "RS_list ->" in line:
-                    rs_id_list = line[line.find('['):].split(",")
-                    rs_id_list = [s.replace("[", "") for s in rs_id_list]
-                    rs_id_list = [s.replace("]", "") for s in rs_id_list]
-                    rs_id_list = [s.strip() for s in rs_id_list]
-                    # only one rs in batch
-                    if len(rs_id_list) == 1:
-                        continue
-                    curr_rs_id_batch = rs_id_list
-                if "creating merge event for" in line:
-                    merged_rs = line[line.index("creating merge event for"):].split(":")[1].split(" ")[1].strip()
-                    merged_into = line[line.index("creating merge event for"):].split(":")[2].strip()
-                    # check if the variants are involved in another hash collision
-                    if merged_rs in merged_rs_ids:
-                        merged_rs_with_further_hash_collision.append(merged_rs)
-                    if merged_into in merged_rs_ids:
-                        merged_rs_with_further_hash_collision.append(merged_into)
-
-                    if merged_rs in curr_rs_id_batch and merged_into in curr_rs_id_batch:
-                        merged_rs_ids[merged_rs] = merged_into
+        if event.kind == RS_BATCH:
+            rs_id_list = file_events.get_batch(event.batch)
+            # only one rs in batch
+            if len(rs_id_list) <= 1:
+                continue
+            curr_rs_id_batch = rs_id_list
+        else:
+            merged_rs = event.rs
+            merged_into = event.other_rs
+            # check if the variants are involved in another hash collision
+            if merged_rs in merged_rs_ids:
+                merged_rs_with_further_hash_collision.append(merged_rs)
+            if merged_into in merged_rs_ids:
+                merged_rs_with_further_hash_collision.append(merged_into)
+
+            if merged_rs in curr_rs_id_batch and merged_into in curr_rs_id_batch:
+                merged_rs_ids[merged_rs] = merged_into
 
     # sundar_merged_rs_accession_set = set()
     # sundar_merged_rs_hashes_set = set()
@@ -66,15 +133,9 @@ def merged_rs_ids_present_in_same_batch(all_log_files):
 
     # get logs for each rs involved
     rs_logs = defaultdict(list)
-    for log_file_path in sorted(all_log_files, key=lambda x: os.stat(x).st_size):
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                split_line = [s.strip().replace(",", "") for s in line.split(" ")]
-                if "RS_list ->" in line:
-                    continue
-                for rs in merged_rs_ids:
-                    if rs in split_line or merged_rs_ids[rs] in split_line:
-                        rs_logs[rs].append(line)
+    for rs in merged_rs_ids:
+        for line in log_event_store.get_lines_mentioning([rs, merged_rs_ids[rs]]):
+            rs_logs[rs].append(line)
 
     # print logs for each rs
     for rs, logs in rs_logs.items():
@@ -84,20 +145,9 @@ def merged_rs_ids_present_in_same_batch(all_log_files):
             print(log_line.replace("\n", ""))
 
 
-def correct_sve_with_wrong_rs(all_log_files, mongo_source, private_config_xml_file):
-    rs_list = []
-
-    # go through each of the log files and find all rs for which sve has been updated
-    for log_file_path in sorted(all_log_files, key=lambda x: os.stat(x).st_size):
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                # get the new_rs from the line where sve with old_rs updated to new_rs
-                if "updating submittedVariantEntity with old_rs:" in line:
-                    # old_rs = line[line.index("updating submittedVariantEntity with old_rs:"):].split(":")[1].strip() \
-                    #     .split(" ")[0].strip()
-                    new_rs = int(
-                        line[line.index("updating submittedVariantEntity with old_rs:"):].split(":")[2].strip())
-                    rs_list.append(new_rs)
+def correct_sve_with_wrong_rs(log_event_store, mongo_source, private_config_xml_file, merge_snapshot_dir=None):
+    # find all rs for which sve has been updated from old_rs to new_rs
+    rs_list = [event.other_rs for _, event in log_event_store.get_events(SVE_RS_UPDATED)]
 
     all_rs_variants = get_rs_variants(mongo_source, list(set(rs_list)))
     rs_not_found_in_db = []
@@ -142,7 +192,7 @@ def correct_sve_with_wrong_rs(all_log_files, mongo_source, private_config_xml_fi
         all_sve_from_tempmongo = get_sve_from_tempmongo(sve_for_which_cve_not_found, private_config_xml_file)
         logger.info(f"Total SVE found in tempmongo: {len(all_sve_from_tempmongo)}")
         sve_not_found_in_tempmongo = check_sve_with_sve_for_correction(sve_for_which_cve_not_found,
-                                                                       all_sve_from_tempmongo)
+                                                                       all_sve_from_tempmongo, merge_snapshot_dir)
 
         if sve_not_found_in_tempmongo:
             logger.info(f"There are some sve which could not be found in tempmongo")
@@ -239,7 +289,8 @@ def check_sve_with_cve_for_correction(ss_list, all_cve_for_sve):
     return sve_for_which_cve_not_found
 
 
-def check_sve_with_sve_for_correction(ss_list, all_sve_from_tempmongo):
+def check_sve_with_sve_for_correction(ss_list, all_sve_from_tempmongo, merge_snapshot_dir=None):
+    merge_chain_resolvers = {}
     sve_not_found = []
     sve_with_wrong_rs = []
     tempmongo_rs_not_found_in_db_nor_merged = []
@@ -270,7 +321,10 @@ def check_sve_with_sve_for_correction(ss_list, all_sve_from_tempmongo):
                     print("-------------------------------------------------------------------------------------------")
                 else:
                     logger.info(f"RS {rs_from_tempmongo} not present in Mongo Prod")
-                    merged_rs = check_and_get_final_merged_rs(rs_from_tempmongo, sve['seq'])
+                    if sve['seq'] not in merge_chain_resolvers:
+                        merge_chain_resolvers[sve['seq']] = MergeChainResolver(mongo_source, sve['seq'],
+                                                                               merge_snapshot_dir)
+                    merged_rs = check_and_get_final_merged_rs(rs_from_tempmongo, merge_chain_resolvers[sve['seq']])
                     if merged_rs is not None:
                         merged_rs_from_db = get_rs_variants_with_asm(mongo_source, sve['seq'], [merged_rs])
                         if merged_rs in merged_rs_from_db:
@@ -299,40 +353,23 @@ def check_sve_with_sve_for_correction(ss_list, all_sve_from_tempmongo):
     logger.info(
         f"SVE for which tempmongo RS not found in DB nor merged : {len(tempmongo_rs_not_found_in_db_nor_merged)}\n"
         f"{tempmongo_rs_not_found_in_db_nor_merged}")
+    for merge_chain_resolver in merge_chain_resolvers.values():
+        merge_chain_resolver.report()
 
     return sve_not_found
 
 
-def check_and_get_final_merged_rs(org_rs, asm):
+def check_and_get_final_merged_rs(org_rs, merge_chain_resolver):
     logger.info(f"Checking if RS {org_rs} is merged into another RS")
-    final_rs = None
-    while org_rs is not None:
-        merge_event = get_rs_merge_events_with_asm(mongo_source, [org_rs], asm)
-        if org_rs in merge_event:
-            mergedInto_rs = merge_event[org_rs][0]['mergeInto']
-            logger.info(f"RS {org_rs} merged into RS {mergedInto_rs}")
-            final_rs = mergedInto_rs
-            org_rs = mergedInto_rs
-        else:
-            break
+    final_rs = merge_chain_resolver.get_final_merged_rs(org_rs)
+    if final_rs is not None:
+        logger.info(f"RS {org_rs} merged into RS {final_rs}")
 
     return final_rs
 
 
-def check_if_any_newly_added_rs_has_collision_in_eva_cve(all_log_files, mongo_source):
-    inserted_rs_id_list = []
-    for log_file_path in sorted(all_log_files, key=lambda x: os.stat(x).st_size):
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                if "Insert rs with new start and id" in line:
-                    id_field = line[line.index("{"):].split(",")[0]
-                    id = id_field.split(":")[1].replace("'", "").strip()
-                    inserted_rs_id_list.append(id)
-                    continue
-                if "insert rs with new start and hash :" in line:
-                    id_field = line[line.index("{"):].split(",")[0]
-                    id = id_field.split(":")[1].replace("'", "").strip()
-                    inserted_rs_id_list.append(id)
+def check_if_any_newly_added_rs_has_collision_in_eva_cve(log_event_store, mongo_source):
+    inserted_rs_id_list = [event.rs_hash for _, event in log_event_store.get_events(RS_INSERTED)]
 
     eva_rs_variants = get_rs_variants_with_hashes(mongo_source, inserted_rs_id_list, "clusteredVariantEntity")
     logger.info(f"No of rs ids found in eva : {len(eva_rs_variants)}")
@@ -340,18 +377,15 @@ def check_if_any_newly_added_rs_has_collision_in_eva_cve(all_log_files, mongo_so
         logger.info(f"{cve}")
 
 
-def check_if_all_processed_rs_was_supposed_to_be_processed(all_log_files, mongo_source):
+def check_if_all_processed_rs_was_supposed_to_be_processed(log_event_store, mongo_source):
     asm_rs_list = {}
     curr_asm = ""
-    for log_file_path in sorted(all_log_files, key=lambda x: os.stat(x).st_size):
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                if 'Started processing assembly :' in line:
-                    curr_asm = line.split(':')[1].strip()
-                    asm_rs_list[curr_asm] = []
-                if "Correct Discordant variants for RS" in line:
-                    rs = line[line.index("Correct Discordant variants for RS"):].split(" ")[-1].strip()
-                    asm_rs_list[curr_asm].append(int(rs))
+    for _, event in log_event_store.get_events(ASSEMBLY_STARTED, RS_CORRECTED):
+        if event.kind == ASSEMBLY_STARTED:
+            curr_asm = event.assembly
+            asm_rs_list[curr_asm] = []
+        else:
+            asm_rs_list[curr_asm].append(event.rs)
 
     for asm, rs_list in asm_rs_list.items():
         rs_variants = get_rs_variants_with_asm(mongo_source, asm, list(set(rs_list)))
@@ -364,20 +398,14 @@ def check_if_all_processed_rs_was_supposed_to_be_processed(all_log_files, mongo_
     logger.info("finished")
 
 
-def check_if_correct_merge_rs_was_picked(all_log_files, mongo_source):
+def check_if_correct_merge_rs_was_picked(log_event_store, mongo_source):
     asm_rs_list = defaultdict(lambda: defaultdict())
     curr_asm = ""
-    for log_file_path in sorted(all_log_files, key=lambda x: os.stat(x).st_size):
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                if 'Started processing assembly :' in line:
-                    curr_asm = line.split(':')[1].strip()
-                    continue
-                if "has been merged into RS" in line:
-                    merged_rs = line[line.index("RS"):].split(" ")[1].strip()
-                    new_rs = line[line.index("RS"):].split(" ")[7].replace(".", "").strip()
-                    # print(f"Merged RS {merged_rs}, New RS {new_rs}")
-                    asm_rs_list[curr_asm][int(merged_rs)] = int(new_rs)
+    for _, event in log_event_store.get_events(ASSEMBLY_STARTED, RS_MERGED_INTO):
+        if event.kind == ASSEMBLY_STARTED:
+            curr_asm = event.assembly
+        else:
+            asm_rs_list[curr_asm][event.rs] = event.other_rs
 
     for asm in asm_rs_list:
         print(f"Assembly: {asm}")
@@ -508,16 +536,23 @@ if __name__ == "__main__":
                         help="Full path to the Mongo Source secrets file (ex: /path/to/mongo/source/secret)",
                         required=True)
     parser.add_argument("--log-file-dir", help="File containing discordant rs ids", required=True)
+    parser.add_argument("--log-cache-dir", required=False, default=None,
+                        help="Directory where the events parsed from each log file are saved and reused")
+    parser.add_argument("--num-processes", type=int, required=False, default=None,
+                        help="Number of processes used to parse the log files")
+    parser.add_argument("--merge-snapshot-dir", required=False, default=None,
+                        help="Directory where the merge events loaded for each assembly are saved and reused")
     args = parser.parse_args()
 
     # there are 2 different log files
     all_log_files = [os.path.join(args.log_file_dir, filename) for filename in os.listdir(args.log_file_dir)]
+    log_event_store = ClusteringLogEventStore(all_log_files, args.log_cache_dir, args.num_processes)
 
     mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
                                  db_name="eva_accession_sharded")
 
-    # merged_rs_ids_present_in_same_batch(all_log_files)
-    # correct_sve_with_wrong_rs(all_log_files, mongo_source, args.private_config_xml_file)
-    # check_if_any_newly_added_rs_has_collision_in_eva_cve(all_log_files, mongo_source)
-    # check_if_all_processed_rs_was_supposed_to_be_processed(all_log_files, mongo_source)
-    check_if_correct_merge_rs_was_picked(all_log_files, mongo_source)
+    # merged_rs_ids_present_in_same_batch(log_event_store)
+    # correct_sve_with_wrong_rs(log_event_store, mongo_source, args.private_config_xml_file, args.merge_snapshot_dir)
+    # check_if_any_newly_added_rs_has_collision_in_eva_cve(log_event_store, mongo_source)
+    # check_if_all_processed_rs_was_supposed_to_be_processed(log_event_store, mongo_source)
+    check_if_correct_merge_rs_was_picked(log_event_store, mongo_source)
@@ -41,6 +41,57 @@ def get_clustered_SHA1(variant_rec):
     return get_SHA1('_'.join([str(variant_rec[key]) for key in keys]))
 
 
+class HashCollisionIndex:
+    """
+    Batch scoped lookup of the clustered variants present in dbsnp and eva CVE collections for a set of candidate hashes.
+    All the candidates are resolved upfront with a few $in queries, then kept up to date with the inserts and deletes
+    made while processing the batch so that later RS in the same batch see the changes made by earlier ones.
+    """
+
+    def __init__(self, mongo_source, candidate_ids, chunk_size=1000):
+        self.dbsnp_variants = {}
+        self.eva_variants = {}
+        candidate_ids = list(set(candidate_ids))
+        for i in range(0, len(candidate_ids), chunk_size):
+            filter_criteria = {'_id': {'$in': candidate_ids[i:i + chunk_size]}}
+            for variant in find_documents(mongo_source, DBSNP_CLUSTERED_VARIANT_ENTITY, filter_criteria):
+                self.dbsnp_variants[variant['_id']] = variant
+            for variant in find_documents(mongo_source, EVA_CLUSTERED_VARIANT_ENTITY, filter_criteria):
+                self.eva_variants[variant['_id']] = variant
+
+    def check_for_hash_collision(self, id):
+        variant_in_dbsnp = self.dbsnp_variants.get(id)
+        variant_in_eva = self.eva_variants.get(id)
+        if variant_in_dbsnp and variant_in_eva:
+            raise Exception(f"CVE variant with {id}  is present in both dbsnp cve and eva cve")
+        return variant_in_dbsnp, variant_in_eva
+
+    def add_dbsnp_variant(self, variant):
+        self.dbsnp_variants[variant['_id']] = variant
+
+    def remove_dbsnp_variants(self, ids):
+        for id in ids:
+            self.dbsnp_variants.pop(id, None)
+
+    def remove_eva_variants(self, ids):
+        for id in ids:
+            self.eva_variants.pop(id, None)
+
+
+def get_candidate_hashes(rs_list, all_rs_variants, all_ss_variants):
+    """Calculate the hash each RS of the batch would get if its start was corrected using its original SS"""
+    candidate_hashes = []
+    for rs in rs_list:
+        rs_without_map_weight = get_rs_without_map_weight(all_rs_variants.get(rs, []))
+        ss_records = all_ss_variants.get(rs)
+        if len(rs_without_map_weight) != 1 or not ss_records:
+            continue
+        rs_with_new_start = copy.copy(rs_without_map_weight[0])
+        rs_with_new_start['start'] = ss_records[0]['start']
+        candidate_hashes.append(get_clustered_SHA1(rs_with_new_start))
+    return candidate_hashes
+
+
 def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000):
     logger.info(f"\n\nStarted processing assembly : {assembly}")
 
@@ -58,6 +109,8 @@ def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000):
 
                 all_rs_variants = get_rs_variants(mongo_source, assembly, rs_list)
                 dbsnp_ss_variants, eva_ss_variants, all_ss_variants = get_ss_variants(mongo_source, assembly, rs_list)
+                collision_index = HashCollisionIndex(mongo_source,
+                                                     get_candidate_hashes(rs_list, all_rs_variants, all_ss_variants))
                 all_events = {}
 
                 for rs in rs_list:
@@ -114,7 +167,7 @@ def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000):
 
                         logger.info(f"Correct Discordant variants for RS {rs}")
                         merged_rs, merged_into = correct_discordant_rs_and_insert_into_db(rs_variant, ss_records,
-                                                                                          assembly)
+                                                                                          assembly, collision_index)
 
                         # check if any merge has happened and
                         # if the merged_rs and the merged_into rs are both in the same batch
@@ -146,18 +199,18 @@ def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000):
                 rs_list_to_process.clear()
 
 
-def correct_discordant_rs_and_insert_into_db(rs_variant, ss_records, assembly):
+def correct_discordant_rs_and_insert_into_db(rs_variant, ss_records, assembly, collision_index):
     rs_with_new_start = copy.copy(rs_variant)
     rs_with_new_start['start'] = ss_records[0]['start']
     rs_with_new_start['_id'] = get_clustered_SHA1(rs_with_new_start)
 
-    variant_in_dbsnp, variant_in_eva = check_for_hash_collision(rs_with_new_start['_id'])
+    variant_in_dbsnp, variant_in_eva = collision_index.check_for_hash_collision(rs_with_new_start['_id'])
 
     if variant_in_dbsnp or variant_in_eva:
         logger.warn(f"Hash collision will occur for RS {rs_variant['accession']} "
                     f"with RS {variant_in_dbsnp['accession'] if variant_in_dbsnp else variant_in_eva['accession']}")
         return resolve_collision_and_insert_rs(rs_variant, rs_with_new_start, variant_in_dbsnp, variant_in_eva,
-                                               assembly)
+                                               assembly, collision_index)
     else:
         logger.info(f"No hash collision for RS {rs_variant['accession']}")
         dbsnp_cve_collection = mongo_source.mongo_handle[mongo_source.db_name][DBSNP_CLUSTERED_VARIANT_ENTITY]
@@ -165,15 +218,18 @@ def correct_discordant_rs_and_insert_into_db(rs_variant, ss_records, assembly):
         logger.info(f"delete rs with wrong start : {rs_variant}")
         dbsnp_cve_collection.with_options(write_concern=WriteConcern("majority")) \
             .delete_one({'_id': rs_variant['_id']})
+        collision_index.remove_dbsnp_variants([rs_variant['_id']])
         # insert rs with new
         logger.info(f"Insert rs with new start and id(hash): {rs_with_new_start}")
         dbsnp_cve_collection.with_options(write_concern=WriteConcern("majority")) \
             .insert_one(rs_with_new_start)
+        collision_index.add_dbsnp_variant(rs_with_new_start)
 
         return None, None
 
 
-def resolve_collision_and_insert_rs(rs_variant, rs_with_new_start, variant_in_dbsnp, variant_in_eva, assembly):
+def resolve_collision_and_insert_rs(rs_variant, rs_with_new_start, variant_in_dbsnp, variant_in_eva, assembly,
+                                    collision_index):
     dbsnp_cve_collection = mongo_source.mongo_handle[mongo_source.db_name][DBSNP_CLUSTERED_VARIANT_ENTITY]
     dbsnp_cvoe_collection = mongo_source.mongo_handle[mongo_source.db_name][DBSNP_CLUSTERED_VARIANT_OPERATION_ENTITY]
     eva_cve_collection = mongo_source.mongo_handle[mongo_source.db_name][EVA_CLUSTERED_VARIANT_ENTITY]
@@ -191,6 +247,7 @@ def resolve_collision_and_insert_rs(rs_variant, rs_with_new_start, variant_in_db
                 f"delete rs with wrong start and the one being merged: \nWrong start: {rs_variant} \nMerged: {variant_in_db}")
             dbsnp_cve_collection.with_options(write_concern=WriteConcern("majority")) \
                 .delete_many({'_id': {'$in': [rs_variant['_id'], variant_in_db['_id']]}})
+            collision_index.remove_dbsnp_variants([rs_variant['_id'], variant_in_db['_id']])
         else:
             merge_event = create_merge_event(variant_in_db, rs_with_new_start)
             eva_cvoe_collection.with_options(write_concern=WriteConcern("majority")).insert_one(merge_event)
@@ -200,9 +257,12 @@ def resolve_collision_and_insert_rs(rs_variant, rs_with_new_start, variant_in_db
                 .delete_many({'_id': {'$in': [rs_variant['_id']]}})
             eva_cve_collection.with_options(write_concern=WriteConcern("majority")) \
                 .delete_many({'_id': {'$in': [variant_in_db['_id']]}})
+            collision_index.remove_dbsnp_variants([rs_variant['_id']])
+            collision_index.remove_eva_variants([variant_in_db['_id']])
 
         logger.info(f"insert rs with new start and hash : {rs_with_new_start}")
         dbsnp_cve_collection.with_options(write_concern=WriteConcern("majority")).insert_one(rs_with_new_start)
+        collision_index.add_dbsnp_variant(rs_with_new_start)
 
         update_ss_with_new_rs(variant_in_db['accession'], rs_with_new_start['accession'], assembly)
 
@@ -214,6 +274,7 @@ def resolve_collision_and_insert_rs(rs_variant, rs_with_new_start, variant_in_db
 
         logger.info(f"delete rs with wrong start: {rs_variant}")
         dbsnp_cve_collection.with_options(write_concern=WriteConcern("majority")).delete_one({'_id': rs_variant['_id']})
+        collision_index.remove_dbsnp_variants([rs_variant['_id']])
 
         update_ss_with_new_rs(rs_with_new_start['accession'], variant_in_db['accession'], assembly)
 
@@ -376,22 +437,6 @@ def check_all_ss_has_same_info(ss_list):
         return True
 
 
-def check_for_hash_collision(id):
-    hash_collision_filter_criteria = {'_id': id}
-    dbsnp_collision_records = find_documents(mongo_source, DBSNP_CLUSTERED_VARIANT_ENTITY,
-                                             hash_collision_filter_criteria)
-    eva_collision_records = find_documents(mongo_source, EVA_CLUSTERED_VARIANT_ENTITY, hash_collision_filter_criteria)
-
-    if dbsnp_collision_records and not eva_collision_records:
-        return dbsnp_collision_records[0], None
-    elif not dbsnp_collision_records and eva_collision_records:
-        return None, eva_collision_records[0]
-    elif not dbsnp_collision_records and not eva_collision_records:
-        return None, None
-    else:
-        raise Exception(f"CVE variant with {id}  is present in both dbsnp cve and eva cve")
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Find discordant variants', add_help=False)
     parser.add_argument("--mongo-source-uri",
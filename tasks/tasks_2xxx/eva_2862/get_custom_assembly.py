@@ -14,8 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import fcntl
+import mmap
 import os
-import re
 import shutil
 import sys
 import urllib
@@ -35,6 +36,154 @@ sys.path.append(os.path.dirname(__file__))
 from remapping_config import load_config
 
 
+# ioctl request asking the file system to share the data blocks of a file with another one (reflink)
+FICLONE = 0x40049409
+INDEX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def clone_file(source_path, destination_path):
+    """
+    Copy source_path to destination_path sharing the data blocks of the source (reflink) when the file system supports
+    it, which takes no time nor space whatever the size of the file. Otherwise the data is copied by the kernel.
+    Hard links are not an option since appending to the destination would then modify the source.
+    """
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(source_path, destination_path)
+    return False
+
+
+def ends_with_new_line(file_path):
+    with open(file_path, 'rb') as open_file:
+        if not open_file.seek(0, os.SEEK_END):
+            return True
+        open_file.seek(-1, os.SEEK_END)
+        return open_file.read(1) == b'\n'
+
+
+class FastaIndexEntry:
+    """One line of a samtools style FASTA index (.fai)"""
+
+    def __init__(self, name, length, offset, line_bases, line_width):
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+
+    @property
+    def end(self):
+        """Offset of the byte following the last line of the sequence, including its end of line"""
+        if not self.length:
+            return self.offset
+        full_lines, remaining_bases = divmod(self.length, self.line_bases)
+        return (self.offset + full_lines * self.line_width + remaining_bases +
+                (self.line_width - self.line_bases if remaining_bases else 0))
+
+    def to_line(self):
+        return f'{self.name}\t{self.length}\t{self.offset}\t{self.line_bases}\t{self.line_width}\n'
+
+    @classmethod
+    def from_line(cls, line):
+        name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+        return cls(name, int(length), int(offset), int(line_bases), int(line_width))
+
+
+class IndexedFasta(AppLogger):
+    """
+    FASTA file and its samtools style index (.fai). The index is read instead of the FASTA file whenever it is up to
+    date and records are appended to both so that the index never needs to be regenerated from the whole FASTA.
+    """
+
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        self.fai_path = fasta_path + '.fai'
+
+    def is_index_up_to_date(self):
+        return (os.path.isfile(self.fai_path) and
+                os.path.getmtime(self.fai_path) >= os.path.getmtime(os.path.realpath(self.fasta_path)))
+
+    def read_index(self):
+        with open(self.fai_path) as open_file:
+            return [FastaIndexEntry.from_line(line) for line in open_file if line.strip()]
+
+    def build_index(self):
+        """
+        Index the FASTA file, which is only needed when it has no index. Records are delimited by searching for the
+        headers and their lengths are deduced from the number of end of lines rather than by parsing every line.
+        """
+        self.info(f'Index {self.fasta_path}')
+        entries = []
+        if not os.path.getsize(self.fasta_path):
+            return entries
+        with open(self.fasta_path, 'rb') as open_file, \
+                mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ) as fasta:
+            header_start = 0 if fasta[:1] == b'>' else fasta.find(b'\n>') + 1 or len(fasta)
+            while header_start < len(fasta):
+                header_end = fasta.find(b'\n', header_start)
+                if header_end == -1:
+                    header_end = len(fasta)
+                sequence_start = min(header_end + 1, len(fasta))
+                next_header_start = fasta.find(b'\n>', header_end) + 1 or len(fasta)
+                first_line_end = fasta.find(b'\n', sequence_start, next_header_start)
+                first_line = fasta[sequence_start:first_line_end + 1 if first_line_end != -1 else next_header_start]
+                end_of_line_bytes = 0
+                for chunk_start in range(sequence_start, next_header_start, INDEX_CHUNK_SIZE):
+                    chunk = fasta[chunk_start:min(chunk_start + INDEX_CHUNK_SIZE, next_header_start)]
+                    end_of_line_bytes += chunk.count(b'\n') + chunk.count(b'\r')
+                entries.append(FastaIndexEntry(
+                    fasta[header_start + 1:header_end].split()[0].decode(),
+                    next_header_start - sequence_start - end_of_line_bytes, sequence_start,
+                    len(first_line.rstrip(b'\r\n')), len(first_line)
+                ))
+                header_start = next_header_start
+        return entries
+
+    def get_index(self):
+        """Return the entries of the index, writing the index first if it is missing or older than the FASTA file"""
+        if self.is_index_up_to_date():
+            return self.read_index()
+        entries = self.build_index()
+        with open(self.fai_path, 'w') as open_file:
+            open_file.writelines(entry.to_line() for entry in entries)
+        return entries
+
+    def get_contig_names(self):
+        return [entry.name for entry in self.get_index()]
+
+    def discard_unindexed_records(self):
+        """
+        Remove anything written after the last record of the index, like a record partially appended by an
+        interrupted run. This assumes that the index is authoritative, which is the case for files only ever appended
+        to with append_record.
+        """
+        entries = self.read_index()
+        end = max((entry.end for entry in entries), default=0)
+        if os.path.getsize(self.fasta_path) > end:
+            self.warning(f'Remove {os.path.getsize(self.fasta_path) - end} bytes not indexed from {self.fasta_path}')
+            os.truncate(self.fasta_path, end)
+
+    def append_record(self, header, sequence, line_bases):
+        """Append the record to the FASTA file then add it to the index. Return the number of bytes appended."""
+        name = header.split()[0]
+        with open(self.fasta_path, 'ab') as fasta:
+            offset = fasta.tell()
+            header_line = f'>{header}\n'.encode()
+            sequence = sequence.encode()
+            # Wrap the sequence in lines of identical length as required to index it
+            record = header_line + b''.join(sequence[start:start + line_bases] + b'\n'
+                                            for start in range(0, len(sequence), line_bases))
+            fasta.write(record)
+        with open(self.fai_path, 'a') as fai:
+            fai.write(FastaIndexEntry(name, len(sequence), offset + len(header_line), line_bases,
+                                      line_bases + 1).to_line())
+        return len(record)
+
+
 class CustomAssembly(AppLogger):
     """
     This class creates a custom assembly based on existing assembly fasta and report.
@@ -118,13 +267,20 @@ class CustomAssembly(AppLogger):
 
     @staticmethod
     def get_contig_accessions_in_fasta(fasta_path):
-        written_contigs = []
-        match = re.compile(r'>(.*?)\s')
-        if os.path.isfile(fasta_path):
-            with open(fasta_path, 'r') as file:
-                for line in file:
-                    written_contigs.extend(match.findall(line))
-        return written_contigs
+        """Return the accessions of the contigs of the FASTA file, read from its index when it is up to date."""
+        if not os.path.isfile(fasta_path):
+            return []
+        return IndexedFasta(fasta_path).get_contig_names()
+
+    @staticmethod
+    def _read_downloaded_contig(contig_path):
+        """Return the header, the sequence and the line length of the single record of a downloaded FASTA file."""
+        with open(contig_path) as open_file:
+            lines = [line.strip() for line in open_file if line.strip()]
+        if not lines or not lines[0].startswith('>') or any(line.startswith('>') for line in lines[1:]):
+            raise ValueError(f'{contig_path} does not contain a single FASTA record')
+        sequence_lines = lines[1:] or ['']
+        return lines[0][1:], ''.join(sequence_lines), len(sequence_lines[0]) or 1
 
     @retry(tries=4, delay=2, backoff=1.2, jitter=(1, 3))
     def download_contig_from_ncbi(self, contig_accession):
@@ -155,33 +311,59 @@ class CustomAssembly(AppLogger):
         else:
             os.symlink(self.assembly_report_path, self.output_assembly_report_path)
 
+    def _prepare_output_fasta(self):
+        """
+        Reuse the custom FASTA of a previous run if there is one, otherwise start it as a clone of the assembly FASTA.
+        Either way the custom FASTA can then be extended by appending records to it and its index.
+        """
+        output_fasta = IndexedFasta(self.output_assembly_fasta_path)
+        if os.path.islink(self.output_assembly_fasta_path):
+            os.remove(self.output_assembly_fasta_path)
+        if os.path.isfile(self.output_assembly_fasta_path) and os.path.isfile(output_fasta.fai_path):
+            self.info(f'Extend existing custom assembly fasta {self.output_assembly_fasta_path}')
+            output_fasta.discard_unindexed_records()
+            return output_fasta
+        if not ends_with_new_line(self.assembly_fasta_path):
+            raise ValueError(f'{self.assembly_fasta_path} does not end with a new line and cannot be extended')
+        assembly_fasta = IndexedFasta(self.assembly_fasta_path)
+        # Make sure the assembly index exists so that it can be reused for the custom assembly
+        assembly_fasta.get_index()
+        if clone_file(self.assembly_fasta_path, self.output_assembly_fasta_path):
+            self.info(f'Cloned {self.assembly_fasta_path} to {self.output_assembly_fasta_path}')
+        else:
+            self.info(f'Copied {self.assembly_fasta_path} to {self.output_assembly_fasta_path}')
+        # The index is copied after the FASTA so that it is up to date
+        shutil.copyfile(assembly_fasta.fai_path, output_fasta.fai_path)
+        return output_fasta
+
     def generate_fasta(self):
         """
-        Check if custom contig needs to be added to the assembly. If yes then copy the fasta file and append the new
-        contigs otherwise create a symlink to the normal assembly.
+        Check if custom contig needs to be added to the assembly. If yes then clone the fasta file and append the new
+        contigs otherwise create a symlink to the normal assembly. Contigs already in the assembly or in the custom
+        fasta of a previous run are found from the fasta indexes and are not added again.
         """
+        contig_to_append = []
         if self.genbank_contig_to_add:
-            self.info(f'Create custom assembly fasta for {self.assembly_accession}')
-            written_contigs = self.get_contig_accessions_in_fasta(self.assembly_fasta_path)
+            written_contigs = set(self.get_contig_accessions_in_fasta(self.assembly_fasta_path))
             # Now find out what are the contigs that needs to be appended to the assembly
-            contig_to_append = []
-            for contig_dict in self.genbank_contig_to_add:
-                if contig_dict['genbank'] not in written_contigs:
-                    contig_to_append.append(self.download_contig_from_ncbi(contig_dict['genbank']))
-            if contig_to_append:
-                shutil.copy(self.assembly_fasta_path, self.output_assembly_fasta_path, follow_symlinks=True)
-                with open(self.output_assembly_fasta_path, 'a+') as fasta:
-                    for contig_path in contig_to_append:
-                        with open(contig_path) as sequence:
-                            for line in sequence:
-                                # Check that the line is not empty
-                                if line.strip():
-                                    fasta.write(line)
-                        os.remove(contig_path)
-            else:
+            contig_to_append = [contig_dict['genbank'] for contig_dict in self.genbank_contig_to_add
+                                if contig_dict['genbank'] not in written_contigs]
+        if not contig_to_append:
+            if not os.path.lexists(self.output_assembly_fasta_path):
                 os.symlink(self.assembly_fasta_path, self.output_assembly_fasta_path)
-        else:
-            os.symlink(self.assembly_fasta_path, self.output_assembly_fasta_path)
+            return
+        self.info(f'Create custom assembly fasta for {self.assembly_accession}')
+        output_fasta = self._prepare_output_fasta()
+        contigs_in_output = set(output_fasta.get_contig_names())
+        bytes_appended = 0
+        for contig_accession in contig_to_append:
+            if contig_accession in contigs_in_output:
+                continue
+            contig_path = self.download_contig_from_ncbi(contig_accession)
+            header, sequence, line_bases = self._read_downloaded_contig(contig_path)
+            bytes_appended += output_fasta.append_record(header, sequence, line_bases)
+            os.remove(contig_path)
+        self.info(f'Appended {bytes_appended} bytes to {self.output_assembly_fasta_path}')
 
 
 class CustomAssemblyFromDatabase(CustomAssembly):
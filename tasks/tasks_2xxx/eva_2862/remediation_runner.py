@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+
+
+class RemediationRun:
+    """One Nextflow remediation of a source assembly for a taxonomy, run from its own working directory"""
+
+    def __init__(self, name, command, working_dir):
+        self.name = name
+        self.command = command
+        self.working_dir = working_dir
+
+    @property
+    def console_log(self):
+        return os.path.join(self.working_dir, 'nextflow_console.log')
+
+
+class RemediationStatusTable:
+    """
+    Status of every remediation run, stored in a JSON file rewritten after each change so that it survives a restart.
+    A run that was started but did not complete is resumed the next time it is launched.
+    """
+
+    def __init__(self, status_file):
+        self.status_file = status_file
+        self.lock = threading.Lock()
+        self.runs = {}
+        if os.path.exists(status_file):
+            with open(status_file) as open_file:
+                self.runs = json.load(open_file)
+
+    def _save(self):
+        # Write a new file and swap it in so an interruption never leaves a truncated table
+        tmp_status_file = self.status_file + '.tmp'
+        with open(tmp_status_file, 'w') as open_file:
+            json.dump(self.runs, open_file, indent=2, sort_keys=True)
+        os.replace(tmp_status_file, self.status_file)
+
+    def get_status(self, run_name):
+        with self.lock:
+            return self.runs.get(run_name, {}).get('status')
+
+    def is_completed(self, run_name):
+        return self.get_status(run_name) == COMPLETED
+
+    def needs_resume(self, run_name):
+        return self.get_status(run_name) in (RUNNING, FAILED)
+
+    def update(self, run_name, status, **details):
+        with self.lock:
+            run_status = self.runs.setdefault(run_name, {'attempts': 0})
+            if status == RUNNING:
+                run_status['attempts'] += 1
+            run_status.update(status=status, updated=time.strftime('%Y-%m-%d %H:%M:%S'), **details)
+            self._save()
+
+
+class RemediationRunner:
+    """
+    Run independent remediations concurrently, at most max_parallel_runs at a time. Each run is launched in its own
+    working directory without changing the working directory of this process. The resources of each run can be capped
+    with the maximum number of tasks Nextflow runs in parallel (queue_size) and the maximum heap of its JVM (max_heap).
+    Runs already completed according to the status table are skipped and the ones interrupted or failed are resumed.
+    """
+
+    def __init__(self, status_table, max_parallel_runs=1, queue_size=None, max_heap=None):
+        self.status_table = status_table
+        self.max_parallel_runs = max_parallel_runs
+        self.queue_size = queue_size
+        self.max_heap = max_heap
+
+    def _get_command(self, remediation_run, resume):
+        command = list(remediation_run.command)
+        if self.queue_size:
+            command.extend(['-queue-size', str(self.queue_size)])
+        if resume and '-resume' not in command:
+            command.append('-resume')
+        return command
+
+    def _get_environment(self):
+        env = dict(os.environ)
+        if self.max_heap:
+            env['NXF_OPTS'] = f'{env.get("NXF_OPTS", "")} -Xmx{self.max_heap}'.strip()
+        return env
+
+    def _run_one(self, remediation_run, resume):
+        resume = resume or self.status_table.needs_resume(remediation_run.name)
+        command = self._get_command(remediation_run, resume)
+        logger.info(f'{"Resume" if resume else "Start"} remediation {remediation_run.name}: {" ".join(command)}')
+        self.status_table.update(remediation_run.name, RUNNING, working_dir=remediation_run.working_dir,
+                                 resumed=resume)
+        start_time = time.perf_counter()
+        os.makedirs(remediation_run.working_dir, exist_ok=True)
+        with open(remediation_run.console_log, 'a') as console_log:
+            return_code = subprocess.call(command, cwd=remediation_run.working_dir, env=self._get_environment(),
+                                          stdout=console_log, stderr=subprocess.STDOUT)
+        duration = round(time.perf_counter() - start_time, 1)
+        status = COMPLETED if return_code == 0 else FAILED
+        self.status_table.update(remediation_run.name, status, return_code=return_code, duration=duration)
+        if status == FAILED:
+            logger.error(f'Remediation {remediation_run.name} failed with exit code {return_code}. '
+                         f'See {remediation_run.console_log}')
+        else:
+            logger.info(f'Remediation {remediation_run.name} completed in {duration}s')
+        return status
+
+    def run(self, remediation_runs, resume=False):
+        """
+        Run the remediations not completed yet, forcing -resume on all of them if resume is set.
+        Return the names of the runs that failed.
+        """
+        runs_to_launch = [remediation_run for remediation_run in remediation_runs
+                          if not self.status_table.is_completed(remediation_run.name)]
+        logger.info(f'{len(runs_to_launch)} remediations to run, '
+                    f'{len(remediation_runs) - len(runs_to_launch)} already completed')
+        failed_runs = []
+        with ThreadPoolExecutor(max_workers=self.max_parallel_runs) as executor:
+            futures = {executor.submit(self._run_one, remediation_run, resume): remediation_run
+                       for remediation_run in runs_to_launch}
+            for future in as_completed(futures):
+                remediation_run = futures[future]
+                try:
+                    status = future.result()
+                except Exception as e:
+                    logger.error(f'Could not run remediation {remediation_run.name}: {e}')
+                    self.status_table.update(remediation_run.name, FAILED, error=str(e))
+                    status = FAILED
+                if status == FAILED:
+                    failed_runs.append(remediation_run.name)
+        return failed_runs
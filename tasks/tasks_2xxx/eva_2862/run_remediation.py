@@ -1,11 +1,9 @@
 #!/usr/bin/env python
 import os
-import subprocess
 import sys
 from argparse import ArgumentParser
 
 import yaml
-from ebi_eva_common_pyutils import command_utils
 from ebi_eva_common_pyutils.config import cfg
 from ebi_eva_common_pyutils.config_utils import get_primary_mongo_creds_for_profile, get_accession_pg_creds_for_profile, \
     get_properties_from_xml_file
@@ -16,6 +14,7 @@ from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
 sys.path.append(os.path.dirname(__file__))
 
 from remapping_config import load_config
+from remediation_runner import RemediationRun, RemediationRunner, RemediationStatusTable
 
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
@@ -56,9 +55,10 @@ build.version=
     return template_file_path
 
 
-def process_one_taxonomy(assembly, taxid, scientific_name, target_assembly, resume):
+def prepare_one_taxonomy(assembly, taxid, scientific_name, target_assembly):
+    """Write the configuration of the remediation of the assembly for the taxonomy and return the run to launch"""
     base_directory = cfg['remapping']['base_directory']
-    nextflow_remapping_process = os.path.join(os.path.dirname(__file__), 'remediate.nf')
+    nextflow_remapping_process = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remediate.nf')
     assembly_directory = os.path.join(base_directory, str(taxid), assembly)
     work_dir = os.path.join(assembly_directory, 'work')
     prop_template_file = os.path.join(assembly_directory, 'template.properties')
@@ -81,27 +81,17 @@ def process_one_taxonomy(assembly, taxid, scientific_name, target_assembly, resu
     with open(remapping_config_file, 'w') as open_file:
         yaml.safe_dump(remapping_config, open_file)
 
-    try:
-        command = [
-            cfg['executable']['nextflow'],
-            '-log', remapping_log,
-            'run', nextflow_remapping_process,
-            '-params-file', remapping_config_file,
-            '-work-dir', work_dir
-        ]
-        if resume:
-            command.append('-resume')
-        curr_working_dir = os.getcwd()
-        os.chdir(assembly_directory)
-        command_utils.run_command_with_output('Nextflow remapping process', ' '.join(command))
-    except subprocess.CalledProcessError as e:
-        logger.error('Nextflow remapping pipeline failed')
-        raise e
-    finally:
-        os.chdir(curr_working_dir)
-
-
-def process_one_assembly(assembly, resume):
+    command = [
+        cfg['executable']['nextflow'],
+        '-log', remapping_log,
+        'run', nextflow_remapping_process,
+        '-params-file', remapping_config_file,
+        '-work-dir', work_dir
+    ]
+    return RemediationRun(f'{taxid}_{assembly}', command, assembly_directory)
+
+
+def get_taxonomies_for_assembly(assembly):
     # Check the original remapping tracking table for the appropriate taxonomies and target assemblies
     query = (
         'SELECT taxonomy, scientific_name, assembly_accession '
@@ -110,19 +100,42 @@ def process_one_assembly(assembly, resume):
         "AND source='DBSNP'"
     )
     with get_metadata_connection_handle(cfg['maven']['environment'], cfg['maven']['settings_file']) as pg_conn:
-        for taxid, scientific_name, target_assembly in get_all_results_for_query(pg_conn, query):
-            process_one_taxonomy(assembly, taxid, scientific_name, target_assembly, resume)
+        return get_all_results_for_query(pg_conn, query)
+
+
+def process_assemblies(assemblies, runner, resume):
+    """Remediate all the taxonomies of all the assemblies, running the remediations concurrently"""
+    remediation_runs = [
+        prepare_one_taxonomy(assembly, taxid, scientific_name, target_assembly)
+        for assembly in assemblies
+        for taxid, scientific_name, target_assembly in get_taxonomies_for_assembly(assembly)
+    ]
+    failed_runs = runner.run(remediation_runs, resume)
+    if failed_runs:
+        raise Exception(f'Remediation failed for {", ".join(failed_runs)}')
 
 
 def main():
-    argparse = ArgumentParser(description='Run remediation for one assembly')
-    argparse.add_argument('--assembly', help='Source assembly to remediate')
-    argparse.add_argument('--resume', action='store_true', default=False)
+    argparse = ArgumentParser(description='Run remediation for one or more assemblies')
+    argparse.add_argument('--assembly', nargs='+', required=True, help='Source assemblies to remediate')
+    argparse.add_argument('--resume', action='store_true', default=False,
+                          help='Resume all the remediations. Interrupted or failed ones are always resumed.')
+    argparse.add_argument('--max-parallel-runs', type=int, default=1,
+                          help='Maximum number of remediations running at the same time')
+    argparse.add_argument('--queue-size', type=int,
+                          help='Maximum number of tasks each remediation runs in parallel')
+    argparse.add_argument('--max-heap', help='Maximum heap of the Nextflow JVM of each remediation (ex: 4g)')
+    argparse.add_argument('--status-file',
+                          help='File recording the status of each remediation. '
+                               'Defaults to remediation_status.json in the remapping base directory')
 
     args = argparse.parse_args()
     load_config()
 
-    process_one_assembly(args.assembly, args.resume)
+    status_file = args.status_file or os.path.join(cfg['remapping']['base_directory'], 'remediation_status.json')
+    runner = RemediationRunner(RemediationStatusTable(status_file), max_parallel_runs=args.max_parallel_runs,
+                               queue_size=args.queue_size, max_heap=args.max_heap)
+    process_assemblies(args.assembly, runner, args.resume)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import os
+import shutil
+import stat
+import tempfile
+import time
+from unittest import TestCase
+
+from tasks.eva_2862.remediation_runner import RemediationRun, RemediationRunner, RemediationStatusTable, COMPLETED, \
+    FAILED
+
+# Stub Nextflow that records its arguments in the directory it runs from, sleeps, and fails if asked to
+STUB_NEXTFLOW = '''#!/bin/sh
+echo "$@" >> nextflow_calls.txt
+sleep {sleep_time}
+if [ -e fail ]; then
+    exit 1
+fi
+'''
+
+
+class TestRemediationRunner(TestCase):
+
+    sleep_time = 0.5
+
+    def setUp(self) -> None:
+        self.base_dir = tempfile.mkdtemp()
+        self.nextflow = os.path.join(self.base_dir, 'nextflow')
+        with open(self.nextflow, 'w') as open_file:
+            open_file.write(STUB_NEXTFLOW.format(sleep_time=self.sleep_time))
+        os.chmod(self.nextflow, os.stat(self.nextflow).st_mode | stat.S_IEXEC)
+        self.status_file = os.path.join(self.base_dir, 'remediation_status.json')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.base_dir)
+
+    def get_remediation_runs(self, num_runs, prefix='run'):
+        return [
+            RemediationRun(f'{prefix}{i}', [self.nextflow, 'run', 'remediate.nf'],
+                           os.path.join(self.base_dir, f'{prefix}{i}'))
+            for i in range(num_runs)
+        ]
+
+    def get_calls(self, remediation_run):
+        calls_file = os.path.join(remediation_run.working_dir, 'nextflow_calls.txt')
+        if not os.path.exists(calls_file):
+            return []
+        with open(calls_file) as open_file:
+            return [line.split() for line in open_file]
+
+    def run_remediations(self, remediation_runs, max_parallel_runs=1, resume=False):
+        runner = RemediationRunner(RemediationStatusTable(self.status_file), max_parallel_runs=max_parallel_runs)
+        start_time = time.perf_counter()
+        failed_runs = runner.run(remediation_runs, resume)
+        return failed_runs, time.perf_counter() - start_time
+
+    def test_wall_clock_scales_with_parallel_runs(self):
+        cwd = os.getcwd()
+        num_runs = 4
+        _, serial_duration = self.run_remediations(self.get_remediation_runs(num_runs, 'serial'))
+        _, parallel_duration = self.run_remediations(self.get_remediation_runs(num_runs, 'parallel'),
+                                                     max_parallel_runs=num_runs)
+        self.assertGreaterEqual(serial_duration, num_runs * self.sleep_time)
+        self.assertLess(parallel_duration, serial_duration / 2)
+        self.assertEqual(cwd, os.getcwd())
+        # Each remediation ran from its own working directory
+        for remediation_run in self.get_remediation_runs(num_runs, 'parallel'):
+            self.assertEqual([['run', 'remediate.nf']], self.get_calls(remediation_run))
+
+    def test_only_failed_run_resumed(self):
+        remediation_runs = self.get_remediation_runs(3)
+        failing_run = remediation_runs[1]
+        os.makedirs(failing_run.working_dir)
+        open(os.path.join(failing_run.working_dir, 'fail'), 'w').close()
+
+        failed_runs, _ = self.run_remediations(remediation_runs, max_parallel_runs=3)
+        self.assertEqual([failing_run.name], failed_runs)
+        status_table = RemediationStatusTable(self.status_file)
+        self.assertEqual([COMPLETED, FAILED, COMPLETED],
+                         [status_table.get_status(remediation_run.name) for remediation_run in remediation_runs])
+
+        # On restart the completed runs are skipped and the failed one is relaunched with -resume
+        os.remove(os.path.join(failing_run.working_dir, 'fail'))
+        failed_runs, _ = self.run_remediations(remediation_runs, max_parallel_runs=3)
+        self.assertEqual([], failed_runs)
+        self.assertEqual([['run', 'remediate.nf']], self.get_calls(remediation_runs[0]))
+        self.assertEqual([['run', 'remediate.nf'], ['run', 'remediate.nf', '-resume']], self.get_calls(failing_run))
+        self.assertEqual([['run', 'remediate.nf']], self.get_calls(remediation_runs[2]))
+        status_table = RemediationStatusTable(self.status_file)
+        self.assertTrue(all(status_table.is_completed(remediation_run.name) for remediation_run in remediation_runs))
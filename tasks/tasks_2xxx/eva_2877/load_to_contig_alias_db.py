@@ -1,21 +1,18 @@
 import argparse
 import os
 
-import requests
 from ebi_eva_common_pyutils.config_utils import get_contig_alias_db_creds_for_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.metadata_utils import get_metadata_connection_handle
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
-from retry import retry
+
+from tasks.eva_2877.contig_alias_loader import ContigAliasLoader, AssemblyOutcome, LOADED, ALREADY_LOADED, FAILED, \
+    RETRIABLE_STATUS_CODES
 
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
 
-class InternalServerError(Exception):
-    pass
-
-
 def get_assemblies_from_evapro(profile, private_config_xml_file):
     with get_metadata_connection_handle(profile, private_config_xml_file) as pg_conn:
         query = "select distinct assembly_accession from evapro.accessioned_assembly where assembly_accession like 'GCA%'" \
@@ -25,54 +22,48 @@ def get_assemblies_from_evapro(profile, private_config_xml_file):
         return [asm[0] for asm in evapro_assemblies]
 
 
-def load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite):
-    logger.info(f"A total of {len(assemblies)} assemblies to be loaded into contig-alias database: {assemblies}")
-
-    for assembly in assemblies:
+def get_load_assembly(contig_alias_url, contig_alias_user, contig_alias_pass, overwrite):
+    async def load_assembly(loader, assembly):
         full_url = os.path.join(contig_alias_url, f'v1/admin/assemblies/{assembly}')
+        auth = (contig_alias_user, contig_alias_pass)
         if overwrite:
-            # delete request for assembly
-            del_request(assembly, full_url, contig_alias_user, contig_alias_pass)
-
-        try:
-            # insert request for assembly
-            insert_request(assembly, full_url, contig_alias_user, contig_alias_pass)
-        except InternalServerError as err:
-            logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {err}')
-
-
-@retry(InternalServerError, tries=3, delay=2, backoff=1.5, jitter=(1, 3))
-def del_request(assembly, url, user, password):
-    response = requests.delete(url, auth=(user, password))
-    if response.status_code == 200:
-        logger.info(f'Assembly accession {assembly} successfully deleted from Contig-Alias DB')
-    elif response.status_code == 500:
-        logger.error(f'Assembly accession {assembly} could not be deleted. Response: {response.text}')
-        raise InternalServerError
-    else:
-        logger.error(f'Assembly accession {assembly} could not be deleted. Response: {response.text}')
-
-
-@retry(InternalServerError, tries=3, delay=2, backoff=1.5, jitter=(1, 3))
-def insert_request(assembly, url, user, password):
-    response = requests.put(url, auth=(user, password))
-    if response.status_code == 200:
-        logger.info(f'Assembly accession {assembly} successfully added to Contig-Alias DB')
-    elif response.status_code == 409:
-        logger.warning(f'Assembly accession {assembly} already exist in Contig-Alias DB. Response: {response.text}')
-    elif response.status_code == 500:
-        logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {response.text}')
-        raise InternalServerError
-    else:
-        logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {response.text}')
-
-
-def load_data_to_contig_alias(private_config_xml_file, profile, assembly_list, overwrite):
+            response = await loader.request(assembly, 'DELETE', full_url, auth=auth)
+            if response.status_code == 200:
+                logger.info(f'Assembly accession {assembly} successfully deleted from Contig-Alias DB')
+            elif response.status_code in RETRIABLE_STATUS_CODES:
+                return AssemblyOutcome(FAILED, response.status_code, f'Could not be deleted: {response.text}')
+            else:
+                logger.error(f'Assembly accession {assembly} could not be deleted. Response: {response.text}')
+
+        response = await loader.request(assembly, 'PUT', full_url, auth=auth)
+        if response.status_code == 200:
+            logger.info(f'Assembly accession {assembly} successfully added to Contig-Alias DB')
+            return AssemblyOutcome(LOADED, response.status_code)
+        elif response.status_code == 409:
+            logger.warning(f'Assembly accession {assembly} already exist in Contig-Alias DB. Response: {response.text}')
+            return AssemblyOutcome(ALREADY_LOADED, response.status_code)
+        return AssemblyOutcome(FAILED, response.status_code, response.text)
+    return load_assembly
+
+
+def load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite,
+                                  journal_file, resume=False, max_concurrent_requests=8, max_requests_per_second=None):
+    logger.info(f"A total of {len(assemblies)} assemblies to be loaded into contig-alias database: {assemblies}")
+    loader = ContigAliasLoader(journal_file, max_concurrent_requests=max_concurrent_requests,
+                               max_requests_per_second=max_requests_per_second)
+    # Assemblies loaded before are loaded again when overwriting, even if the journal says they are completed
+    return loader.run(assemblies, get_load_assembly(contig_alias_url, contig_alias_user, contig_alias_pass,
+                                                       overwrite), resume=resume and not overwrite)
+
+
+def load_data_to_contig_alias(private_config_xml_file, profile, assembly_list, overwrite, journal_file, resume=False,
+                              max_concurrent_requests=8, max_requests_per_second=None):
     assemblies = assembly_list if assembly_list else get_assemblies_from_evapro(profile, private_config_xml_file)
     contig_alias_url, contig_alias_user, contig_alias_pass = get_contig_alias_db_creds_for_profile(
         profile, private_config_xml_file)
 
-    load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite)
+    load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite,
+                                  journal_file, resume, max_concurrent_requests, max_requests_per_second)
 
 
 if __name__ == "__main__":
@@ -83,8 +74,19 @@ if __name__ == "__main__":
     parser.add_argument("--assembly-list", help="Assembly list e.g. GCA_000181335.4", required=False, nargs='+')
     parser.add_argument("--overwrite", action="store_true", default=False,
                         help="Whether to delete and re-insert assembly information")
+    parser.add_argument("--journal-file", default='eva2877_contig_alias_load_journal.jsonl',
+                        help="File recording the outcome of each assembly")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Skip the assemblies already loaded according to the journal file. "
+                             "Ignored with --overwrite")
+    parser.add_argument("--max-concurrent-requests", type=int, default=8,
+                        help="Maximum number of requests sent to the contig-alias API at once")
+    parser.add_argument("--max-requests-per-second", type=float, default=None,
+                        help="Maximum number of requests per second sent to the contig-alias host")
 
     args = parser.parse_args()
 
-    load_data_to_contig_alias(args.private_config_xml_file, args.profile, args.assembly_list, args.overwrite)
+    load_data_to_contig_alias(args.private_config_xml_file, args.profile, args.assembly_list, args.overwrite,
+                              args.journal_file, args.resume, args.max_concurrent_requests,
+                              args.max_requests_per_second)
 
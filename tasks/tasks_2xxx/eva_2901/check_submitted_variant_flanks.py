@@ -6,13 +6,19 @@ import itertools
 
 from Bio import pairwise2
 from Bio.Seq import Seq
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from ebi_eva_common_pyutils.config import cfg
 from ebi_eva_common_pyutils.config_utils import get_primary_mongo_creds_for_profile
 from ebi_eva_common_pyutils.taxonomy.taxonomy import get_scientific_name_from_ensembl
 from pymongo import MongoClient
 
-cache = {'scientific_name_from_taxonomy': {}}
+from tasks.eva_2901.fasta_flank_extractor import FastaFlankExtractor
+
+cache = {'scientific_name_from_taxonomy': {}, 'flank_extractors': {}}
+
+MATCH_SCORE = 1
+MISMATCH_SCORE = -3
+GAP_OPEN_SCORE = -10
+GAP_EXTEND_SCORE = -10
 
 
 def revcomp(seq):
@@ -34,9 +40,20 @@ def get_genome(taxonomy, assembly_accession):
     )
 
 
+def get_flank_extractor(genome_assembly_fasta):
+    if genome_assembly_fasta not in cache['flank_extractors']:
+        cache['flank_extractors'][genome_assembly_fasta] = FastaFlankExtractor(genome_assembly_fasta)
+    return cache['flank_extractors'][genome_assembly_fasta]
+
+
+def align(sequence1, sequence2):
+    return pairwise2.align.globalms(sequence1, sequence2, MATCH_SCORE, MISMATCH_SCORE, GAP_OPEN_SCORE,
+                                    GAP_EXTEND_SCORE, one_alignment_only=True)
+
+
 def compare_variant_flanks(sequence1, sequence2):
-    alignments1 = pairwise2.align.globalms(sequence1, sequence2, 1, -3, -10, -10, one_alignment_only=True)
-    alignments2 = pairwise2.align.globalms(sequence1, revcomp(sequence2), 1, -3, -10, -10, one_alignment_only=True)
+    alignments1 = align(sequence1, sequence2)
+    alignments2 = align(sequence1, revcomp(sequence2))
 
     if alignments1 and alignments2:
         if alignments2[0].score > alignments1[0].score:
@@ -49,6 +66,84 @@ def compare_variant_flanks(sequence1, sequence2):
         return alignments2, '-'
 
 
+class FlankComparator:
+    """
+    Give the same result as compare_variant_flanks while running as few alignments as possible:
+    1. Sequences identical on the forward or reverse strand get their (gapless) alignment without any alignment run.
+    2. An orientation that shares no k-mer with the first sequence cannot score more than a computable bound, so it
+       is not aligned when the other orientation already scores above that bound.
+    3. Remaining orientations are aligned and every result is memoised per pair of sequences.
+    """
+
+    def __init__(self, kmer_size=8):
+        self.kmer_size = kmer_size
+        self.comparison_cache = {}
+        self.num_comparisons = 0
+        self.num_alignments = 0
+
+    def clear_cache(self):
+        self.comparison_cache.clear()
+
+    def _kmers(self, sequence):
+        return {sequence[i:i + self.kmer_size] for i in range(len(sequence) - self.kmer_size + 1)}
+
+    def _max_score_without_shared_kmer(self, sequence1, sequence2):
+        """
+        Upper bound of the global alignment score of two sequences that have no k-mer in common: runs of matches are
+        shorter than k so they are separated by mismatches or gaps, and every position of the longest sequence that
+        is not a match costs at least a mismatch.
+        """
+        min_length, max_length = sorted((len(sequence1), len(sequence2)))
+        max_run_length = self.kmer_size - 1
+        return max(
+            num_matches * MATCH_SCORE + MISMATCH_SCORE * max(max_length - num_matches,
+                                                              -(-num_matches // max_run_length) - 1)
+            for num_matches in range(min_length + 1)
+        )
+
+    def _align(self, sequence1, sequence2):
+        self.num_alignments += 1
+        return align(sequence1, sequence2)[0]
+
+    def compare(self, sequence1, sequence2):
+        self.num_comparisons += 1
+        if (sequence1, sequence2) not in self.comparison_cache:
+            self.comparison_cache[(sequence1, sequence2)] = self._compare(sequence1, sequence2)
+        return self.comparison_cache[(sequence1, sequence2)]
+
+    def _compare(self, sequence1, sequence2):
+        if not sequence1 or not sequence2:
+            self.num_alignments += 2
+            return compare_variant_flanks(sequence1, sequence2)
+        revcomp_sequence2 = revcomp(sequence2)
+        if sequence1 == sequence2:
+            return pairwise2.Alignment(sequence1, sequence2, float(len(sequence1) * MATCH_SCORE), 0,
+                                       len(sequence1)), '+'
+        if sequence1 == revcomp_sequence2:
+            return pairwise2.Alignment(sequence1, revcomp_sequence2, float(len(sequence1) * MATCH_SCORE), 0,
+                                       len(sequence1)), '-'
+
+        kmers1 = self._kmers(sequence1)
+        forward_shares_kmer = not kmers1.isdisjoint(self._kmers(sequence2))
+        reverse_shares_kmer = not kmers1.isdisjoint(self._kmers(revcomp_sequence2))
+        alignment1 = alignment2 = None
+        if forward_shares_kmer and not reverse_shares_kmer:
+            alignment1 = self._align(sequence1, sequence2)
+            # Ties are resolved on the forward strand
+            if alignment1.score >= self._max_score_without_shared_kmer(sequence1, revcomp_sequence2):
+                return alignment1, '+'
+        elif reverse_shares_kmer and not forward_shares_kmer:
+            alignment2 = self._align(sequence1, revcomp_sequence2)
+            if alignment2.score > self._max_score_without_shared_kmer(sequence1, sequence2):
+                return alignment2, '-'
+
+        alignment1 = alignment1 or self._align(sequence1, sequence2)
+        alignment2 = alignment2 or self._align(sequence1, revcomp_sequence2)
+        if alignment2.score > alignment1.score:
+            return alignment2, '-'
+        return alignment1, '+'
+
+
 def format_output(ssid, variant1, variant2, alignment, strand, flank_up1, flank_down1, flank_up2, flank_down2):
     ref1 = ' '.join((flank_up1, variant1['ref'], flank_down1))
     ref_bases = variant2['ref'] if strand == '+' else revcomp(variant2['ref'])
@@ -65,25 +160,24 @@ def format_output(ssid, variant1, variant2, alignment, strand, flank_up1, flank_
     return '\t'.join([str(s) for s in out])
 
 
-def check_submitted_variant_flanks(mongo_client, ssid):
-    samtools = cfg.query('executable', 'samtools', ret_default='samtools')
+def check_submitted_variant_flanks(mongo_client, ssid, flank_comparator):
     sve_collection = mongo_client['eva_accession_sharded']['dbsnpSubmittedVariantEntity']
     cursor = sve_collection.find({'accession': int(ssid), 'remappedFrom': {'$exists': False}})
     flank_size = 50
     variant_records = list(cursor)
     id_2_info = {}
     for variant_rec in variant_records:
-        flank_up_coord = f"{variant_rec['contig']}:{variant_rec['start'] - flank_size}-{variant_rec['start'] - 1}"
-        flank_down_coord = f"{variant_rec['contig']}:{variant_rec['start'] + 1}-{variant_rec['start'] + flank_size}"
         genome_assembly_fasta = get_genome(assembly_accession=variant_rec['seq'], taxonomy=variant_rec['tax'])
-        command = f"{samtools} faidx {genome_assembly_fasta} {flank_up_coord} | grep -v '^>' | sed 's/\\n//' "
-        flank_up = run_command_with_output(f'Extract upstream sequence using {flank_up_coord}',  command, return_process_output=True).strip().upper()
-        command = f"{samtools} faidx {genome_assembly_fasta} {flank_down_coord} | grep -v '^>' | sed 's/\\n//' "
-        flank_down = run_command_with_output(f'Extract downstream sequence using {flank_down_coord}',  command, return_process_output=True).strip().upper()
+        flank_up, flank_down = get_flank_extractor(genome_assembly_fasta).fetch_many([
+            (variant_rec['contig'], variant_rec['start'] - flank_size, variant_rec['start'] - 1),
+            (variant_rec['contig'], variant_rec['start'] + 1, variant_rec['start'] + flank_size)
+        ])
+        flank_up, flank_down = flank_up.upper(), flank_down.upper()
         id_2_info[variant_rec['_id']] = {'variant_rec': variant_rec, 'flank_up': flank_up, 'flank_down': flank_down}
 
+    flank_comparator.clear_cache()
     for variant_id1, variant_id2 in list(itertools.combinations(id_2_info, 2)):
-        alignment, strand = compare_variant_flanks(
+        alignment, strand = flank_comparator.compare(
             id_2_info[variant_id1]['flank_up'] + id_2_info[variant_id1]['variant_rec']['ref'] + id_2_info[variant_id1]['flank_down'],
             id_2_info[variant_id2]['flank_up'] + id_2_info[variant_id2]['variant_rec']['ref'] + id_2_info[variant_id2]['flank_down']
         )
@@ -115,10 +209,12 @@ if __name__ == '__main__':
     mongo_uri = f'mongodb://{mongo_user}:@{mongo_host}:27017/eva_accession_sharded?authSource=admin'
     mongo_client = MongoClient(mongo_uri, password=mongo_pass)
     nb_ssids = 0
+    flank_comparator = FlankComparator()
     with open(args.ssid_file) as open_file:
         for line in open_file:
             nb_ssids += 1
             if nb_ssids % 1000 == 0 :
-                print(f'Processed {nb_ssids} ssids', file=sys.stderr)
-            check_submitted_variant_flanks(mongo_client, line.strip())
+                print(f'Processed {nb_ssids} ssids: {flank_comparator.num_alignments} alignments for '
+                      f'{flank_comparator.num_comparisons} flank comparisons', file=sys.stderr)
+            check_submitted_variant_flanks(mongo_client, line.strip(), flank_comparator)
     mongo_client.close()
@@ -0,0 +1,86 @@
+import mmap
+import os
+from collections import namedtuple
+
+FaiEntry = namedtuple('FaiEntry', ['length', 'offset', 'line_bases', 'line_width'])
+
+COMPLEMENT = str.maketrans('ACGTRYKMBDHVNacgtrykmbdhvn', 'TGCAYRMKVHDBNtgcayrmkvhdbn')
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def build_fasta_index(fasta_path, fai_path):
+    """Write a samtools compatible .fai index for fasta_path"""
+    entries = []
+    with open(fasta_path, 'rb') as fasta:
+        offset = 0
+        name = None
+        for line in fasta:
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append((name, length, seq_offset, line_bases or 0, line_width or 0))
+                name = line[1:].split()[0].decode()
+                length = 0
+                seq_offset = offset + len(line)
+                line_bases = line_width = None
+            elif name is not None:
+                if line_bases is None:
+                    line_bases = len(line.rstrip(b'\r\n'))
+                    line_width = len(line)
+                length += len(line.rstrip(b'\r\n'))
+            offset += len(line)
+        if name is not None:
+            entries.append((name, length, seq_offset, line_bases or 0, line_width or 0))
+    with open(fai_path, 'w') as fai:
+        for entry in entries:
+            fai.write('\t'.join(str(field) for field in entry) + '\n')
+
+
+class FastaFlankExtractor:
+    """
+    Extract sub-sequences from a FASTA file in-process using its .fai index and a memory map of the file.
+    Coordinates are 1-based and inclusive like samtools faidx regions and are clipped to the contig boundaries.
+    """
+
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        fai_path = fasta_path + '.fai'
+        if not os.path.exists(fai_path):
+            build_fasta_index(fasta_path, fai_path)
+        self.index = {}
+        with open(fai_path) as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                self.index[name] = FaiEntry(int(length), int(offset), int(line_bases), int(line_width))
+        self._file = open(fasta_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _file_position(self, entry, position):
+        """File offset of the 0-based position in the contig"""
+        return entry.offset + (position // entry.line_bases) * entry.line_width + position % entry.line_bases
+
+    def fetch(self, contig, start, end, reverse=False):
+        entry = self.index[contig]
+        start = max(start, 1)
+        end = min(end, entry.length)
+        if start > end:
+            return ''
+        raw = self._mmap[self._file_position(entry, start - 1):self._file_position(entry, end - 1) + 1]
+        sequence = raw.translate(None, b'\r\n').decode()
+        return reverse_complement(sequence) if reverse else sequence
+
+    def fetch_many(self, regions):
+        """Fetch a batch of (contig, start, end) or (contig, start, end, reverse) regions"""
+        return [self.fetch(*region) for region in regions]
@@ -0,0 +1,55 @@
+import itertools
+import random
+from unittest import TestCase
+
+from tasks.eva_2901.check_submitted_variant_flanks import FlankComparator, compare_variant_flanks, revcomp
+
+
+def mutate(sequence, rng, num_mutations):
+    sequence = list(sequence)
+    for _ in range(num_mutations):
+        position = rng.randrange(len(sequence))
+        mutation = rng.choice(['substitution', 'insertion', 'deletion'])
+        if mutation == 'substitution':
+            sequence[position] = rng.choice('ACGT')
+        elif mutation == 'insertion':
+            sequence.insert(position, rng.choice('ACGT'))
+        else:
+            del sequence[position]
+    return ''.join(sequence)
+
+
+class TestFlankComparator(TestCase):
+
+    def setUp(self) -> None:
+        rng = random.Random(2901)
+        self.flanks = []
+        for _ in range(4):
+            flank = ''.join(rng.choice('ACGT') for _ in range(101))
+            self.flanks.extend([flank, flank, revcomp(flank), mutate(flank, rng, 2), revcomp(mutate(flank, rng, 5)),
+                                mutate(flank, rng, 30)])
+        # Low complexity flanks share k-mers on both strands
+        self.flanks.extend(['AT' * 50 + 'G', 'TA' * 50 + 'C', 'A' * 101])
+
+    def test_same_result_as_compare_variant_flanks(self):
+        flank_comparator = FlankComparator()
+        for flank1, flank2 in itertools.combinations(self.flanks, 2):
+            expected_alignment, expected_strand = compare_variant_flanks(flank1, flank2)
+            alignment, strand = flank_comparator.compare(flank1, flank2)
+            self.assertEqual(expected_strand, strand)
+            self.assertEqual(expected_alignment, alignment)
+        self.assertLess(flank_comparator.num_alignments, 2 * flank_comparator.num_comparisons)
+
+    def test_no_alignment_for_identical_flanks(self):
+        flank_comparator = FlankComparator()
+        flank = self.flanks[0]
+        for flank1, flank2 in itertools.combinations([flank, flank, revcomp(flank)], 2):
+            flank_comparator.compare(flank1, flank2)
+        self.assertEqual(3, flank_comparator.num_comparisons)
+        self.assertEqual(0, flank_comparator.num_alignments)
+
+    def test_max_score_without_shared_kmer(self):
+        flank_comparator = FlankComparator(kmer_size=3)
+        # Runs of at most 2 matches separated by mismatches: MM-MM-MM-MM scores 8 - 3 * 3
+        self.assertEqual(-1, flank_comparator._max_score_without_shared_kmer('A' * 11, 'A' * 11))
+        self.assertEqual(2, flank_comparator._max_score_without_shared_kmer('AA', 'AA'))
@@ -0,0 +1,78 @@
+import os
+import shutil
+import subprocess
+from unittest import TestCase, skipUnless
+
+from tasks.eva_2901.fasta_flank_extractor import FastaFlankExtractor, reverse_complement, build_fasta_index
+
+
+class TestFastaFlankExtractor(TestCase):
+
+    test_dir = os.path.dirname(__file__)
+    fasta_path = os.path.join(test_dir, 'genome.fa')
+
+    def setUp(self) -> None:
+        self.sequences = {}
+        with open(self.fasta_path) as fasta:
+            for line in fasta:
+                if line.startswith('>'):
+                    name = line[1:].split()[0]
+                    self.sequences[name] = ''
+                else:
+                    self.sequences[name] += line.strip()
+        self.extractor = FastaFlankExtractor(self.fasta_path)
+
+    def tearDown(self) -> None:
+        self.extractor.close()
+
+    def test_fetch(self):
+        for contig, sequence in self.sequences.items():
+            for start in range(1, len(sequence) + 1, 7):
+                for end in range(start, len(sequence) + 1, 11):
+                    self.assertEqual(sequence[start - 1:end], self.extractor.fetch(contig, start, end))
+
+    def test_fetch_clipped_to_contig(self):
+        sequence = self.sequences['chr2']
+        self.assertEqual(sequence[:10], self.extractor.fetch('chr2', -40, 10))
+        self.assertEqual(sequence[80:], self.extractor.fetch('chr2', 81, 130))
+        self.assertEqual('', self.extractor.fetch('chr2', 100, 150))
+
+    def test_fetch_many_reverse_complement(self):
+        sequence = self.sequences['chr1']
+        self.assertEqual(
+            [sequence[55:65], reverse_complement(sequence[55:65])],
+            self.extractor.fetch_many([('chr1', 56, 65), ('chr1', 56, 65, True)])
+        )
+        self.assertEqual('NnacgtACGT', reverse_complement('ACGTacgtnN'))
+
+    def test_build_fasta_index(self):
+        fai_path = os.path.join(self.test_dir, 'rebuilt.fa.fai')
+        try:
+            build_fasta_index(self.fasta_path, fai_path)
+            with open(fai_path) as rebuilt, open(self.fasta_path + '.fai') as expected:
+                self.assertEqual(expected.read(), rebuilt.read())
+        finally:
+            os.remove(fai_path)
+
+    def test_build_fasta_index_empty_record(self):
+        fasta_path = os.path.join(self.test_dir, 'empty_record.fa')
+        fai_path = fasta_path + '.fai'
+        try:
+            with open(fasta_path, 'w') as fasta:
+                fasta.write('>a\n>b\nACGT\n>c\n')
+            build_fasta_index(fasta_path, fai_path)
+            with open(fai_path) as fai:
+                self.assertEqual('a\t0\t3\t0\t0\nb\t4\t6\t4\t5\nc\t0\t14\t0\t0\n', fai.read())
+        finally:
+            for path in (fasta_path, fai_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @skipUnless(shutil.which('samtools'), 'samtools is not installed')
+    def test_identical_to_samtools(self):
+        for contig, sequence in self.sequences.items():
+            for start, end in [(1, 50), (20, 70), (len(sequence) - 30, len(sequence))]:
+                samtools_output = subprocess.run(['samtools', 'faidx', self.fasta_path, f'{contig}:{start}-{end}'],
+                                                 capture_output=True, text=True, check=True).stdout
+                expected = ''.join(samtools_output.splitlines()[1:])
+                self.assertEqual(expected, self.extractor.fetch(contig, start, end))
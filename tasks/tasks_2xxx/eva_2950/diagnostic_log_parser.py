@@ -0,0 +1,211 @@
+import ast
+import datetime
+import json
+import os
+import pickle
+import re
+
+from bson import ObjectId
+
+# Tokens allowed in the python representation of the documents dumped in the EVA-2850 logs
+TOKEN_REGEX = re.compile(r"""\s*(?:
+    (?P<string>'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*")
+    |(?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+    |(?P<punctuation>[\[\]{}(),:])
+    |(?P<name>datetime\.datetime|ObjectId|True|False|None)
+)""", re.VERBOSE)
+
+CONSTANTS = {'True': True, 'False': False, 'None': None}
+
+DATETIME_KEY = '__eva2950_datetime__'
+OBJECTID_KEY = '__eva2950_objectid__'
+# Rewrite the python literals to JSON so that most documents can be decoded by the json module. Anything that cannot be
+# translated safely (escape sequences, tuples, JSON only constants...) is left to the LiteralParser.
+TO_JSON_REGEX = re.compile(r"""
+    '([^'\\"]*)'
+    |("[^"\\]*")
+    |\b(True)\b|\b(False)\b|\b(None)\b
+    |datetime\.datetime\(([\d,\ ]+)\)
+    |ObjectId\('([0-9a-fA-F]{24})'\)
+    |(\btrue\b|\bfalse\b|\bnull\b|\bNaN\b|\bInfinity\b|[()'"\\])
+""", re.VERBOSE)
+JSON_CONSTANTS = {3: 'true', 4: 'false', 5: 'null'}
+
+
+class NotTranslatableToJson(Exception):
+    pass
+
+
+class LiteralParser:
+    """
+    Parse the python representation of documents (dict, list, tuple, str, int, float, bool, None, datetime.datetime
+    and ObjectId) without evaluating any code. Anything outside this grammar raises a ValueError.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        position = 0
+        text_length = len(text.rstrip())
+        while position < text_length:
+            match = TOKEN_REGEX.match(text, position)
+            if not match:
+                raise ValueError(text)
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        self.position = 0
+
+    def parse(self):
+        value = self._parse_value()
+        if self.position != len(self.tokens):
+            raise ValueError(self.text)
+        return value
+
+    def _next(self):
+        try:
+            token = self.tokens[self.position]
+        except IndexError:
+            raise ValueError(self.text)
+        self.position += 1
+        return token
+
+    def _expect(self, punctuation):
+        if self._next() != ('punctuation', punctuation):
+            raise ValueError(self.text)
+
+    def _peek_punctuation(self, punctuation):
+        return self.position < len(self.tokens) and self.tokens[self.position] == ('punctuation', punctuation)
+
+    def _parse_sequence(self, closing, parse_item):
+        """Parse comma separated items, allowing a trailing comma, until the closing punctuation"""
+        while not self._peek_punctuation(closing):
+            parse_item()
+            if not self._peek_punctuation(closing):
+                self._expect(',')
+        self.position += 1
+
+    def _parse_value(self):
+        kind, token = self._next()
+        if kind == 'string':
+            if '\\' in token:
+                # Only a string literal can reach here so literal_eval is used to decode its escape sequences
+                return ast.literal_eval(token)
+            return token[1:-1]
+        if kind == 'number':
+            if '.' in token or 'e' in token or 'E' in token:
+                return float(token)
+            return int(token)
+        if kind == 'name':
+            if token in CONSTANTS:
+                return CONSTANTS[token]
+            self._expect('(')
+            arguments = []
+            self._parse_sequence(')', lambda: arguments.append(self._parse_value()))
+            if token == 'ObjectId':
+                if len(arguments) != 1 or not isinstance(arguments[0], str):
+                    raise ValueError(self.text)
+                return ObjectId(arguments[0])
+            if not arguments or not all(isinstance(argument, int) for argument in arguments):
+                raise ValueError(self.text)
+            return datetime.datetime(*arguments)
+        if token == '{':
+            dictionary = {}
+
+            def parse_item():
+                key = self._parse_value()
+                self._expect(':')
+                dictionary[key] = self._parse_value()
+            self._parse_sequence('}', parse_item)
+            return dictionary
+        if token == '[':
+            values = []
+            self._parse_sequence(']', lambda: values.append(self._parse_value()))
+            return values
+        if token == '(':
+            values = []
+            self._parse_sequence(')', lambda: values.append(self._parse_value()))
+            return tuple(values)
+        raise ValueError(self.text)
+
+
+def _to_json(match):
+    group = match.lastindex
+    if group == 1:
+        if match.group(1) in (DATETIME_KEY, OBJECTID_KEY):
+            raise NotTranslatableToJson
+        return '"' + match.group(1) + '"'
+    if group == 2:
+        return match.group(2)
+    if group in JSON_CONSTANTS:
+        return JSON_CONSTANTS[group]
+    if group == 6:
+        return '{"' + DATETIME_KEY + '": [' + match.group(6) + ']}'
+    if group == 7:
+        return '{"' + OBJECTID_KEY + '": "' + match.group(7) + '"}'
+    raise NotTranslatableToJson
+
+
+def _decode_special_values(dictionary):
+    if len(dictionary) == 1:
+        if DATETIME_KEY in dictionary:
+            return datetime.datetime(*dictionary[DATETIME_KEY])
+        if OBJECTID_KEY in dictionary:
+            return ObjectId(dictionary[OBJECTID_KEY])
+    return dictionary
+
+
+def parse_literal(text):
+    try:
+        return json.loads(TO_JSON_REGEX.sub(_to_json, text), object_hook=_decode_special_values)
+    except (NotTranslatableToJson, ValueError, TypeError):
+        return LiteralParser(text).parse()
+
+
+def iterate_diagnostic_log(log_file):
+    """Yield the RS id and the list of submitted variants of every split candidate found in the log"""
+    rsid = None
+    with open(log_file) as open_file:
+        for line in open_file:
+            line = line.strip()
+            if rsid:
+                # We are parsing the line just after finding the RS id
+                yield rsid, parse_literal(line[11:])
+                rsid = None
+            if 'Not all original SS has same info' in line:
+                sp_line = line.split()
+                rsid = int(sp_line[4].strip(','))
+
+        if rsid:
+            yield rsid, parse_literal(line[11:])
+
+
+def write_record_file(records, record_file):
+    """Write the records to a binary file that can be read back without parsing the log, and yield them"""
+    with open(record_file + '.tmp', 'wb') as open_file:
+        for record in records:
+            pickle.dump(record, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+            yield record
+    os.replace(record_file + '.tmp', record_file)
+
+
+def read_record_file(record_file):
+    with open(record_file, 'rb') as open_file:
+        while True:
+            try:
+                yield pickle.load(open_file)
+            except EOFError:
+                return
+
+
+def parse_diagnostic_log(log_file, record_file=None):
+    """
+    Stream the split candidates of an EVA-2850 diagnostic log.
+    When a record file is provided it is read instead of the log if it is more recent, otherwise it is created while
+    the log is parsed.
+    """
+    if record_file and os.path.exists(record_file) and os.path.getmtime(record_file) >= os.path.getmtime(log_file):
+        return read_record_file(record_file)
+    records = iterate_diagnostic_log(log_file)
+    if record_file:
+        return write_record_file(records, record_file)
+    return records
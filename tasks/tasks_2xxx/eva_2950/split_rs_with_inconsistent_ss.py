@@ -1,18 +1,20 @@
 import os
-import ast
 import glob
+import time
 from argparse import ArgumentParser
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import zip_longest
 
 from ebi_eva_common_pyutils.config_utils import get_mongo_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
-import datetime
 
 from pyfaidx import Fasta
 from pymongo import MongoClient, WriteConcern, ReadPreference
 from pymongo.read_concern import ReadConcern
 
+from tasks.eva_2950.diagnostic_log_parser import parse_diagnostic_log
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
@@ -152,42 +154,8 @@ def add_contex_base(fa, chrom, pos, ref, alt):
     return pos, ref, alt
 
 
-def ast_parse_with_datetime(astr):
-    """
-    Parse a string representing a python data structure into a python data structure
-    Based on https://stackoverflow.com/questions/4235606/way-to-use-ast-literal-eval-to-convert-string-into-a-datetime
-    """
-    try:
-        tree = ast.parse(astr)
-    except SyntaxError:
-        raise ValueError(astr)
-    for node in ast.walk(tree):
-        if isinstance(node, (ast.Module, ast.Expr, ast.Dict, ast.Str, ast.List, ast.Constant,
-                            ast.Attribute, ast.Num, ast.Name, ast.Load, ast.Tuple)):
-            continue
-        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'datetime':
-            continue
-        raise ValueError(astr)
-    return eval(astr)
-
-
-def parse_eva2850_diagnostic_log(log_file):
-    rsid = None
-    with open(log_file) as open_file:
-        for line in open_file:
-            line = line.strip()
-            if rsid:
-                # We are parsing the line just after finding the RS id
-                list_of_ssids = ast_parse_with_datetime(line.strip()[11:])
-                yield rsid, list_of_ssids
-                rsid = None
-            if 'Not all original SS has same info' in line:
-                sp_line = line.split()
-                rsid = int(sp_line[4].strip(','))
-
-        if rsid:
-            list_of_ssids = ast_parse_with_datetime(line.strip()[11:])
-            yield rsid, list_of_ssids
+def parse_eva2850_diagnostic_log(log_file, record_file=None):
+    return parse_diagnostic_log(log_file, record_file)
 
 
 genome_cache = {}
@@ -204,6 +172,131 @@ def get_genome_object(ref_genome_directory, genome_accession):
     return genome_cache[genome_accession]
 
 
+class SequenceWindowCache:
+    """
+    Serve the sequence requests made during normalisation from a window of the contig kept in memory.
+    Variants are expected to be processed in increasing position so the window only moves forward along the contig.
+    """
+
+    def __init__(self, genome_object, window_size=1000000, lookback=1000):
+        self.genome_object = genome_object
+        self.window_size = window_size
+        # Left alignment looks up to 1000 bases before the variant
+        self.lookback = lookback
+        self.contig_lengths = {}
+        self.contig = None
+        self.window_start = self.window_end = 0
+        self.window = ''
+        self.hits = self.misses = 0
+
+    def __getitem__(self, contig):
+        return ContigWindow(self, contig)
+
+    def contig_length(self, contig):
+        if contig not in self.contig_lengths:
+            self.contig_lengths[contig] = len(self.genome_object[contig])
+        return self.contig_lengths[contig]
+
+    def get_sequence(self, contig, start, end):
+        """Sequence between the 0-based start and end, or None if the request is not within the contig"""
+        contig_length = self.contig_length(contig)
+        if start >= contig_length:
+            return None
+        end = min(end, contig_length)
+        if contig == self.contig and self.window_start <= start and end <= self.window_end:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.contig = contig
+            self.window_start = max(0, start - self.lookback)
+            self.window_end = min(contig_length, max(end, start + self.window_size))
+            self.window = self.genome_object[contig][self.window_start:self.window_end]
+        return self.window[start - self.window_start:end - self.window_start]
+
+
+class ContigWindow:
+
+    def __init__(self, sequence_window_cache, contig):
+        self.sequence_window_cache = sequence_window_cache
+        self.contig = contig
+
+    def __getitem__(self, item):
+        sequence = None
+        if isinstance(item, slice):
+            if item.step is None and item.start is not None and item.stop is not None and 0 <= item.start <= item.stop:
+                sequence = self.sequence_window_cache.get_sequence(self.contig, item.start, item.stop)
+        elif item >= 0:
+            sequence = self.sequence_window_cache.get_sequence(self.contig, item, item + 1)
+        if sequence is None:
+            # Anything the window cannot serve, like negative indexes, goes to the genome
+            return self.sequence_window_cache.genome_object[self.contig][item]
+        return sequence
+
+
+def normalise_record(genome_object, contig, start, ref, alt):
+    """Return the variant with context base, the normalised variant and the error preventing normalisation if any"""
+    try:
+        context_pos, context_ref, context_alt = add_contex_base(genome_object, contig, start, ref, alt)
+        normalised_variant = leftnorm(contig, context_pos, context_ref, context_alt, fa=genome_object)
+        return (context_pos, context_ref, context_alt), normalised_variant, None
+    except ReferenceError as e:
+        return None, None, str(e)
+
+
+def normalise_partition(ref_genome_directory, genome_accession, contig, records):
+    """Normalise records of one contig in increasing position, reading the genome through a sequence window"""
+    start_time = time.perf_counter()
+    sequence_window = SequenceWindowCache(get_genome_object(ref_genome_directory, genome_accession))
+    results = [
+        (index, normalise_record(sequence_window, contig, start, ref, alt))
+        for index, start, ref, alt in sorted(records, key=lambda record: record[1])
+    ]
+    return os.getpid(), results, time.perf_counter() - start_time, sequence_window.hits, sequence_window.misses
+
+
+def normalise_ss_entities(ss_entities, ref_genome_directory, executor=None, partition_size=10000):
+    """
+    Normalise every submitted variant and return the results in the same order as the input.
+    Without executor the variants are normalised one after the other in this process. With an executor they are
+    grouped by contig, sorted by position and split in partitions that are normalised in the executor's processes.
+    """
+    if executor is None:
+        return [
+            normalise_record(get_genome_object(ref_genome_directory, ss_entity['seq']), ss_entity['contig'],
+                             ss_entity['start'], ss_entity['ref'], ss_entity['alt'])
+            for ss_entity in ss_entities
+        ]
+
+    records_per_contig = defaultdict(list)
+    for index, ss_entity in enumerate(ss_entities):
+        records_per_contig[(ss_entity['seq'], ss_entity['contig'])].append(
+            (index, ss_entity['start'], ss_entity['ref'], ss_entity['alt'])
+        )
+    futures = []
+    for (genome_accession, contig), records in records_per_contig.items():
+        records.sort(key=lambda record: record[1])
+        for i in range(0, len(records), partition_size):
+            futures.append(executor.submit(normalise_partition, ref_genome_directory, genome_accession, contig,
+                                           records[i:i + partition_size]))
+
+    results = [None] * len(ss_entities)
+    worker_stats = defaultdict(lambda: {'records': 0, 'duration': 0, 'hits': 0, 'misses': 0})
+    for future in as_completed(futures):
+        pid, partition_results, duration, hits, misses = future.result()
+        for index, result in partition_results:
+            results[index] = result
+        worker_stats[pid]['records'] += len(partition_results)
+        worker_stats[pid]['duration'] += duration
+        worker_stats[pid]['hits'] += hits
+        worker_stats[pid]['misses'] += misses
+    for pid, stats in worker_stats.items():
+        requests = stats['hits'] + stats['misses']
+        logger.info(f"Worker {pid}: {stats['records']} records normalised "
+                    f"({stats['records'] / max(stats['duration'], 1e-9):.0f} records/s), "
+                    f"sequence window hit rate {stats['hits'] / requests if requests else 0:.2%}")
+    return results
+
+
 def variant_type(ref, alt):
     if len(ref) == len(alt) == 1:
         return 'SNP'
@@ -250,31 +343,42 @@ def shelve_submitted_variant_entities(mongo_handle, submitted_variant_ids, input
         # assert response.deleted_count == len(batch_sve_ids), 'Not all variants were deleted from dbsnpSubmittedVariantEntity'
 
 
-def process_diagnostic_log(log_file, ref_genome_directory, mongo_handle=None):
+def process_diagnostic_log(log_file, ref_genome_directory, mongo_handle=None, num_processes=1, chunk_size=10000,
+                           record_file=None):
     count_normalisation = count_splits = 0
     all_submitted_variant_ids = set()
-    for rsid, list_of_ss_entities in parse_eva2850_diagnostic_log(log_file):
-        try:
-            variant_to_entities = defaultdict(list)
-            for ss_entity in list_of_ss_entities:
-                all_submitted_variant_ids.add(ss_entity['_id'])
-                genome_object = get_genome_object(ref_genome_directory, ss_entity['seq'])
-                context_pos, context_ref, context_alt = add_contex_base(
-                    genome_object, ss_entity['contig'], ss_entity['start'], ss_entity['ref'], ss_entity['alt']
-                )
-                normalised_pos, normalised_ref, normalised_alt = leftnorm(
-                    ss_entity['contig'], context_pos, context_ref, context_alt, fa=genome_object
-                )
-                context_entity = {'start': context_pos, 'ref': context_ref, 'alt': context_alt}
-                normalised_clustered_variant_definition = (normalised_pos, variant_type(normalised_ref, normalised_alt))
-                ss_entity['contig'] + str(ss_entity['start']) + ss_entity['ref'] + ss_entity['alt']
-                normalised_entity = {'start': normalised_pos, 'ref': normalised_ref, 'alt': normalised_alt}
-                variant_to_entities[normalised_clustered_variant_definition].append((ss_entity, context_entity, normalised_entity))
-            count_normalisation += process_renormalisation(variant_to_entities)
-            count_splits += process_split(rsid, variant_to_entities)
-        except ReferenceError as e:
-            logger.error(f'Cannot Process rs{rsid} because one of the ssid cannot be normalised')
-            logger.error(str(e))
+    executor = ProcessPoolExecutor(max_workers=num_processes) if num_processes > 1 else None
+    try:
+        for rs_chunk in grouper(parse_eva2850_diagnostic_log(log_file, record_file), chunk_size):
+            rs_chunk = [rs_and_ss_entities for rs_and_ss_entities in rs_chunk if rs_and_ss_entities]
+            normalisation_results = iter(normalise_ss_entities(
+                [ss_entity for _, list_of_ss_entities in rs_chunk for ss_entity in list_of_ss_entities],
+                ref_genome_directory, executor
+            ))
+            for rsid, list_of_ss_entities in rs_chunk:
+                variant_to_entities = defaultdict(list)
+                rs_normalisation_results = [next(normalisation_results) for _ in list_of_ss_entities]
+                for ss_entity, (context_variant, normalised_variant, error) in zip(list_of_ss_entities,
+                                                                                   rs_normalisation_results):
+                    all_submitted_variant_ids.add(ss_entity['_id'])
+                    if error:
+                        logger.error(f'Cannot Process rs{rsid} because one of the ssid cannot be normalised')
+                        logger.error(error)
+                        break
+                    context_pos, context_ref, context_alt = context_variant
+                    normalised_pos, normalised_ref, normalised_alt = normalised_variant
+                    context_entity = {'start': context_pos, 'ref': context_ref, 'alt': context_alt}
+                    normalised_clustered_variant_definition = (normalised_pos,
+                                                               variant_type(normalised_ref, normalised_alt))
+                    normalised_entity = {'start': normalised_pos, 'ref': normalised_ref, 'alt': normalised_alt}
+                    variant_to_entities[normalised_clustered_variant_definition].append((ss_entity, context_entity,
+                                                                                         normalised_entity))
+                else:
+                    count_normalisation += process_renormalisation(variant_to_entities)
+                    count_splits += process_split(rsid, variant_to_entities)
+    finally:
+        if executor:
+            executor.shutdown()
     logger.info(f'{count_normalisation} submitted variants need to be renormalised')
     logger.info(f'{count_splits} clustered variants need to be created')
 
@@ -326,13 +430,19 @@ def main():
     parser.add_argument('--ref_genome_directory')
     parser.add_argument('--settings_xml_file')
     parser.add_argument('--profile', default='development')
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help='Number of processes used to normalise the variants. 1 normalises them serially')
+    parser.add_argument('--record_file',
+                        help='File where the parsed diagnostic log is stored and reused while it is newer than the log')
     args = parser.parse_args()
     if args.settings_xml_file:
         mongo_uri = get_mongo_uri_for_eva_profile(args.profile, args.settings_xml_file)
         with MongoClient(mongo_uri) as mongo_handle:
-            process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory, mongo_handle)
+            process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory, mongo_handle,
+                                   num_processes=args.num_processes, record_file=args.record_file)
     else:
-        process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory)
+        process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory, num_processes=args.num_processes,
+                               record_file=args.record_file)
 
 
 if __name__ == '__main__':
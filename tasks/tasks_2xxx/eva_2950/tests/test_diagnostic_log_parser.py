@@ -0,0 +1,69 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from bson import ObjectId
+
+from tasks.eva_2950.diagnostic_log_parser import parse_literal, LiteralParser, parse_diagnostic_log
+
+
+class TestParseLiteral(TestCase):
+
+    test_dir = os.path.dirname(__file__)
+
+    def test_same_as_eval_on_diagnostic_log(self):
+        with open(os.path.join(self.test_dir, 'diagnostic_output_log.out')) as open_file:
+            log_lines = open_file.readlines()
+        # The documents are logged on the line following the RS id
+        lines = [log_lines[i + 1].strip()[11:] for i, line in enumerate(log_lines[:-1])
+                 if 'Not all original SS has same info' in line]
+        assert lines
+        for line in lines:
+            expected = eval(line, {'__builtins__': {}, 'datetime': datetime})
+            assert parse_literal(line) == expected
+            assert LiteralParser(line).parse() == expected
+
+    def test_parse_values(self):
+        text = ("{'_id': ObjectId('5f1b2c3d4e5f6a7b8c9d0e1f'), 'list': [1, -2.5, 1e-05], 'tuple': (1, 'a'), "
+                "'escaped': 'it\\'s', 'double': \"say \\\"hi\\\"\", 'flags': [True, False, None], "
+                "'date': datetime.datetime(2021, 3, 4, 5, 6, 7), 1: 'int key'}")
+        assert parse_literal(text) == {
+            '_id': ObjectId('5f1b2c3d4e5f6a7b8c9d0e1f'), 'list': [1, -2.5, 1e-05], 'tuple': (1, 'a'),
+            'escaped': "it's", 'double': 'say "hi"', 'flags': [True, False, None],
+            'date': datetime.datetime(2021, 3, 4, 5, 6, 7), 1: 'int key'
+        }
+
+    def test_reject_code(self):
+        for text in ["__import__('os').system('ls')", "{'a': open('/etc/passwd')}", "[true, null]",
+                     "datetime.datetime.now()", "{'a': 1} + {}", "[1, 2"]:
+            with self.assertRaises(ValueError):
+                parse_literal(text)
+
+
+class TestParseDiagnosticLog(TestCase):
+
+    test_dir = os.path.dirname(__file__)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_file(self):
+        log_file = os.path.join(self.tmp_dir, 'diagnostic_output_log.out')
+        shutil.copy(os.path.join(self.test_dir, 'diagnostic_output_log.out'), log_file)
+        record_file = os.path.join(self.tmp_dir, 'diagnostic_output_log.records')
+        expected = list(parse_diagnostic_log(log_file))
+
+        assert list(parse_diagnostic_log(log_file, record_file)) == expected
+        assert os.path.exists(record_file)
+        # The record file is used as long as it is more recent than the log
+        with open(log_file, 'w'):
+            pass
+        os.utime(log_file, (0, 0))
+        assert list(parse_diagnostic_log(log_file, record_file)) == expected
+        os.utime(log_file)
+        assert list(parse_diagnostic_log(log_file, record_file)) == []
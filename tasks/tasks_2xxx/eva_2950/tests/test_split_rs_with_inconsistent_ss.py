@@ -1,10 +1,14 @@
 import os.path
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 from unittest import TestCase
 
 from pyfaidx import Fasta
 
-from tasks.eva_2950.split_rs_with_inconsistent_ss import leftnorm, parse_eva2850_diagnositc_log, process_diagnostic_log
+from tasks.eva_2950.split_rs_with_inconsistent_ss import leftnorm, parse_eva2850_diagnostic_log, process_diagnostic_log, \
+    normalise_ss_entities, SequenceWindowCache
 
 
 class TestNormalisation(TestCase):
@@ -33,6 +37,42 @@ class TestNormalisation(TestCase):
         alt = 'T'
         assert (leftnorm(chrom, pos, ref, alt, fa=fa)) == (80, 'C', 'CT')
 
+    def test_leftnorm_with_sequence_window(self):
+        fasta_file = os.path.join(self.test_dir, 'fasta_file.fa')
+        sequence_window = SequenceWindowCache(Fasta(fasta_file, as_raw=True, read_ahead=40000), window_size=50)
+        chrom = 'AP014957.1'
+        assert (leftnorm(chrom, 81, '', 'TTTTT', fa=sequence_window)) == (80, 'C', 'CTTTTT')
+        assert (leftnorm(chrom, 91, '', 'T', fa=sequence_window)) == (80, 'C', 'CT')
+        assert sequence_window.hits > 0
+
+
+class TestParallelNormalisation(TestCase):
+
+    test_dir = os.path.dirname(__file__)
+
+    def setUp(self) -> None:
+        self.ref_genome_dir = tempfile.mkdtemp()
+        genome_dir = os.path.join(self.ref_genome_dir, 'species', 'GCA_TEST.1')
+        os.makedirs(genome_dir)
+        shutil.copy(os.path.join(self.test_dir, 'fasta_file.fa'), os.path.join(genome_dir, 'GCA_TEST.1.fa'))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.ref_genome_dir)
+
+    def test_same_results_as_serial_normalisation(self):
+        variants = [(91, '', 'TTTTT'), (81, '', 'T'), (150, 'G', ''), (70, 'T', 'C'), (85, 'T', 'G'), (120, 'AG', ''),
+                    (91, '', 'T'), (10, '', 'GA'), (70, 'G', 'C')]
+        ss_entities = [
+            {'seq': 'GCA_TEST.1', 'contig': 'AP014957.1', 'start': start, 'ref': ref, 'alt': alt}
+            for start, ref, alt in variants
+        ]
+        serial_results = normalise_ss_entities(ss_entities, self.ref_genome_dir)
+        # One of the variant cannot be normalised
+        assert len([error for _, _, error in serial_results if error]) == 1
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            parallel_results = normalise_ss_entities(ss_entities, self.ref_genome_dir, executor, partition_size=3)
+        assert serial_results == parallel_results
+
 
 class TestSplitRS(TestCase):
 
@@ -42,7 +82,7 @@ class TestSplitRS(TestCase):
         diagnostic_file = os.path.join(self.test_dir, 'diagnostic_output_log.out')
         rsids = []
         lists_of_ssids = []
-        for rsid, list_of_ssids in parse_eva2850_diagnositc_log(diagnostic_file):
+        for rsid, list_of_ssids in parse_eva2850_diagnostic_log(diagnostic_file):
             rsids.append(rsid)
             lists_of_ssids.append(list_of_ssids)
 
@@ -1,60 +1,101 @@
+import time
 from argparse import ArgumentParser
-from collections import Counter, defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from ebi_eva_common_pyutils.config_utils import get_mongo_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
-from itertools import zip_longest
 from pymongo import MongoClient, WriteConcern, ReadPreference
+from pymongo.errors import BulkWriteError
 from pymongo.read_concern import ReadConcern
 
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
+duplicate_key_error_code = 11000
 
-def grouper(iterable, n, fillvalue=None):
-    args = [iter(iterable)] * n
-    return zip_longest(fillvalue=fillvalue, *args)
 
+def get_duplicate_detection_pipeline(assembly_accession, accessions):
+    """
+    Aggregation grouping the submitted variants of the accessions per accession. Variants with the multimapped or
+    allele mismatch flag set are ignored because they are ignored anyway. Only the accessions with more than one
+    variant come back with their variants, the other ones only with their count.
+    """
+    return [
+        {'$match': {'seq': assembly_accession, 'accession': {'$in': accessions},
+                    'allelesMatch': {'$exists': False}, 'mapWeight': {'$exists': False}}},
+        {'$group': {'_id': '$accession', 'count': {'$sum': 1}, 'documents': {'$push': '$$ROOT'}}},
+        {'$project': {'count': 1, 'documents': {'$cond': [{'$gt': ['$count', 1]}, '$documents', []]}}}
+    ]
 
-def check_submitted_variant_have_duplicates(submitted_variant_records):
-    count_per_ssid = Counter()
-    ssid_to_variant_list = defaultdict(list)
+
+def find_duplicated_submitted_variants(source_collection, assembly_accession, accessions):
     duplicated_variants = []
-    for variant_rec in submitted_variant_records:
-        if 'allelesMatch' in variant_rec or 'mapWeight' in variant_rec:
-            # Ingore the variant that have multimapped or allele mismatch flag set because they are ignored anyway
-            continue
-        count_per_ssid[variant_rec['accession']] += 1
-        ssid_to_variant_list[variant_rec['accession']].append(variant_rec)
-
-    for ssid in count_per_ssid:
-        if count_per_ssid[ssid] > 1:
-            duplicated_variants.extend(ssid_to_variant_list[ssid])
+    for accession_group in source_collection.aggregate(get_duplicate_detection_pipeline(assembly_accession,
+                                                                                         accessions)):
+        if accession_group['count'] > 1:
+            duplicated_variants.extend(accession_group['documents'])
         else:
-            logger.warning(f'Found only {count_per_ssid.get(ssid, 0)} variant for ss{ssid}')
+            logger.warning(f'Found only {accession_group["count"]} variant for ss{accession_group["_id"]}')
+    logger.info(f'Found {len(duplicated_variants)} duplicated documents for {len(accessions)} accessions')
     return duplicated_variants
 
 
-def shelve_submitted_variant_entities(mongo_handle, submitted_variant_accession, assembly_accession):
-    output_collection = 'eva2979_dbsnpSubmittedVariantEntity'
-    batch_size = 1000
-    for batch_sve_accs in grouper(submitted_variant_accession, batch_size):
-        # remove None
-        batch_sve_accs = [acc for acc in batch_sve_accs if acc]
-        query_filter = {'seq': assembly_accession, 'accession': {'$in': batch_sve_accs}}
-        documents = [d for d in mongo_handle["eva_accession_sharded"]['dbsnpSubmittedVariantEntity'].
-                     with_options(read_concern=ReadConcern("majority"), read_preference=ReadPreference.PRIMARY).
-                     find(query_filter)]
-        logger.info(f'Found {len(documents)} documents for {len(batch_sve_accs)} accessions')
-        duplicated_submitted_variant_ids = check_submitted_variant_have_duplicates(documents)
-        if duplicated_submitted_variant_ids:
-            mongo_handle["eva_accession_sharded"][output_collection].\
-                with_options(write_concern=WriteConcern("majority")).\
-                insert_many(duplicated_submitted_variant_ids)
-            # response = mongo_handle['dbsnpSubmittedVariantEntity'].\
-            #     with_options(write_concern=WriteConcern("majority")).\
-            #     delete_many({'_id': {'$in': duplicated_submitted_variant_ids}})
-            # assert response.deleted_count == len(duplicated_submitted_variant_ids), 'Not all variants were deleted from dbsnpSubmittedVariantEntity'
+def insert_shelved_submitted_variants(output_collection, duplicated_variants):
+    """Insert the variants in any order, skipping the ones shelved by a previous run. Return the number inserted."""
+    try:
+        num_inserted = len(output_collection.insert_many(duplicated_variants, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        other_errors = [error for error in e.details['writeErrors'] if error['code'] != duplicate_key_error_code]
+        if other_errors:
+            raise
+        num_inserted = e.details['nInserted']
+    return num_inserted
+
+
+def shelve_submitted_variant_entities(mongo_handle, submitted_variant_accession, assembly_accession, batch_size=1000,
+                                      num_readers=2, num_writers=2):
+    """
+    Copy the submitted variants of the accessions that have more than one variant in the assembly to the output
+    collection. Duplicates are found by the server for batches of consecutive accessions and written in bulk while the
+    next batches are read.
+    """
+    output_collection_name = 'eva2979_dbsnpSubmittedVariantEntity'
+    source_collection = mongo_handle["eva_accession_sharded"]['dbsnpSubmittedVariantEntity'].\
+        with_options(read_concern=ReadConcern("majority"), read_preference=ReadPreference.PRIMARY)
+    output_collection = mongo_handle["eva_accession_sharded"][output_collection_name].\
+        with_options(write_concern=WriteConcern("majority"))
+    # Sorted batches are contiguous ranges of the accession index
+    accessions = sorted(set(submitted_variant_accession))
+    num_inserted = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_readers) as read_executor, \
+            ThreadPoolExecutor(max_workers=num_writers) as write_executor:
+        pending_reads = deque()
+        pending_writes = deque()
+
+        def write_oldest_read():
+            nonlocal num_inserted
+            duplicated_variants = pending_reads.popleft().result()
+            if duplicated_variants:
+                pending_writes.append(write_executor.submit(insert_shelved_submitted_variants, output_collection,
+                                                            duplicated_variants))
+            # Bound the number of batches held in memory while they are written
+            while len(pending_writes) > num_writers * 2:
+                num_inserted += pending_writes.popleft().result()
+
+        for start in range(0, len(accessions), batch_size):
+            pending_reads.append(read_executor.submit(find_duplicated_submitted_variants, source_collection,
+                                                      assembly_accession, accessions[start:start + batch_size]))
+            while len(pending_reads) > num_readers * 2:
+                write_oldest_read()
+        while pending_reads:
+            write_oldest_read()
+        while pending_writes:
+            num_inserted += pending_writes.popleft().result()
+    duration = max(time.perf_counter() - start_time, 1e-9)
+    logger.info(f'Shelved {num_inserted} submitted variants for {len(accessions)} accessions in {duration:.1f}s '
+                f'({len(accessions) / duration:.0f} accessions/s)')
 
 
 def parse_duplicate_list(duplicates_file):
@@ -77,13 +118,18 @@ def main():
     parser.add_argument('--duplicates_file', required=True)
     parser.add_argument('--settings_xml_file', required=True)
     parser.add_argument('--profile', default='development')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Number of accessions checked in each query')
+    parser.add_argument('--num_readers', type=int, default=2, help='Number of queries finding duplicates in parallel')
+    parser.add_argument('--num_writers', type=int, default=2, help='Number of inserts running in parallel')
     args = parser.parse_args()
     mongo_uri = get_mongo_uri_for_eva_profile(args.profile, args.settings_xml_file)
     with MongoClient(mongo_uri) as mongo_handle:
         duplicated_accessions, assembly_accession = parse_duplicate_list(args.duplicates_file)
         if duplicated_accessions:
             logger.info(f'Will attempt to shelf {len(duplicated_accessions)} for assembly {assembly_accession}')
-            shelve_submitted_variant_entities(mongo_handle, duplicated_accessions, assembly_accession)
+            shelve_submitted_variant_entities(mongo_handle, duplicated_accessions, assembly_accession,
+                                              batch_size=args.batch_size, num_readers=args.num_readers,
+                                              num_writers=args.num_writers)
         else:
             logger.info(f'No duplicated variants for assembly {assembly_accession}')
 